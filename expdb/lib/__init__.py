@@ -1,7 +1,20 @@
 from .queries import (
-    get_latest_timecourses_by_modality
+    LatestTimecourse,
+    StageSummary,
+    get_latest_timecourses,
+    get_latest_timecourses_by_modality,
+    get_slowest_stages,
+    summarize_stages_by_commit
 )
+from .sync import SyncReader, SyncWindow
 
 __all__ = [
-    'get_latest_timecourses_by_modality'
+    'LatestTimecourse',
+    'StageSummary',
+    'SyncReader',
+    'SyncWindow',
+    'get_latest_timecourses',
+    'get_latest_timecourses_by_modality',
+    'get_slowest_stages',
+    'summarize_stages_by_commit'
 ]
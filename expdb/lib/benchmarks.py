@@ -0,0 +1,222 @@
+"""
+Benchmarks of lineage queries on synthetic DAGs.
+
+Builds a study of synthetic subjects, each with uploads that have trees of
+derivatives, and times get_latest_timecourses over the whole study against
+calling get_latest_timecourses_by_modality subject by subject:
+
+    python -m expdb.lib.benchmarks --subjects 100 --uploads 4 --depth 8
+"""
+from typing import Dict, List, Optional
+
+import sqlalchemy
+from sqlalchemy import event, insert
+from sqlalchemy.orm import Session, sessionmaker
+
+from datetime import datetime, timedelta
+import argparse
+import random
+import time
+
+from ..models import Base, DataType, Modality, Study, Subject, Timecourse
+from ..models.timecourse import (rebuild_lineage_closure,
+                                 timecourse_lineage_association)
+from .queries import get_latest_timecourses, get_latest_timecourses_by_modality
+
+
+def build_synthetic_study(
+    session: Session,
+    n_subjects: int,
+    uploads_per_subject: int = 4,
+    depth: int = 8,
+    branching: int = 2,
+    merge_rate: float = 0.1,
+    seed: int = 0
+) -> Study:
+    """
+    Add a study of synthetic subjects with DAGs of derived timecourses.
+
+    Each subject has EEG uploads and, for each, ``depth`` levels of
+    derivatives, each derived from a random timecourse of the level above.
+    Some derivatives (``merge_rate``) have a second parent in the level
+    above, and each upload also has a derivative of another modality. Rows
+    are inserted in bulk, so that DAGs of many thousands of timecourses are
+    built in seconds.
+
+    Parameters
+    ----------
+    session : Session
+        SQLAlchemy session
+    n_subjects : int
+        The number of subjects
+    uploads_per_subject : int
+        The number of EEG uploads of each subject
+    depth : int
+        The number of levels of derivatives of each upload
+    branching : int
+        The number of derivatives in each level
+    merge_rate : float
+        The fraction of derivatives with two parents
+    seed : int
+        Seed of the random DAGs
+
+    Returns
+    -------
+    Study
+        The study, committed.
+    """
+    rng = random.Random(seed)
+    study = Study(name=f"synthetic_{seed}_{n_subjects}",
+                  github_repo="synthetic/dag")
+    subjects = [Subject(name=f"Synthetic {i}", code=f"S{i:05d}", age=30,
+                        meditation_experience=0)
+                for i in range(n_subjects)]
+    session.add(study)
+    session.add_all(subjects)
+    session.flush()
+
+    next_id = (session.query(sqlalchemy.func.max(Timecourse.id)).scalar()
+               or 0) + 1
+    start = datetime(2024, 1, 1)
+    rows: List[Dict] = []
+    edges: List[Dict] = []
+
+    def add(subject: Subject, modality: Modality, data_type: DataType,
+            parents: List[int]) -> int:
+        nonlocal next_id
+        tc_id, next_id = next_id, next_id + 1
+        rows.append({
+            "id": tc_id, "sampling_rate": 256.0, "modality": modality,
+            "type": data_type, "path": f"{study.name}/{tc_id}.fif",
+            "transform_names_json": "[]", "transform_params_json": "[]",
+            "git_commit": "synthetic", "_is_pilot": False,
+            "date_collected": start + timedelta(minutes=tc_id),
+            "subject_id": subject.id, "study_id": study.id})
+        edges.extend({"parent_timecourse_id": parent,
+                      "derived_timecourse_id": tc_id} for parent in parents)
+        return tc_id
+
+    for subject in subjects:
+        for _ in range(uploads_per_subject):
+            upload = add(subject, Modality.IMAGING, DataType.EEG, [])
+            add(subject, Modality.BEHAVIORAL, DataType.INPUT_RESPONSE,
+                [upload])
+            level = [upload]
+            for _ in range(depth):
+                below = []
+                for _ in range(branching):
+                    parents = [rng.choice(level)]
+                    if len(level) > 1 and rng.random() < merge_rate:
+                        parents.append(rng.choice(
+                            [tc for tc in level if tc != parents[0]]))
+                    below.append(add(subject, Modality.IMAGING,
+                                     DataType.EEG, parents))
+                level = below
+
+    session.execute(insert(Timecourse.__table__), rows)
+    session.execute(insert(timecourse_lineage_association), edges)
+    # Bulk inserts bypass the ORM, so the closure table is built here.
+    rebuild_lineage_closure(session.connection(),
+                            {row["id"] for row in rows})
+    session.commit()
+    return study
+
+
+def benchmark_latest(session: Session, study: Study,
+                     modality: Modality = Modality.IMAGING,
+                     repeats: int = 3) -> Dict[str, float]:
+    """
+    Time finding the latest derivative of every upload of a study.
+
+    Parameters
+    ----------
+    session : Session
+        SQLAlchemy session
+    study : Study
+        The study, e.g. from ``build_synthetic_study``
+    modality : Modality
+        The modality to query
+    repeats : int
+        The best of this many runs is reported
+
+    Returns
+    -------
+    dict
+        The seconds and number of SQL statements taken by
+        get_latest_timecourses over the whole study ("study") and by
+        get_latest_timecourses_by_modality for each subject in turn
+        ("per_subject").
+    """
+    subjects = (session.query(Subject)
+                .filter(Subject.id.in_(
+                    session.query(Timecourse.subject_id)
+                    .filter(Timecourse.study_id == study.id)))
+                .order_by(Subject.id).all())
+    statements = []
+
+    def count(*args):
+        statements.append(args[2])
+
+    def run(fn) -> Dict[str, float]:
+        best = float("inf")
+        for _ in range(repeats):
+            # Start from an empty session, but for the study and subjects.
+            session.expunge_all()
+            session.add(study)
+            session.add_all(subjects)
+            statements.clear()
+            began = time.perf_counter()
+            fn()
+            best = min(best, time.perf_counter() - began)
+        return {"seconds": best, "statements": len(statements)}
+
+    engine = session.get_bind()
+    event.listen(engine, "before_cursor_execute", count)
+    try:
+        return {
+            "study": run(lambda: get_latest_timecourses(
+                session, modality, study=study)),
+            "per_subject": run(lambda: [
+                get_latest_timecourses_by_modality(session, subject, modality)
+                for subject in subjects]),
+        }
+    finally:
+        event.remove(engine, "before_cursor_execute", count)
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark lineage queries on a synthetic study.")
+    parser.add_argument("--database-url", default="sqlite://",
+                        help="Database to build the study in; defaults to "
+                        "an in-memory SQLite database.")
+    parser.add_argument("--subjects", type=int, default=100)
+    parser.add_argument("--uploads", type=int, default=4)
+    parser.add_argument("--depth", type=int, default=8)
+    parser.add_argument("--branching", type=int, default=2)
+    parser.add_argument("--merge-rate", type=float, default=0.1)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    engine = sqlalchemy.create_engine(args.database_url)
+    Base.metadata.create_all(engine)
+    session = sessionmaker(bind=engine)()
+    began = time.perf_counter()
+    study = build_synthetic_study(
+        session, args.subjects, uploads_per_subject=args.uploads,
+        depth=args.depth, branching=args.branching,
+        merge_rate=args.merge_rate, seed=args.seed)
+    n_timecourses = (session.query(Timecourse)
+                     .filter(Timecourse.study_id == study.id).count())
+    print(f"Built {n_timecourses} timecourses for {args.subjects} subjects "
+          f"in {time.perf_counter() - began:.1f}s")
+    for name, result in benchmark_latest(session, study,
+                                         repeats=args.repeats).items():
+        print(f"{name:>12}: {result['seconds'] * 1000:8.1f} ms, "
+              f"{result['statements']} statements")
+    session.close()
+
+
+if __name__ == "__main__":
+    main()
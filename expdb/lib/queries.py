@@ -1,8 +1,10 @@
-from typing import List, Optional
+from typing import Iterable, List, NamedTuple, Optional, Union
 from sqlalchemy.orm import Session
-from sqlalchemy import and_
+from sqlalchemy import Select, func, select
 
-from ..models import Timecourse, Subject, Data, Modality
+from ..models import Timecourse, Study, Subject, Data, Modality
+from ..models.timecourse import timecourse_lineage_association
+from ..models import TransformRun, TransformRunStage
 
 def _get_latest_derived_timecourse(source_timecourse: Timecourse) -> Optional[Timecourse]:
     """
@@ -21,26 +23,10 @@ def _get_latest_derived_timecourse(source_timecourse: Timecourse) -> Optional[Ti
     Optional[Timecourse]
         The most recent derived timecourse, or None if there are no derivatives
     """
-    # Get all timecourses that derive from this one (directly or indirectly)
-    derived = []
-    to_check = [source_timecourse]
-    checked = set()
-    
-    while to_check:
-        current = to_check.pop(0)
-        if current.id in checked:
-            continue
-            
-        checked.add(current.id)
-        children = current.derived_timecourses.all()
-        derived.extend(children)
-        to_check.extend(children)
-    
-    if not derived:
-        return None
-    
-    # Return the most recent one
-    return max(derived, key=lambda tc: tc.date_collected)
+    # Every descendant, at any depth, is in the lineage closure.
+    return (source_timecourse.descendants
+            .order_by(Timecourse.date_collected.desc(), Timecourse.id.desc())
+            .first())
 
 def _find_original_upload(timecourse: Timecourse) -> Optional[Timecourse]:
     """
@@ -65,13 +51,111 @@ def _find_original_upload(timecourse: Timecourse) -> Optional[Timecourse]:
         matching_parents = []
         for parent in current.derived_from:
             if (parent.data.modality == current_modality and 
-                parent.type == current_datatype):
+                parent.data.type == current_datatype):
                 matching_parents.append(parent)
         
         if not matching_parents:
             return current
         current = matching_parents[0]  # Follow first parent in case of multiple parents
 
+class LatestTimecourse(NamedTuple):
+    subject_id: int
+    upload_id: int
+    timecourse: Timecourse
+
+
+def get_latest_timecourses(
+    session: Session,
+    modality: Modality,
+    subjects: Optional[Iterable[Union[Subject, int]]] = None,
+    study: Optional[Study] = None
+) -> List[LatestTimecourse]:
+    """
+    Find the latest derivative of each original upload of a modality, for
+    many subjects or a whole study, in one query.
+
+    An upload's derivatives are the timecourses derived from it through a
+    chain of timecourses of the same subject, modality and data type. The
+    latest is the most recently collected of the upload and its
+    derivatives. The chains are followed with a recursive query, and the
+    latest of each is picked with a window function, so the cost doesn't
+    grow with the depth of the lineage nor the number of uploads.
+
+    Parameters
+    ----------
+    session : Session
+        SQLAlchemy session
+    modality : Modality
+        The modality to filter by
+    subjects : Iterable[Subject or int], optional
+        Only consider these subjects (or subject ids)
+    study : Study, optional
+        Only consider this study's timecourses
+
+    Returns
+    -------
+    List[LatestTimecourse]
+        One per original upload, ordered by subject and upload. A timecourse
+        derived from several uploads is the latest of each of them.
+    """
+    subject_ids = None
+    if subjects is not None:
+        subject_ids = sorted({s if isinstance(s, int) else s.id
+                              for s in subjects})
+    study_id = None if study is None else study.id
+    rows = session.execute(
+        _latest_timecourses_query(modality, subject_ids, study_id)).all()
+    return [LatestTimecourse(*row) for row in rows]
+
+
+def _latest_timecourses_query(modality: Modality,
+                              subject_ids: Optional[List[int]],
+                              study_id: Optional[int]) -> Select:
+    """The statement of ``get_latest_timecourses``."""
+    timecourses = Timecourse.__table__
+    lineage = timecourse_lineage_association
+    scope = [timecourses.c.modality == modality]
+    if subject_ids is not None:
+        scope.append(timecourses.c.subject_id.in_(subject_ids))
+    if study_id is not None:
+        scope.append(timecourses.c.study_id == study_id)
+
+    has_parent = (select(lineage.c.derived_timecourse_id)
+                  .where(lineage.c.derived_timecourse_id == timecourses.c.id)
+                  .exists())
+    chains = (select(timecourses.c.id.label('upload_id'),
+                     timecourses.c.id.label('id'),
+                     timecourses.c.subject_id.label('subject_id'),
+                     timecourses.c.type.label('type'))
+              .where(*scope, ~has_parent)
+              .cte('chains', recursive=True))
+    child = timecourses.alias('child')
+    # UNION rather than UNION ALL, so that diamonds are only walked once.
+    chains = chains.union(
+        select(chains.c.upload_id, child.c.id, child.c.subject_id,
+               child.c.type)
+        .join(lineage, lineage.c.parent_timecourse_id == chains.c.id)
+        .join(child, child.c.id == lineage.c.derived_timecourse_id)
+        .where(child.c.subject_id == chains.c.subject_id,
+               child.c.modality == modality,
+               child.c.type == chains.c.type))
+
+    ranked = (select(
+                  chains.c.upload_id,
+                  chains.c.subject_id,
+                  chains.c.id,
+                  func.row_number().over(
+                      partition_by=chains.c.upload_id,
+                      order_by=(timecourses.c.date_collected.desc(),
+                                timecourses.c.id.desc())).label('rank'))
+              .join(timecourses, timecourses.c.id == chains.c.id)
+              .subquery('ranked'))
+    return (select(ranked.c.subject_id, ranked.c.upload_id, Timecourse)
+            .join(ranked, Timecourse.id == ranked.c.id)
+            .where(ranked.c.rank == 1)
+            .order_by(ranked.c.subject_id, ranked.c.upload_id))
+
+
 def get_latest_timecourses_by_modality(
     session: Session, 
     subject: Subject,
@@ -81,6 +165,8 @@ def get_latest_timecourses_by_modality(
     Find all latest derived timecourses for a subject with a specific modality.
     For each original upload, finds the most recent timecourse that derives from
     the same original upload (including sister timecourses).
+
+    See ``get_latest_timecourses``, which does this for many subjects at once.
     
     Parameters
     ----------
@@ -96,35 +182,104 @@ def get_latest_timecourses_by_modality(
     List[Timecourse]
         List of the most recent timecourses that derive from each original upload
     """
-    # Get all timecourses for this subject with the specified modality
-    base_query = session.query(Timecourse).filter(
-        and_(
-            Timecourse.subject_id == subject.id,
-            Timecourse.modality == modality
-        )
-    )
-    
-    # Find original uploads
-    original_uploads = [tc for tc in base_query.all() 
-                       if not tc.derived_from.count()]
-    
-    # Get latest derivative for each upload
-    latest_timecourses = []
-    for upload in original_uploads:
-        # Get all timecourses that derive from this upload
-        all_derived = base_query.filter(
-            Timecourse.id.in_(
-                tc.id for tc in base_query.all()
-                if _find_original_upload(tc) == upload
-            )
-        ).all()
-        
-        if all_derived:
-            # Get the most recent one
-            latest = max(all_derived, key=lambda tc: tc.date_collected)
-            latest_timecourses.append(latest)
-        else:
-            # If no derivatives, include the original upload
-            latest_timecourses.append(upload)
-            
-    return latest_timecourses
\ No newline at end of file
+    latest = []
+    for row in get_latest_timecourses(session, modality, subjects=[subject]):
+        if row.timecourse not in latest:
+            latest.append(row.timecourse)
+    return latest
+
+
+def get_slowest_stages(
+    session: Session,
+    stage: str,
+    transform: Optional[str] = None,
+    git_commit: Optional[str] = None,
+    limit: int = 20
+) -> List[TransformRunStage]:
+    """
+    Find the transform runs that spent the longest in a stage.
+
+    Parameters
+    ----------
+    session : Session
+        SQLAlchemy session
+    stage : str
+        The stage, e.g. "load", "transform" or "store/upload"
+    transform : str, optional
+        Only consider runs of the Transform subclass with this name
+    git_commit : str, optional
+        Only consider runs at this commit
+    limit : int
+        The number of stages to return
+
+    Returns
+    -------
+    List[TransformRunStage]
+        The slowest stages, slowest first. Their ``run`` gives the transform,
+        commit and timecourse.
+    """
+    query = (session.query(TransformRunStage)
+             .join(TransformRunStage.run)
+             .filter(TransformRunStage.stage == stage))
+    if transform is not None:
+        query = query.filter(TransformRun.transform == transform)
+    if git_commit is not None:
+        query = query.filter(TransformRun.git_commit == git_commit)
+    return (query.order_by(TransformRunStage.wall_time.desc())
+            .limit(limit).all())
+
+
+class StageSummary(NamedTuple):
+    git_commit: Optional[str]
+    stage: str
+    runs: int
+    mean_wall_time: float
+    max_wall_time: float
+    mean_cpu_time: float
+    mean_bytes: Optional[float]
+    max_rss: Optional[int]
+
+
+def summarize_stages_by_commit(
+    session: Session,
+    transform: str
+) -> List[StageSummary]:
+    """
+    Summarize the cost of each stage of a transform at each git commit.
+
+    Comparing a stage across commits shows when it regressed.
+
+    Parameters
+    ----------
+    session : Session
+        SQLAlchemy session
+    transform : str
+        The name of the Transform subclass
+
+    Returns
+    -------
+    List[StageSummary]
+        One summary per commit and stage, ordered by when the commit first
+        ran and then by stage.
+    """
+    first_run = func.min(TransformRun.started_at)
+    rows = (session.query(
+                TransformRun.git_commit,
+                TransformRunStage.stage,
+                func.count(TransformRunStage.id),
+                func.avg(TransformRunStage.wall_time),
+                func.max(TransformRunStage.wall_time),
+                func.avg(TransformRunStage.cpu_time),
+                func.avg(TransformRunStage.bytes),
+                func.max(TransformRunStage.max_rss),
+                first_run)
+            .join(TransformRunStage.run)
+            .filter(TransformRun.transform == transform)
+            .group_by(TransformRun.git_commit, TransformRunStage.stage)
+            .all())
+    commit_started = {}
+    for row in rows:
+        commit_started[row[0]] = min(commit_started.get(row[0], row[-1]),
+                                     row[-1])
+    rows.sort(key=lambda row: (commit_started[row[0]], row[1]))
+    return [StageSummary(*row[:-1]) for row in rows]
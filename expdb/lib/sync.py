@@ -0,0 +1,296 @@
+from typing import (Dict, Iterator, List, Mapping, Optional, Sequence, Union)
+
+import numpy as np
+import pandas as pd
+
+from datetime import datetime
+import dataclasses
+
+from ..models import Timecourse
+from ..storage import StorageManager, WindowReader
+from ..storage import format as fmt
+
+
+WindowData = Union[np.ndarray, pd.DataFrame]
+
+
+@dataclasses.dataclass
+class SyncWindow:
+    """
+    One window of every timecourse read by a SyncReader.
+
+    Parameters
+    ----------
+    index : int
+        The window's position in the reader.
+    start : datetime
+        When the window starts.
+    offset : float
+        Seconds from the reader's first window to this one.
+    data : dict
+        Each timecourse's samples in the window by name: an array with time
+        as the last axis (see WindowReader), or the rows of a DataFrame.
+    """
+    index: int
+    start: datetime
+    offset: float
+    data: Dict[str, WindowData]
+
+    def __getitem__(self, name: str) -> WindowData:
+        return self.data[name]
+
+
+@dataclasses.dataclass
+class _Stream:
+    name: str
+    sampling_rate: float
+    # Start of the recording, in seconds since the epoch.
+    t0: float
+    n_times: Optional[int]
+    reader: Optional[WindowReader] = None
+    frame: Optional[pd.DataFrame] = None
+    event_column: Optional[str] = None
+    event_times: Optional[np.ndarray] = None
+    event_order: Optional[np.ndarray] = None
+
+
+class SyncReader:
+    """
+    Reads aligned windows of several timecourses on a common clock.
+
+    Each timecourse starts at its ``date_collected`` and is sampled at its
+    ``Data.sampling_rate``, so sample ``i`` of a timecourse falls at
+    ``date_collected + i / sampling_rate``. The reader yields windows of
+    ``window`` seconds, every ``step`` seconds, over the span that every
+    (sampled) timecourse covers, and gives each window the samples of each
+    timecourse that fall in it.
+
+    Payloads are read through their storage manager's window readers
+    (StorageManager.open_reader), so for formats that support partial reads
+    (fif EEG, blocked fMRI archives, video and audio) only the samples of
+    each window are decoded. DataFrames (e.g. INPUT_RESPONSE) are loaded
+    whole. A DataFrame is either sampled, one row per sample, or, if it has
+    an entry in ``event_columns``, a table of events whose times (in seconds
+    from ``date_collected``) are given by that column. A window of an event
+    table contains the events that fall in it, with their times made
+    relative to the window's start.
+
+    By default each timecourse keeps its own sampling rate, so windows of
+    different timecourses have different numbers of samples (but the same
+    number for every window). With ``sampling_rate``, every window of every
+    sampled timecourse is resampled to that rate, by the nearest sample or
+    by linear interpolation between the two nearest samples. Which samples
+    each window needs is worked out for all windows at once, and each
+    window is read as one contiguous range.
+
+    Examples
+    --------
+    >>> with SyncReader({"eeg": eeg_tc, "audio": audio_tc, "video": video_tc},
+    ...                 storage_manager, window=2.0, step=1.0) as reader:
+    ...     for window in reader:
+    ...         model.step(window["eeg"], window["audio"], window["video"])
+
+    Parameters
+    ----------
+    timecourses : sequence or mapping of Timecourse
+        The timecourses to align, by name. A sequence names each timecourse
+        by its data type, e.g. "eeg", which must then be unique.
+    storage_manager : StorageManager
+        Used to read the payloads.
+    window : float
+        Length of each window, in seconds.
+    step : float, optional
+        Seconds between the starts of consecutive windows. Defaults to
+        ``window``.
+    start, stop : datetime, optional
+        Limit the windows to this span.
+    sampling_rate : float, optional
+        Resample every sampled timecourse to this rate (Hz).
+    method : str
+        "nearest" or "linear", how to resample. DataFrames always use the
+        nearest row.
+    event_columns : mapping of str to str
+        For event tables, the name of the column holding each event's time.
+    """
+
+    def __init__(self,
+                 timecourses: Union[Sequence[Timecourse],
+                                    Mapping[str, Timecourse]],
+                 storage_manager: StorageManager,
+                 window: float,
+                 step: Optional[float] = None,
+                 start: Optional[datetime] = None,
+                 stop: Optional[datetime] = None,
+                 sampling_rate: Optional[float] = None,
+                 method: str = "nearest",
+                 event_columns: Optional[Mapping[str, str]] = None):
+        if window <= 0 or (step is not None and step <= 0):
+            raise ValueError(f"Invalid window {window} or step {step}.")
+        if method not in ("nearest", "linear"):
+            raise ValueError(f"Unknown method {method}, expected 'nearest' "
+                             "or 'linear'.")
+        if not isinstance(timecourses, Mapping):
+            names = [tc.data.type.value.lower() for tc in timecourses]
+            if len(set(names)) != len(names):
+                raise ValueError(f"Timecourses of the same data type ({names})"
+                                 " must be given names with a mapping.")
+            timecourses = dict(zip(names, timecourses))
+        if not timecourses:
+            raise ValueError("A SyncReader needs at least one timecourse.")
+        event_columns = dict(event_columns or {})
+        unknown = set(event_columns) - set(timecourses)
+        if unknown:
+            raise ValueError(f"No timecourses named {sorted(unknown)}.")
+
+        self.window = window
+        self.step = window if step is None else step
+        self.sampling_rate = sampling_rate
+        self.method = method
+        self._streams: List[_Stream] = []
+        try:
+            for name, tc in timecourses.items():
+                self._streams.append(self._open(
+                    name, tc, storage_manager, event_columns.get(name)))
+        except BaseException:
+            self.close()
+            raise
+
+        sampled = [s for s in self._streams if s.event_column is None]
+        spans = sampled or self._streams
+        begin = max(s.t0 for s in spans)
+        end = min((s.t0 + s.n_times / s.sampling_rate for s in sampled),
+                  default=None)
+        if start is not None:
+            begin = max(begin, start.timestamp())
+        if stop is not None:
+            end = stop.timestamp() if end is None else min(
+                end, stop.timestamp())
+        if end is None:
+            self.close()
+            raise ValueError("Event tables alone have no end; give stop.")
+        self._begin = begin
+        # Allow for rounding in the span, so that e.g. a 10 s recording has
+        # ten 1 s windows.
+        n_windows = int(np.floor((end - begin - window) / self.step + 1e-9))
+        self._starts = begin + self.step * np.arange(max(n_windows + 1, 0))
+
+        self._positions: Dict[str, np.ndarray] = {}
+        self._lengths: Dict[str, int] = {}
+        for stream in sampled:
+            self._map(stream)
+
+    @staticmethod
+    def _open(name: str, tc: Timecourse, storage_manager: StorageManager,
+              event_column: Optional[str]) -> _Stream:
+        stream = _Stream(name=name, sampling_rate=tc.data.sampling_rate,
+                         t0=tc.date_collected.timestamp(), n_times=None,
+                         event_column=event_column)
+        _, payload_type = fmt.get_serializer_for_extension(
+            tc.data.type, tc.path.split('.')[-1])
+        if payload_type is not pd.DataFrame:
+            if event_column is not None:
+                raise ValueError(f"{name} is not a DataFrame, so it cannot "
+                                 f"be an event table.")
+            stream.reader = storage_manager.open_reader(tc)
+            stream.n_times = stream.reader.n_times
+            return stream
+
+        stream.frame = storage_manager.retrieve(tc)
+        if event_column is None:
+            stream.n_times = len(stream.frame)
+        else:
+            times = stream.frame[event_column].to_numpy(dtype=float)
+            stream.event_order = np.argsort(times, kind="stable")
+            stream.event_times = times[stream.event_order]
+        return stream
+
+    def _map(self, stream: _Stream):
+        """Work out the (fractional) sample positions of every window."""
+        rate = stream.sampling_rate
+        target = self.sampling_rate if self.sampling_rate else rate
+        n = int(round(self.window * target))
+        offsets = np.arange(n) * (rate / target)
+        first = (self._starts - stream.t0) * rate
+        if self.sampling_rate is None:
+            # Whole samples, so windows aren't shifted by fractions of one.
+            first = np.round(first)
+        positions = first[:, np.newaxis] + offsets[np.newaxis, :]
+        self._positions[stream.name] = np.clip(positions, 0,
+                                               stream.n_times - 1)
+        self._lengths[stream.name] = n
+
+    def __len__(self) -> int:
+        return len(self._starts)
+
+    def __iter__(self) -> Iterator[SyncWindow]:
+        for i in range(len(self)):
+            yield self.read_window(i)
+
+    @property
+    def names(self) -> List[str]:
+        """The names of the timecourses, in order."""
+        return [s.name for s in self._streams]
+
+    def samples_per_window(self, name: str) -> Optional[int]:
+        """Samples of a timecourse in each window (None for event tables)."""
+        return self._lengths.get(name)
+
+    def read_window(self, index: int) -> SyncWindow:
+        """Read the window at ``index`` of every timecourse."""
+        if not 0 <= index < len(self):
+            raise IndexError(f"Window {index} out of range for "
+                             f"{len(self)} windows.")
+        start = float(self._starts[index])
+        data = {}
+        for stream in self._streams:
+            if stream.event_column is not None:
+                data[stream.name] = self._read_events(stream, start)
+            else:
+                data[stream.name] = self._read_samples(
+                    stream, self._positions[stream.name][index])
+        return SyncWindow(index=index,
+                          start=datetime.fromtimestamp(start),
+                          offset=start - self._begin,
+                          data=data)
+
+    def _read_samples(self, stream: _Stream,
+                      positions: np.ndarray) -> WindowData:
+        if stream.frame is not None or self.method == "nearest":
+            index = np.round(positions).astype(np.int64)
+            if stream.frame is not None:
+                return stream.frame.iloc[index]
+            lo, hi = int(index[0]), int(index[-1]) + 1
+            block = stream.reader.read(lo, hi)
+            if hi - lo == len(index):
+                return block
+            return block[..., index - lo]
+
+        below = np.floor(positions).astype(np.int64)
+        above = np.minimum(below + 1, stream.n_times - 1)
+        weight = positions - below
+        lo, hi = int(below[0]), int(above[-1]) + 1
+        block = stream.reader.read(lo, hi).astype(float, copy=False)
+        return (block[..., below - lo] * (1 - weight)
+                + block[..., above - lo] * weight)
+
+    def _read_events(self, stream: _Stream, start: float) -> pd.DataFrame:
+        relative = start - stream.t0
+        lo, hi = np.searchsorted(stream.event_times,
+                                 [relative, relative + self.window],
+                                 side="left")
+        events = stream.frame.iloc[stream.event_order[lo:hi]].copy()
+        events[stream.event_column] = stream.event_times[lo:hi] - relative
+        return events
+
+    def close(self):
+        """Close the payload readers."""
+        for stream in self._streams:
+            if stream.reader is not None:
+                stream.reader.close()
+                stream.reader = None
+
+    def __enter__(self) -> 'SyncReader':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
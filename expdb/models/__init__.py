@@ -15,3 +15,6 @@ Base = declarative_base()
 from .subject import Subject
 from .study import Study
 from .timecourse import Data, DataType, Modality, Timecourse, TransformData
+from .job import JobStatus, TransformJob
+from .run import TransformRun, TransformRunStage
+from .sweep import SweepMetric
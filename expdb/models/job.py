@@ -0,0 +1,69 @@
+from typing import Optional
+
+from sqlalchemy import DateTime, Enum, ForeignKey, Index, Integer, String, Text
+from sqlalchemy.orm import Mapped, mapped_column, relationship
+from sqlalchemy.sql import func
+
+import enum
+
+from . import Base, Timecourse
+
+
+class JobStatus(enum.Enum):
+    # Waiting for a worker (again, if a previous attempt failed or its
+    # worker died).
+    QUEUED = "QUEUED"
+    # Claimed by the worker in worker_id, which heartbeats while it runs.
+    RUNNING = "RUNNING"
+    DONE = "DONE"
+    # Failed on every allowed attempt.
+    FAILED = "FAILED"
+
+
+class TransformJob(Base):
+    """A transform queued to be run by a worker (see transforms.jobs).
+
+    Parameters
+    ----------
+    transform : str
+        The Transform subclass, as "module:ClassName".
+    params_json : str
+        JSON of the keyword parameters passed to the transform.
+    input_ids_json : str
+        JSON list of the ids of the input timecourses.
+    """
+    __tablename__ = 'transform_jobs'
+    __table_args__ = (
+        # Workers claim the oldest queued job.
+        Index('ix_transform_jobs_status_id', 'status', 'id'),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    transform: Mapped[str] = mapped_column(String(255), nullable=False)
+    params_json: Mapped[str] = mapped_column(Text, nullable=False,
+                                             default="{}")
+    input_ids_json: Mapped[str] = mapped_column(Text, nullable=False)
+
+    status: Mapped[JobStatus] = mapped_column(Enum(JobStatus), nullable=False,
+                                              default=JobStatus.QUEUED)
+    attempts: Mapped[int] = mapped_column(Integer, nullable=False, default=0)
+    max_attempts: Mapped[int] = mapped_column(Integer, nullable=False,
+                                              default=3)
+    worker_id: Mapped[Optional[str]] = mapped_column(String(255),
+                                                     nullable=True)
+    error: Mapped[Optional[str]] = mapped_column(Text, nullable=True)
+
+    # Times are naive UTC.
+    created_at = mapped_column(DateTime, server_default=func.now())
+    claimed_at = mapped_column(DateTime, nullable=True)
+    heartbeat_at = mapped_column(DateTime, nullable=True)
+    finished_at = mapped_column(DateTime, nullable=True)
+
+    output_timecourse_id: Mapped[Optional[int]] = mapped_column(
+        ForeignKey('timecourses.id'), nullable=True)
+    output_timecourse: Mapped[Optional["Timecourse"]] = relationship(
+        "Timecourse")
+
+    def __repr__(self) -> str:
+        return (f"TransformJob({self.id}, {self.transform}, "
+                f"{self.status.value})")
@@ -0,0 +1,96 @@
+from typing import List, Optional
+
+from sqlalchemy import (BigInteger, DateTime, Float, ForeignKey, Index, Integer,
+                        String)
+from sqlalchemy.orm import Mapped, mapped_column, relationship
+from sqlalchemy.sql import func
+
+from . import Base, Timecourse
+
+
+class TransformRun(Base):
+    """The cost of the transform run that produced a timecourse.
+
+    Parameters
+    ----------
+    transform : str
+        The name of the Transform subclass.
+    git_commit : str
+        The git commit the transform ran at, as recorded in the timecourse.
+    wall_time : float
+        Elapsed seconds, summed over the top-level stages.
+    cpu_time : float
+        CPU seconds, summed over the top-level stages.
+    max_rss : int
+        The peak resident set size of the process at the end of the run, in
+        bytes.
+    """
+    __tablename__ = 'transform_runs'
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    timecourse_id: Mapped[int] = mapped_column(ForeignKey('timecourses.id'),
+                                               nullable=False, index=True)
+    timecourse: Mapped["Timecourse"] = relationship("Timecourse")
+
+    transform: Mapped[str] = mapped_column(String(255), nullable=False,
+                                           index=True)
+    git_commit: Mapped[Optional[str]] = mapped_column(String, nullable=True,
+                                                      index=True)
+    hostname: Mapped[Optional[str]] = mapped_column(String(255),
+                                                    nullable=True)
+    started_at = mapped_column(DateTime, server_default=func.now())
+
+    wall_time: Mapped[float] = mapped_column(Float, nullable=False)
+    cpu_time: Mapped[float] = mapped_column(Float, nullable=False)
+    max_rss: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)
+
+    stages: Mapped[List["TransformRunStage"]] = relationship(
+        "TransformRunStage", back_populates="run",
+        order_by="TransformRunStage.position",
+        cascade="all, delete-orphan")
+
+    def __repr__(self) -> str:
+        return (f"TransformRun({self.transform}, {self.timecourse_id}, "
+                f"{self.wall_time:.3f}s)")
+
+
+class TransformRunStage(Base):
+    """One stage of a TransformRun.
+
+    Parameters
+    ----------
+    stage : str
+        The stage, prefixed by its enclosing stages. Transforms record
+        "lookup", "load", "transform", "construct", "store" and "db_commit";
+        storage managers record e.g. "load/download", "load/decode",
+        "store/serialize" and "store/upload" within them.
+    position : int
+        The order the stage started in within the run.
+    bytes : int
+        Size of the payload files the stage (and the stages within it) read
+        or wrote, or None if it read or wrote none.
+    max_rss : int
+        The peak resident set size of the process when the stage ended.
+    """
+    __tablename__ = 'transform_run_stages'
+    __table_args__ = (
+        # Finding the slowest runs of a stage.
+        Index('ix_transform_run_stages_stage_wall_time', 'stage',
+              'wall_time'),
+    )
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    run_id: Mapped[int] = mapped_column(ForeignKey('transform_runs.id'),
+                                        nullable=False, index=True)
+    run: Mapped["TransformRun"] = relationship("TransformRun",
+                                               back_populates="stages")
+    position: Mapped[int] = mapped_column(Integer, nullable=False)
+    stage: Mapped[str] = mapped_column(String(255), nullable=False)
+
+    wall_time: Mapped[float] = mapped_column(Float, nullable=False)
+    cpu_time: Mapped[float] = mapped_column(Float, nullable=False)
+    bytes: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)
+    max_rss: Mapped[Optional[int]] = mapped_column(BigInteger, nullable=True)
+
+    def __repr__(self) -> str:
+        return f"TransformRunStage({self.stage}, {self.wall_time:.3f}s)"
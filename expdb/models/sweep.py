@@ -0,0 +1,56 @@
+from typing import Optional
+
+from sqlalchemy import DateTime, ForeignKey, String, Text
+from sqlalchemy.orm import Mapped, mapped_column, relationship
+from sqlalchemy.sql import func
+
+from . import Base, Timecourse
+
+
+class SweepMetric(Base):
+    """A metric of one run of a parameter sweep.
+
+    Sweeps that don't store their outputs record only this, so a metric
+    identifies the run by the derivation key its output would have had.
+
+    Parameters
+    ----------
+    input_id : int
+        The input timecourse.
+    output_id : int
+        The output timecourse, if the sweep stored it.
+    transform : str
+        The name of the Transform subclass.
+    params_json : str
+        The parameters of the run.
+    derivation_key : str, optional
+        As Timecourse.derivation_key: the hash of the input, transform,
+        parameters and git commit. None if the code wasn't committed, in
+        which case the metric is never reused.
+    value_json : str
+        The metric, as JSON.
+    """
+    __tablename__ = 'sweep_metrics'
+
+    id: Mapped[int] = mapped_column(primary_key=True)
+    input_id: Mapped[int] = mapped_column(ForeignKey('timecourses.id'),
+                                          nullable=False, index=True)
+    input: Mapped["Timecourse"] = relationship("Timecourse",
+                                               foreign_keys=[input_id])
+    output_id: Mapped[Optional[int]] = mapped_column(
+        ForeignKey('timecourses.id'), nullable=True)
+    output: Mapped[Optional["Timecourse"]] = relationship(
+        "Timecourse", foreign_keys=[output_id])
+
+    transform: Mapped[str] = mapped_column(String(255), nullable=False)
+    params_json: Mapped[str] = mapped_column(Text, nullable=False)
+    git_commit: Mapped[Optional[str]] = mapped_column(String, nullable=True)
+    derivation_key: Mapped[Optional[str]] = mapped_column(String(64),
+                                                          nullable=True,
+                                                          index=True)
+    value_json: Mapped[str] = mapped_column(Text, nullable=False)
+    created_at = mapped_column(DateTime, server_default=func.now())
+
+    def __repr__(self) -> str:
+        return (f"SweepMetric({self.transform}, {self.input_id}, "
+                f"{self.params_json})")
@@ -1,8 +1,12 @@
-from typing import List, Optional, Type
-
-from sqlalchemy import Column, Enum, Float, String, ForeignKey, DateTime, Table
-from sqlalchemy.orm import composite, relationship, Mapped, mapped_column, validates
-from sqlalchemy.sql import func
+from typing import List, Optional, Set, Type
+
+from sqlalchemy import (Column, Connection, Enum, Float, Index, Integer,
+                        String, ForeignKey, DateTime, Table, delete, event,
+                        func, insert, inspect, literal, select, union_all,
+                        update)
+from sqlalchemy.orm import (Session, composite, object_session, relationship,
+                            Mapped, mapped_column, validates)
+from sqlalchemy.sql.expression import CTE
 from sqlalchemy.ext.hybrid import hybrid_property
 
 import dataclasses
@@ -135,12 +139,38 @@ timecourse_lineage_association = Table(
     Column('derived_timecourse_id', ForeignKey('timecourses.id'),
            primary_key=True),
     Column('parent_timecourse_id', ForeignKey('timecourses.id'),
-            primary_key=True)
+            primary_key=True),
+    # The primary key finds parents; this finds children, e.g. to follow
+    # lineage forward.
+    Index('ix_timecourse_lineage_parent', 'parent_timecourse_id',
+          'derived_timecourse_id')
+)
+
+# The transitive closure of the lineage DAG: a row per timecourse and each
+# of its ancestors, at the length of the shortest path between them. It is
+# maintained by _update_lineage_closure whenever lineage edges change, so
+# that all the ancestors or descendants of a timecourse, at any depth, are
+# found with one indexed query.
+timecourse_lineage_closure = Table(
+    'timecourse_lineage_closure',
+    Base.metadata,
+    Column('ancestor_id', ForeignKey('timecourses.id'), primary_key=True),
+    Column('descendant_id', ForeignKey('timecourses.id'), primary_key=True,
+           index=True),
+    Column('depth', Integer, nullable=False)
 )
 
 
 class Timecourse(Base):
     __tablename__ = 'timecourses'
+    __table_args__ = (
+        # A subject's (or a study's) timecourses of a modality and data
+        # type, newest first, e.g. in lib.queries and the graph scheduler.
+        Index('ix_timecourses_subject_modality_type_date', 'subject_id',
+              'modality', 'type', 'date_collected'),
+        Index('ix_timecourses_study_modality_type_date', 'study_id',
+              'modality', 'type', 'date_collected'),
+    )
     
     id: Mapped[int] = mapped_column(primary_key=True)
     data: Mapped[Data] = composite(Data,
@@ -157,12 +187,24 @@ class Timecourse(Base):
                                       unique=True)
     description: Mapped[str] = mapped_column(String, nullable=True)
 
+    @property
+    def is_view(self) -> bool:
+        """Whether the payload is stored as a view of a parent's payload."""
+        return self.path is not None and self.path.endswith(".view")
+
     transform: Mapped[TransformData] = composite(
         TransformData,
         mapped_column("transform_names_json", String, nullable=False),
         mapped_column("transform_params_json", String, nullable=False),
         mapped_column("git_commit", String, nullable=False))
 
+    # Hash of the inputs, transform names, canonical params and git commit
+    # that produced the timecourse, used to reuse identical derivations.
+    # Null for uploads and timecourses created before it was recorded.
+    derivation_key: Mapped[Optional[str]] = mapped_column(String(64),
+                                                          nullable=True,
+                                                          index=True)
+
     # Timestamp when the timecourse was created
     date_collected: Mapped[DateTime] = mapped_column(DateTime,
                                                      server_default=func.now())
@@ -209,19 +251,172 @@ class Timecourse(Base):
         lazy='dynamic'
     )
 
-    def propagate_is_pilot(self, value: bool):
-        """
-        Recursively propagate the is_pilot flag to both parent (derived_from) 
-        and child (derived_timecourses) timecourses.
+    # Every ancestor and descendant, at any depth (see
+    # timecourse_lineage_closure). Read-only: lineage is changed through
+    # derived_from.
+    ancestors: Mapped[List["Timecourse"]] = relationship(
+        "Timecourse",
+        secondary=timecourse_lineage_closure,
+        primaryjoin=id == timecourse_lineage_closure.c.descendant_id,
+        secondaryjoin=id == timecourse_lineage_closure.c.ancestor_id,
+        viewonly=True,
+        lazy='dynamic'
+    )
+
+    descendants: Mapped[List["Timecourse"]] = relationship(
+        "Timecourse",
+        secondary=timecourse_lineage_closure,
+        primaryjoin=id == timecourse_lineage_closure.c.ancestor_id,
+        secondaryjoin=id == timecourse_lineage_closure.c.descendant_id,
+        viewonly=True,
+        lazy='dynamic'
+    )
+
+    def root_uploads(self) -> List["Timecourse"]:
         """
-        # Propagate to all derived (child) timecourses
-        for child_timecourse in self.derived_timecourses:
-            if child_timecourse.is_pilot != value:
-                child_timecourse.is_pilot = value
+        The uploads (timecourses without parents) this timecourse derives
+        from, found with one query whatever the depth.
 
-        # Propagate to all parent timecourses
-        for parent_timecourse in self.derived_from:
-            if parent_timecourse.is_pilot != value:
-                parent_timecourse.is_pilot = value
+        Returns
+        -------
+        List[Timecourse]
+            The uploads, by id. Empty if this timecourse is itself an upload.
+        """
+        return (self.ancestors
+                .filter(~Timecourse.derived_from.any())
+                .order_by(Timecourse.id)
+                .all())
 
+    def propagate_is_pilot(self, value: bool):
+        """
+        Propagate the is_pilot flag to every timecourse connected to this one
+        by lineage, through parents (derived_from) and children
+        (derived_timecourses) alike.
+
+        Saved timecourses are updated with one bulk UPDATE of the connected
+        component, found with a recursive query, and the timecourses loaded
+        in the session are refreshed. Timecourses that aren't saved yet only
+        have the lineage added to them in memory, which is walked instead.
+        """
+        session = object_session(self)
+        if session is None or self.id is None:
+            for related in (list(self.derived_timecourses)
+                            + list(self.derived_from)):
+                if related.is_pilot != value:
+                    related.is_pilot = value
+            return
+        component = _lineage_component(self.id)
+        # Pending lineage is flushed by the query, so it's included.
+        session.execute(
+            update(Timecourse)
+            .where(Timecourse.id.in_(select(component.c.id)))
+            .values(_is_pilot=value),
+            execution_options={"synchronize_session": "fetch"})
+
+
+def _lineage_component(timecourse_id: int) -> CTE:
+    """The ids of the timecourses connected to one by lineage, as a CTE."""
+    lineage = timecourse_lineage_association
+    # Lineage edges, followed both ways.
+    edges = union_all(
+        select(lineage.c.parent_timecourse_id.label('source'),
+               lineage.c.derived_timecourse_id.label('target')),
+        select(lineage.c.derived_timecourse_id,
+               lineage.c.parent_timecourse_id)).subquery('edges')
+    component = select(literal(timecourse_id).label('id')).cte(
+        'component', recursive=True)
+    # UNION rather than UNION ALL, so that cycles through the edges end.
+    return component.union(
+        select(edges.c.target).join(component,
+                                    edges.c.source == component.c.id))
+
+
+def rebuild_lineage_closure(connection: Connection,
+                            timecourse_ids: Optional[Set[int]] = None):
+    """
+    Recompute the closure rows of timecourses from the lineage edges.
 
+    Parameters
+    ----------
+    connection : Connection
+        The connection (of the session) to update the table on.
+    timecourse_ids : Set[int], optional
+        The timecourses whose ancestors are recomputed. Their descendants'
+        ancestors change with theirs, so callers include them. Defaults to
+        every timecourse.
+    """
+    lineage = timecourse_lineage_association
+    closure = timecourse_lineage_closure
+    if timecourse_ids is not None and not timecourse_ids:
+        return
+    start = select(lineage.c.parent_timecourse_id.label('ancestor_id'),
+                   lineage.c.derived_timecourse_id.label('descendant_id'),
+                   literal(1).label('depth'))
+    clear = delete(closure)
+    if timecourse_ids is not None:
+        ids = sorted(timecourse_ids)
+        start = start.where(lineage.c.derived_timecourse_id.in_(ids))
+        clear = clear.where(closure.c.descendant_id.in_(ids))
+    # Walk up from each timecourse, one lineage edge per step.
+    paths = start.cte('paths', recursive=True)
+    paths = paths.union_all(
+        select(lineage.c.parent_timecourse_id, paths.c.descendant_id,
+               paths.c.depth + 1)
+        .where(lineage.c.derived_timecourse_id == paths.c.ancestor_id))
+    shortest = (select(paths.c.ancestor_id, paths.c.descendant_id,
+                       func.min(paths.c.depth))
+                .group_by(paths.c.ancestor_id, paths.c.descendant_id))
+    connection.execute(clear)
+    connection.execute(insert(closure).from_select(
+        ['ancestor_id', 'descendant_id', 'depth'], shortest))
+
+
+def _descendant_ids(connection: Connection, ids: Set[int]) -> Set[int]:
+    closure = timecourse_lineage_closure
+    rows = connection.execute(
+        select(closure.c.descendant_id)
+        .where(closure.c.ancestor_id.in_(sorted(ids)))).scalars()
+    return set(rows)
+
+
+@event.listens_for(Session, 'before_flush')
+def _forget_deleted_lineage(session: Session, flush_context, instances):
+    """Drop the closure rows of deleted timecourses before they go."""
+    deleted = {tc.id for tc in session.deleted
+               if isinstance(tc, Timecourse) and tc.id is not None}
+    if not deleted:
+        return
+    connection = session.connection()
+    stale = session.info.setdefault('lineage_stale', set())
+    stale |= _descendant_ids(connection, deleted) - deleted
+    closure = timecourse_lineage_closure
+    connection.execute(delete(closure).where(
+        closure.c.ancestor_id.in_(sorted(deleted))
+        | closure.c.descendant_id.in_(sorted(deleted))))
+
+
+@event.listens_for(Session, 'after_flush')
+def _update_lineage_closure(session: Session, flush_context):
+    """Keep timecourse_lineage_closure in step with the edges just flushed.
+
+    Only timecourses whose parents changed, and their descendants, are
+    recomputed, which for new derivations is the new timecourse alone.
+    """
+    changed = set()
+    for tc in list(session.new) + list(session.dirty):
+        if not isinstance(tc, Timecourse):
+            continue
+        state = inspect(tc)
+        parents = state.attrs.derived_from.history
+        if parents.added or parents.deleted:
+            changed.add(tc.id)
+        children = state.attrs.derived_timecourses.history
+        changed.update(child.id for child in children.added + children.deleted
+                       if child.id is not None)
+    stale = session.info.pop('lineage_stale', set())
+    if not changed and not stale:
+        return
+    connection = session.connection()
+    if changed:
+        changed |= _descendant_ids(connection, changed)
+    rebuild_lineage_closure(connection, changed | stale)
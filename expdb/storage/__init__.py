@@ -1 +1,4 @@
-from .storage_manager import StorageManager, GCSStorageManager, LocalStorageManager
\ No newline at end of file
+from .storage_manager import StorageManager, GCSStorageManager, LocalStorageManager
+from .readers import WindowReader
+from .shared import SharedPayload, SharedPayloadStore
+from .views import View
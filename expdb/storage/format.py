@@ -1,17 +1,30 @@
 import numpy as np
-from typing import Dict, Generic, List, Union, TypeVar, Type, Tuple
+from typing import (Any, Collection, Dict, Generic, List, Mapping, Optional,
+                    Union, TypeVar, Type, Tuple, get_args, get_origin)
 from abc import ABC, abstractmethod
+import json
+import os
+import zipfile
+import zlib
 import soundfile as sf
 import mne
 import pandas as pd
 import cv2
 
 from ..models import DataType, Timecourse
+from .readers import (AudioWindowReader, BlockedWindowReader,
+                      RawWindowReader, VideoWindowReader, WindowReader,
+                      reader_for_payload)
+from .storage_utils import (BlockedArchiveReader, BlockedArchiveWriter,
+                            DEFAULT_BLOCK_BYTES, LazyArrayDict, MaskedVolume,
+                            QUANTIZATION_MEMBER, dequantize, quantize,
+                            write_npz_member)
+from .views import View
 
 
 # pytype: disable=*
-TimecoursePayload = Union[mne.io.Raw, Dict[str, np.ndarray],
-                          pd.DataFrame, np.ndarray]
+TimecoursePayload = Union[mne.io.BaseRaw, Dict[str, np.ndarray],
+                          pd.DataFrame, np.ndarray, View]
 
 TYPE_TO_EXTENSION = {}
 TYPE_TO_SERIALIZER: Dict[Tuple[DataType, type],
@@ -45,6 +58,12 @@ class PayloadSerializer(ABC, Generic[T]):
     3. Implement _write_to_file() and _read_from_file() methods
     4. Use @register method to register supported DataTypes
 
+    Serializers that take options (e.g. compression settings) accept them as
+    keyword arguments to __init__. StorageManager.store() and retrieve() pass
+    their keyword arguments through to the serializer. _write_to_file() may
+    return a dict reporting on the write (e.g. quantization error), which
+    to_file() and StorageManager.store() return.
+
     By implementing this interface, the framework will automatically handle data
     retrieval and storage for Timecourse objects of the given type.
     """
@@ -52,15 +71,16 @@ class PayloadSerializer(ABC, Generic[T]):
     extension: str
 
     @abstractmethod
-    def _write_to_file(self, payload: T, fname: str):
+    def _write_to_file(self, payload: T,
+                       fname: str) -> Optional[Dict[str, Any]]:
         raise NotImplementedError
 
-    def to_file(self, fname: str, payload: T):
+    def to_file(self, fname: str, payload: T) -> Optional[Dict[str, Any]]:
         ext = fname.split('.')[-1]
         if not fname.endswith(self.extension):
             raise ValueError(f"File name must have extension {self.extension} "
                              f"but was given {ext}.")
-        self._write_to_file(payload, fname)
+        return self._write_to_file(payload, fname)
 
     @abstractmethod
     def _read_from_file(self, fname: str) -> T:
@@ -73,6 +93,34 @@ class PayloadSerializer(ABC, Generic[T]):
                              f"but was given {ext}.")
         return self._read_from_file(fname)
 
+    def detach(self, payload: T) -> T:
+        """Make a payload read by from_file() independent of its file.
+
+        Called before a temporary file that a payload was read from is
+        deleted. Serializers that read lazily should load whatever they still
+        need from the file here.
+        """
+        return payload
+
+    def open_reader(self, fname: str) -> WindowReader:
+        """Open a file for reading one window of time at a time.
+
+        By default the whole payload is read and windows are sliced from it.
+        Serializers of formats that support partial reads override this to
+        keep memory bounded by the window size.
+        """
+        return reader_for_payload(self.from_file(fname))
+
+    def estimate_nbytes(self, fname: str) -> int:
+        """Estimate the memory a payload read from a file takes, in bytes.
+
+        By default this is the size of the file, which underestimates
+        compressed formats. Serializers of formats whose headers record the
+        payload's shape override this to compute it without reading the
+        payload.
+        """
+        return os.path.getsize(fname)
+
     @classmethod
     def register(cls, data_types: List[DataType]):
         from typing import get_type_hints
@@ -80,8 +128,12 @@ class PayloadSerializer(ABC, Generic[T]):
         # Get the concrete type from the write method's type hints
         hints = get_type_hints(cls._write_to_file)
         concrete_type = hints['payload']
-        if hasattr(concrete_type, "__origin__"):
-            concrete_type = concrete_type.__args__[0]
+        origin = get_origin(concrete_type)
+        if origin is Union:
+            concrete_type = get_args(concrete_type)[0]
+        elif origin is not None:
+            # e.g. Dict[str, np.ndarray] is registered as dict.
+            concrete_type = origin
 
         for data_type in data_types:
             TYPE_TO_EXTENSION[(data_type, concrete_type)] = cls.extension
@@ -89,6 +141,65 @@ class PayloadSerializer(ABC, Generic[T]):
             TYPE_TO_SERIALIZER[(data_type, concrete_type)] = cls
 
 
+def get_payload_type(payload: TimecoursePayload) -> type:
+    """Return the registered payload type that a payload is stored as.
+
+    Subclasses of registered types (e.g. np.memmap), read-only mappings
+    (e.g. a LazyArrayDict returned by retrieve()) and masked fMRI volumes
+    resolve to the registered type, so a retrieved payload can be stored
+    again.
+    """
+    if isinstance(payload, Mapping):
+        return dict
+    if isinstance(payload, MaskedVolume):
+        return np.ndarray
+    for _, concrete_type in TYPE_TO_SERIALIZER:
+        if isinstance(payload, concrete_type):
+            return concrete_type
+    return type(payload)
+
+
+def get_serializer_for_extension(
+        data_type: DataType,
+        ext: str) -> Tuple[Type['PayloadSerializer[TimecoursePayload]'], type]:
+    """Find the serializer that wrote a file of the given data type.
+
+    Returns:
+        The serializer class and the payload type it produces.
+
+    Raises:
+        ValueError: If no serializer is registered for the pair.
+    """
+    for (dt, concrete_type), ser in TYPE_TO_SERIALIZER.items():
+        if dt == data_type and ser.extension == ext:
+            return ser, concrete_type
+    raise ValueError(f"No serializer registered for {data_type} "
+                     f"with extension {ext}.")
+
+
+def _npz_nbytes(fname: str, names: Optional[Collection[str]] = None) -> int:
+    """Size of the arrays of an npz archive, read from their headers."""
+    total = 0
+    with zipfile.ZipFile(fname) as zf:
+        for member in zf.namelist():
+            if not member.endswith(".npy"):
+                continue
+            if names is not None and member[:-len(".npy")] not in names:
+                continue
+            with zf.open(member) as f:
+                version = np.lib.format.read_magic(f)
+                if version == (1, 0):
+                    shape, _, dtype = np.lib.format.read_array_header_1_0(f)
+                else:
+                    shape, _, dtype = np.lib.format.read_array_header_2_0(f)
+            total += int(np.prod(shape)) * dtype.itemsize
+    return total
+
+
+def _report_quantization(name: str, mode: str, max_abs_error: float):
+    print(f"Quantized {name} to {mode}, max absolute error {max_abs_error:.6g}")
+
+
 class NumpyPayloadSerializer(PayloadSerializer[np.ndarray]):
     extension = "npz"
 
@@ -96,7 +207,11 @@ class NumpyPayloadSerializer(PayloadSerializer[np.ndarray]):
         np.savez(fname, payload)
 
     def _read_from_file(self, fname: str) -> np.ndarray:
-        return np.load(fname)
+        with np.load(fname) as data:
+            return data['arr_0']
+
+    def estimate_nbytes(self, fname: str) -> int:
+        return _npz_nbytes(fname, ["arr_0"])
 
 
 NumpyPayloadSerializer.register([DataType.FMRI])
@@ -115,15 +230,106 @@ class DataFramePayloadSerializer(PayloadSerializer[pd.DataFrame]):
 DataFramePayloadSerializer.register([DataType.INPUT_RESPONSE])
 
 
-class EEGPayloadSerializer(PayloadSerializer[mne.io.Raw]):
+class DictPayloadSerializer(PayloadSerializer[Dict[str, np.ndarray]]):
+    """Serializer for named collections of arrays, e.g. epochs + labels.
+
+    Payloads are written as an npz archive (readable with np.load) and read
+    back as a LazyArrayDict, which only loads an array when it is first
+    accessed. Arrays stored uncompressed are memory-mapped.
+
+    Args:
+        compress: Which arrays to compress when writing. True or False
+            applies to every array; a collection of names compresses just
+            those arrays. Compressed arrays are smaller but cannot be
+            memory-mapped.
+        mmap_mode: Mode used to memory-map uncompressed arrays on read, or
+            None to always read arrays into memory.
+        quantize: If set, float arrays are stored as "float16", or as
+            "int16" with a scale and offset per channel. They are dequantized
+            to their original dtype when read.
+        quantize_axis: The time axis of the arrays; int16 scales and offsets
+            are computed over it.
+    """
+    extension = "npzd"
+
+    def __init__(self, compress: Union[bool, Collection[str]] = False,
+                 mmap_mode: Optional[str] = "c",
+                 quantize: Optional[str] = None, quantize_axis: int = -1):
+        self.compress = compress
+        self.mmap_mode = mmap_mode
+        self.quantize = quantize
+        self.quantize_axis = quantize_axis
+
+    def _compress_key(self, key: str) -> bool:
+        if isinstance(self.compress, bool):
+            return self.compress
+        return key in self.compress
+
+    def _write_to_file(self, payload: Dict[str, np.ndarray],
+                       fname: str) -> Optional[Dict[str, Any]]:
+        quantization: Dict[str, Dict[str, Any]] = {}
+        errors: List[float] = []
+        with zipfile.ZipFile(fname, mode="w", allowZip64=True) as zf:
+            for key, array in payload.items():
+                array = np.asanyarray(array)
+                if (self.quantize is not None
+                        and np.issubdtype(array.dtype, np.floating)):
+                    quantized, params, error = quantize(
+                        array, self.quantize, self.quantize_axis)
+                    for name, param in params.items():
+                        write_npz_member(zf, f"__{name}__/{key}", param)
+                    quantization[key] = {"mode": self.quantize,
+                                         "dtype": array.dtype.str,
+                                         "params": sorted(params)}
+                    _report_quantization(key, self.quantize, error)
+                    errors.append(error)
+                    array = quantized
+                write_npz_member(zf, key, array,
+                                 compress=self._compress_key(key))
+            if quantization:
+                zf.writestr(QUANTIZATION_MEMBER, json.dumps(quantization))
+        if errors:
+            return {"max_abs_error": max(errors)}
+        return None
+
+    def _read_from_file(self, fname: str) -> Dict[str, np.ndarray]:
+        return LazyArrayDict(fname, mmap_mode=self.mmap_mode)
+
+    def detach(self, payload: Dict[str, np.ndarray]) -> Dict[str, np.ndarray]:
+        # Memory maps stay valid after their file is unlinked.
+        if isinstance(payload, LazyArrayDict):
+            payload.load_all()
+        return payload
+
+    def estimate_nbytes(self, fname: str) -> int:
+        return _npz_nbytes(fname)
+
+
+DictPayloadSerializer.register([DataType.EEG, DataType.FMRI])
+
+
+class EEGPayloadSerializer(PayloadSerializer[mne.io.BaseRaw]):
+    """Serializer for MNE Raw objects of any origin (fif, EDF, BDF, ...).
+
+    Raw objects that are not preloaded are saved chunk by chunk, so
+    recordings larger than memory can be stored.
+    """
     extension = "fif"
 
-    def _write_to_file(self, payload: mne.io.Raw, fname: str):
+    def _write_to_file(self, payload: mne.io.BaseRaw, fname: str):
         payload.save(fname, overwrite=True)
 
-    def _read_from_file(self, fname: str) -> mne.io.Raw:
+    def _read_from_file(self, fname: str) -> mne.io.BaseRaw:
         return mne.io.read_raw_fif(fname, preload=True)
 
+    def open_reader(self, fname: str) -> WindowReader:
+        return RawWindowReader(mne.io.read_raw_fif(fname, preload=False))
+
+    def estimate_nbytes(self, fname: str) -> int:
+        # Preloaded data is float64, whatever the file's format.
+        with mne.io.read_raw_fif(fname, preload=False, verbose=False) as raw:
+            return len(raw.ch_names) * raw.n_times * 8
+
 
 EEGPayloadSerializer.register([DataType.EEG])
 
@@ -188,6 +394,10 @@ class VideoPayloadSerializer(PayloadSerializer[np.ndarray]):
             cap.release()
 
 
+    def open_reader(self, fname: str) -> WindowReader:
+        return VideoWindowReader(fname)
+
+
 VideoPayloadSerializer.register([DataType.VIDEO, DataType.VISUAL_PROMPT])
 
 
@@ -228,25 +438,157 @@ class AudioPayloadSerializer(PayloadSerializer[np.ndarray]):
         return samples_float / 32768.0
 
 
+    def open_reader(self, fname: str) -> WindowReader:
+        return AudioWindowReader(fname)
+
+
 AudioPayloadSerializer.register([DataType.AUDITORY_PROMPT])
 
 
 class FMRIPayloadSerializer(PayloadSerializer[np.ndarray]):
+    """Serializer for fMRI volumes.
+
+    Volumes are split into blocks that are compressed and decompressed in
+    parallel (see BlockedArchiveWriter), so storing and loading a run scales
+    with the number of cores. Objects written before the blocked format, as a
+    compressed npz with a single 'data' array, are still read.
+
+    4D ``(x, y, z, t)`` runs can be stored masked: a boolean brain mask plus
+    a ``(n_voxels, t)`` matrix of the voxels inside it. Masked objects are
+    read back either as that compact matrix or as a MaskedVolume, which
+    reconstructs the 4D volume lazily. Passing a MaskedVolume payload always
+    stores it masked.
+
+    Args:
+        n_threads: Number of threads used for (de)compression. Defaults to
+            the CPU count.
+        compression_level: zlib compression level, from 0 to 9.
+        block_bytes: Target uncompressed size of each block.
+        mask: On store, None to store the dense volume, "auto" to mask out
+            voxels that are zero at every timepoint, or a boolean
+            ``(x, y, z)`` array.
+        layout: On retrieve of a masked object, "volume" for a MaskedVolume
+            or "compact" for the ``(n_voxels, t)`` matrix.
+        quantize: If set, float volumes are stored as "float16", or as
+            "int16" with a scale and offset per voxel. They are dequantized
+            to their original dtype when read.
+    """
     extension = "npz"
 
-    def _write_to_file(self, payload: np.ndarray, fname: str):
+    def __init__(self, n_threads: Optional[int] = None,
+                 compression_level: int = zlib.Z_DEFAULT_COMPRESSION,
+                 block_bytes: int = DEFAULT_BLOCK_BYTES,
+                 mask: Union[None, str, np.ndarray] = None,
+                 layout: str = "volume", quantize: Optional[str] = None):
+        if layout not in ("volume", "compact"):
+            raise ValueError(f"Unknown layout {layout}, expected 'volume' or "
+                             "'compact'.")
+        if isinstance(mask, str) and mask != "auto":
+            raise ValueError(f"Unknown mask {mask}, expected 'auto' or an "
+                             "array.")
+        self.n_threads = n_threads
+        self.compression_level = compression_level
+        self.block_bytes = block_bytes
+        self.mask = mask
+        self.layout = layout
+        self.quantize = quantize
+
+    def _write_to_file(self, payload: np.ndarray,
+                       fname: str) -> Optional[Dict[str, Any]]:
         # Validate payload dimensions
         if len(payload.shape) < 3:
             raise ValueError(f"FMRI payload must have at least 3 dimensions but got {
                              len(payload.shape)}")
 
-        # Save as compressed npz file
-        np.savez_compressed(fname, data=payload)
+        if self.mask is not None and not isinstance(payload, MaskedVolume):
+            payload = MaskedVolume.from_dense(
+                payload, None if isinstance(self.mask, str) else self.mask)
+
+        report = None
+        with BlockedArchiveWriter(fname, n_threads=self.n_threads,
+                                  compression_level=self.compression_level,
+                                  block_bytes=self.block_bytes) as writer:
+            data = payload
+            if isinstance(payload, MaskedVolume):
+                writer.attrs["layout"] = "masked"
+                writer.attrs["fill_value"] = payload.fill_value
+                writer.write_array("mask", payload.mask)
+                data = payload.data
+            if self.quantize is not None:
+                # Time is the last axis of both dense and masked layouts.
+                quantized, params, error = quantize(data, self.quantize, -1)
+                writer.attrs["quantization"] = {"mode": self.quantize,
+                                                "dtype": data.dtype.str,
+                                                "params": sorted(params)}
+                for name, param in params.items():
+                    writer.write_array(name, param)
+                _report_quantization("data", self.quantize, error)
+                report = {"max_abs_error": error}
+                data = quantized
+            writer.write_array("data", data)
+        return report
 
     def _read_from_file(self, fname: str) -> np.ndarray:
-        # Load npz file
-        with np.load(fname) as data:
-            return data['data']
+        if not BlockedArchiveReader.is_blocked_archive(fname):
+            # Written before the blocked format: a plain compressed npz.
+            with np.load(fname) as data:
+                return data['data']
+
+        with BlockedArchiveReader(fname, n_threads=self.n_threads) as reader:
+            data = reader.read_array("data")
+            if "quantization" in reader.attrs:
+                spec = reader.attrs["quantization"]
+                params = {name: reader.read_array(name)
+                          for name in spec["params"]}
+                data = dequantize(data, params, spec["mode"], spec["dtype"])
+            if reader.attrs.get("layout") != "masked":
+                return data
+            if self.layout == "compact":
+                return data
+            return MaskedVolume(reader.read_array("mask"), data,
+                                fill_value=reader.attrs["fill_value"])
+
+    def open_reader(self, fname: str) -> WindowReader:
+        if not BlockedArchiveReader.is_blocked_archive(fname):
+            return super().open_reader(fname)
+        return BlockedWindowReader(fname, n_threads=self.n_threads)
+
+    def estimate_nbytes(self, fname: str) -> int:
+        if not BlockedArchiveReader.is_blocked_archive(fname):
+            return _npz_nbytes(fname, ["data"])
+        with BlockedArchiveReader(fname, n_threads=1) as reader:
+            layout = reader.arrays["data"]
+            # Quantized data is read back in its original dtype.
+            dtype = reader.attrs.get("quantization", {}).get(
+                "dtype", layout["dtype"])
+            total = int(np.prod(layout["shape"])) * np.dtype(dtype).itemsize
+            if "mask" in reader.arrays:
+                total += int(np.prod(reader.arrays["mask"]["shape"]))
+            return total
 
 
 FMRIPayloadSerializer.register([DataType.FMRI])
+
+
+class ViewSerializer(PayloadSerializer[View]):
+    """Serializer for views, stored as a JSON descriptor of their parent.
+
+    What is read back is the View itself; StorageManager.retrieve() then
+    applies it to the parent's payload (see views.py). Serializer options
+    are meant for the parent, so they are ignored here.
+    """
+    extension = "view"
+
+    def __init__(self, **options):
+        pass
+
+    def _write_to_file(self, payload: View, fname: str):
+        with open(fname, "w") as f:
+            f.write(payload.to_json())
+
+    def _read_from_file(self, fname: str) -> View:
+        with open(fname) as f:
+            return View.from_json(f.read())
+
+
+ViewSerializer.register(list(DataType))
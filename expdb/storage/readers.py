@@ -0,0 +1,237 @@
+"""
+Readers that load a stored payload one window of time at a time.
+
+A WindowReader exposes the length of a payload's time axis (always its last
+axis, as returned by ``read``) and reads any ``[start, stop)`` range of it
+without loading the rest. Serializers return one from open_reader(), so that
+streaming transforms can process recordings larger than memory.
+"""
+from abc import ABC, abstractmethod
+from typing import Callable, List, Optional
+
+import cv2
+import mne
+import numpy as np
+import soundfile as sf
+import tempfile
+
+from .storage_utils import (BlockedArchiveReader, MaskedVolume, dequantize,
+                            release_pages)
+
+
+class WindowReader(ABC):
+    """Reads a payload window by window along its time axis.
+
+    Readers are context managers; files they hold open are closed, and
+    scratch files removed, on close().
+    """
+    n_times: int
+
+    def __init__(self):
+        self._on_close: List[Callable[[], None]] = []
+
+    @abstractmethod
+    def read(self, start: int, stop: int) -> np.ndarray:
+        """Read samples ``[start, stop)``, with time as the last axis."""
+        raise NotImplementedError
+
+    def wrap(self, data: np.ndarray):
+        """Turn an array shaped like this reader's windows into a payload.
+
+        Used to build the output of a transform that preserves the input's
+        payload type, e.g. an MNE Raw with the input's measurement info.
+        """
+        return data
+
+    def call_on_close(self, callback: Callable[[], None]):
+        """Register a callback to run, in registration order, on close()."""
+        self._on_close.append(callback)
+
+    def close(self):
+        while self._on_close:
+            self._on_close.pop(0)()
+
+    def __enter__(self) -> 'WindowReader':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ArrayWindowReader(WindowReader):
+    """Reads windows of an array (memory map, MaskedVolume) with time last."""
+
+    def __init__(self, array: np.ndarray):
+        super().__init__()
+        self.array = array
+        self.n_times = array.shape[-1]
+
+    def read(self, start: int, stop: int) -> np.ndarray:
+        window = np.array(self.array[..., start:stop])
+        release_pages(self.array)
+        return window
+
+
+class RawWindowReader(WindowReader):
+    """Reads windows of an MNE Raw, which need not be preloaded.
+
+    Windows are ``(n_channels, n_times)`` arrays in volts, as returned by
+    ``Raw.get_data``, and wrap() builds a RawArray with the Raw's info.
+    """
+
+    def __init__(self, raw: mne.io.BaseRaw):
+        super().__init__()
+        self.raw = raw
+        self.n_times = raw.n_times
+
+    def read(self, start: int, stop: int) -> np.ndarray:
+        return self.raw.get_data(start=start, stop=stop)
+
+    def wrap(self, data: np.ndarray) -> mne.io.BaseRaw:
+        return mne.io.RawArray(data, self.raw.info.copy(),
+                               first_samp=self.raw.first_samp, verbose=False)
+
+    def close(self):
+        self.raw.close()
+        super().close()
+
+
+class BlockedWindowReader(WindowReader):
+    """Reads windows of the ``data`` array of a blocked fMRI archive.
+
+    Quantized data is dequantized, and masked data expanded to dense
+    volumes, one window at a time. When the archive is blocked along time
+    (Fortran ordered volumes, as NIfTI files are) only the blocks overlapping
+    a window are decompressed. Otherwise the array is first decompressed,
+    block by block, to a scratch memory map.
+
+    Args:
+        fname: Path of the archive.
+        n_threads: Number of decompression threads. Defaults to the CPU count.
+    """
+
+    def __init__(self, fname: str, n_threads: Optional[int] = None):
+        super().__init__()
+        self._reader = BlockedArchiveReader(fname, n_threads=n_threads)
+        self.call_on_close(self._reader.close)
+        attrs = self._reader.attrs
+        layout = self._reader.arrays["data"]
+        self.n_times = layout["shape"][-1]
+
+        self._quantization = attrs.get("quantization")
+        self._params = {}
+        if self._quantization is not None:
+            self._params = {name: self._reader.read_array(name)
+                            for name in self._quantization["params"]}
+        self._mask = None
+        if attrs.get("layout") == "masked":
+            self._mask = self._reader.read_array("mask")
+            self._fill_value = attrs["fill_value"]
+
+        self._spooled = None
+        if layout["axis"] != len(layout["shape"]) - 1:
+            self._spooled = self._spool(layout)
+
+    def _spool(self, layout) -> np.memmap:
+        scratch = tempfile.TemporaryFile()
+        self.call_on_close(scratch.close)
+        shape = tuple(layout["shape"])
+        out = np.memmap(scratch, dtype=np.dtype(layout["dtype"]), mode="w+",
+                        shape=shape, order="F")
+        axis = layout["axis"]
+        for start, stop in layout["bounds"]:
+            block = self._reader.read_range("data", start, stop)
+            index = [slice(None)] * len(shape)
+            index[axis] = slice(start, stop)
+            out[tuple(index)] = block
+            release_pages(out)
+        out.flush()
+        del out
+        return np.memmap(scratch, dtype=np.dtype(layout["dtype"]), mode="r",
+                         shape=shape, order="F")
+
+    def read(self, start: int, stop: int) -> np.ndarray:
+        if self._spooled is not None:
+            window = np.array(self._spooled[..., start:stop])
+            release_pages(self._spooled)
+        else:
+            window = self._reader.read_range("data", start, stop)
+        if self._quantization is not None:
+            window = dequantize(window, self._params,
+                                self._quantization["mode"],
+                                self._quantization["dtype"])
+        if self._mask is not None:
+            window = MaskedVolume(self._mask, window,
+                                  fill_value=self._fill_value).to_dense()
+        return window
+
+
+class VideoWindowReader(WindowReader):
+    """Decodes only the frames of each window of a video file.
+
+    Windows are ``(height, width, 3, n_frames)`` RGB arrays, with time last
+    like every window; wrap() moves time back to the first axis of a video
+    payload. Reading windows in order decodes each frame once; reading out
+    of order seeks.
+    """
+
+    def __init__(self, fname: str):
+        super().__init__()
+        self._capture = cv2.VideoCapture(fname)
+        if not self._capture.isOpened():
+            raise ValueError(f"Could not open video file {fname}")
+        self.call_on_close(self._capture.release)
+        self.n_times = int(self._capture.get(cv2.CAP_PROP_FRAME_COUNT))
+        self._height = int(self._capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        self._width = int(self._capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+        self._position = 0
+
+    def read(self, start: int, stop: int) -> np.ndarray:
+        if start != self._position:
+            self._capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+        frames = np.empty((self._height, self._width, 3, stop - start),
+                          dtype=np.uint8)
+        for i in range(stop - start):
+            ret, frame = self._capture.read()
+            if not ret:
+                raise ValueError(f"Failed to read frame {start + i} from "
+                                 f"video file")
+            frames[..., i] = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        self._position = stop
+        return frames
+
+    def wrap(self, data: np.ndarray) -> np.ndarray:
+        return np.ascontiguousarray(np.moveaxis(data, -1, 0))
+
+
+class AudioWindowReader(WindowReader):
+    """Decodes only the samples of each window of an audio file.
+
+    Windows are ``(n_channels, n_samples)`` arrays, scaled as
+    AudioPayloadSerializer reads them; wrap() moves time back to the first
+    axis of an audio payload.
+    """
+
+    def __init__(self, fname: str):
+        super().__init__()
+        self._file = sf.SoundFile(fname)
+        self.call_on_close(self._file.close)
+        self.n_times = self._file.frames
+
+    def read(self, start: int, stop: int) -> np.ndarray:
+        self._file.seek(start)
+        samples = self._file.read(stop - start, always_2d=True)
+        return (samples.astype(np.float32) / 32768.0).T
+
+    def wrap(self, data: np.ndarray) -> np.ndarray:
+        return np.ascontiguousarray(np.moveaxis(data, -1, 0))
+
+
+def reader_for_payload(payload) -> WindowReader:
+    """Wrap an already loaded payload (an array, MaskedVolume or Raw)."""
+    if isinstance(payload, mne.io.BaseRaw):
+        return RawWindowReader(payload)
+    if isinstance(payload, (np.ndarray, MaskedVolume)):
+        return ArrayWindowReader(payload)
+    raise TypeError(f"Cannot read {type(payload).__name__} payloads in "
+                    f"windows.")
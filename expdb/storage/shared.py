@@ -0,0 +1,248 @@
+"""
+Decoded payloads in named shared memory, for handing to worker processes.
+
+Passing a payload to a process pool pickles it through a pipe, which for
+multi-GB fMRI arrays or MNE Raw recordings costs more than most analyses.
+A SharedPayloadStore instead copies each payload once into a named shared
+memory segment and returns a SharedPayload, a small picklable handle. Any
+process on the machine can attach() the handle to get the payload back as a
+view of the segment, without copying it.
+
+The store owns the segments. Each handle is reference counted: share()
+and retain() add a reference, release() drops one, and the segment is
+unlinked when the last one is dropped, or when the store is closed. Worker
+processes that attached a segment keep their mapping until the attached
+payload is garbage collected, even if the segment was unlinked meanwhile.
+"""
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+import mne
+import numpy as np
+
+from multiprocessing import shared_memory
+import dataclasses
+import mmap
+import threading
+
+
+class _Mapping:
+    """Exposes an attached segment's buffer, closing it once unused.
+
+    Arrays built on the buffer keep this object alive, so the segment is
+    only unmapped once the last of them is garbage collected.
+    """
+
+    def __init__(self, shm: shared_memory.SharedMemory):
+        self._shm = shm
+
+    def __buffer__(self, flags: int) -> memoryview:
+        return self._shm.buf
+
+    def __release_buffer__(self, view: memoryview):
+        pass
+
+    def __del__(self):
+        self._shm.close()
+
+
+@dataclasses.dataclass(frozen=True)
+class SharedPayload:
+    """A picklable handle to a payload in shared memory.
+
+    Attributes:
+        name: Name of the shared memory segment.
+        shape: Shape of the array.
+        dtype: Dtype of the array, as a string.
+        order: "C" or "F", the memory layout of the array.
+        info: For Raw payloads, the measurement info. The array is then the
+            Raw's data.
+        first_samp: For Raw payloads, the first sample.
+        annotations: For Raw payloads, the annotations.
+    """
+    name: str
+    shape: Tuple[int, ...]
+    dtype: str
+    order: str = "C"
+    info: Optional[mne.Info] = None
+    first_samp: int = 0
+    annotations: Optional[mne.Annotations] = None
+
+    @property
+    def nbytes(self) -> int:
+        """Size of the array in bytes."""
+        return int(np.prod(self.shape)) * np.dtype(self.dtype).itemsize
+
+    def attach(self, private: bool = False) -> Any:
+        """Map the payload into this process without copying it.
+
+        Args:
+            private: If True, the segment is mapped copy-on-write, so that a
+                consumer can change its payload in place (e.g. filter a Raw)
+                without the others seeing it. Only the pages it writes to
+                are copied.
+
+        Returns:
+            An ndarray viewing the segment, or for Raw payloads a RawArray
+            whose data is one. Unless private, writes are visible to every
+            process that attached the segment.
+        """
+        shm = shared_memory.SharedMemory(name=self.name)
+        count = int(np.prod(self.shape))
+        if not private:
+            buffer = _Mapping(shm)
+        elif getattr(shm, "_fd", -1) >= 0:
+            # A MAP_PRIVATE mapping of the segment, which outlives shm.
+            buffer = mmap.mmap(shm._fd, shm.size, access=mmap.ACCESS_COPY)
+            shm.close()
+        else:
+            # Without a file descriptor (Windows), a private copy.
+            buffer = bytearray(shm.buf[:self.nbytes])
+            shm.close()
+        array = np.frombuffer(buffer, dtype=self.dtype, count=count)
+        array = array.reshape(self.shape, order=self.order)
+        if self.info is None:
+            return array
+        raw = mne.io.RawArray(array, self.info, first_samp=self.first_samp,
+                              copy="info", verbose=False)
+        if self.annotations is not None:
+            raw.set_annotations(self.annotations)
+        return raw
+
+
+class SharedPayloadStore:
+    """Owns the shared memory segments of shared payloads.
+
+    Payloads are numpy arrays (including memory maps) and MNE Raw objects,
+    whose data is loaded if it wasn't preloaded. The store is thread-safe.
+
+    Example:
+        with SharedPayloadStore() as store:
+            handle = store.share(storage_manager.retrieve(timecourse))
+            with ProcessPoolExecutor() as pool:
+                results = list(pool.map(analyze, [handle] * 8))
+
+        def analyze(handle):
+            data = handle.attach()
+            ...
+    """
+
+    def __init__(self):
+        self._segments: Dict[str, shared_memory.SharedMemory] = {}
+        self._handles: Dict[str, SharedPayload] = {}
+        self._counts: Dict[str, int] = {}
+        self._keys: Dict[Hashable, str] = {}
+        self._lock = threading.Lock()
+
+    def share(self, payload: Any, key: Optional[Hashable] = None
+              ) -> SharedPayload:
+        """Copy a payload into a new shared memory segment.
+
+        Args:
+            payload: An ndarray or MNE Raw.
+            key: Optionally, a key to find the handle by with get().
+
+        Returns:
+            A handle holding one reference to the segment.
+
+        Raises:
+            TypeError: If the payload is of another type.
+        """
+        meta: Dict[str, Any] = {}
+        if isinstance(payload, mne.io.BaseRaw):
+            meta = {"info": payload.info,
+                    "first_samp": payload.first_samp,
+                    "annotations": payload.annotations}
+            array = payload.get_data()
+        elif isinstance(payload, np.ndarray):
+            array = payload
+        else:
+            raise TypeError(f"Cannot share {type(payload).__name__} payloads; "
+                            f"expected an ndarray or MNE Raw.")
+
+        order = "F" if (array.flags.f_contiguous
+                        and not array.flags.c_contiguous) else "C"
+        shm = shared_memory.SharedMemory(create=True,
+                                         size=max(array.nbytes, 1))
+        try:
+            view = np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf,
+                              order=order)
+            view[...] = array
+            del view
+        except BaseException:
+            shm.close()
+            shm.unlink()
+            raise
+        handle = SharedPayload(name=shm.name, shape=array.shape,
+                               dtype=array.dtype.str, order=order, **meta)
+        with self._lock:
+            self._segments[shm.name] = shm
+            self._handles[shm.name] = handle
+            self._counts[shm.name] = 1
+            if key is not None:
+                self._keys[key] = shm.name
+        return handle
+
+    def get(self, key: Hashable) -> Optional[SharedPayload]:
+        """The handle shared with ``key``, with a new reference, if any."""
+        with self._lock:
+            name = self._keys.get(key)
+            if name is None:
+                return None
+            self._counts[name] += 1
+            return self._handles[name]
+
+    def retain(self, handle: SharedPayload):
+        """Add a reference to a shared payload."""
+        with self._lock:
+            self._check(handle)
+            self._counts[handle.name] += 1
+
+    def release(self, handle: SharedPayload):
+        """Drop a reference, unlinking the segment if it was the last one.
+
+        Processes that attached the payload keep their mapping.
+        """
+        with self._lock:
+            self._check(handle)
+            self._counts[handle.name] -= 1
+            if self._counts[handle.name] == 0:
+                self._unlink(handle.name)
+
+    def refcount(self, handle: SharedPayload) -> int:
+        """The number of references to a shared payload (0 once unlinked)."""
+        with self._lock:
+            return self._counts.get(handle.name, 0)
+
+    def _check(self, handle: SharedPayload):
+        if handle.name not in self._segments:
+            raise KeyError(f"{handle.name} is not a live segment of this "
+                           f"store.")
+
+    def _unlink(self, name: str):
+        shm = self._segments.pop(name)
+        del self._handles[name]
+        del self._counts[name]
+        self._keys = {k: v for k, v in self._keys.items() if v != name}
+        shm.close()
+        shm.unlink()
+
+    @property
+    def nbytes(self) -> int:
+        """Total size of the live segments' payloads."""
+        with self._lock:
+            return sum(handle.nbytes for handle in self._handles.values())
+
+    def __len__(self) -> int:
+        return len(self._segments)
+
+    def close(self):
+        """Unlink every segment, whatever its references."""
+        with self._lock:
+            for name in list(self._segments):
+                self._unlink(name)
+
+    def __enter__(self) -> 'SharedPayloadStore':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
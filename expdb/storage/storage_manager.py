@@ -1,14 +1,22 @@
-from typing import Type
+from typing import Callable, Optional, Tuple, Type
 from abc import ABC, abstractmethod
 
+from sqlalchemy.orm import object_session
+
 from . import format as fmt
+from .readers import WindowReader, reader_for_payload
+from .shared import SharedPayload, SharedPayloadStore
+from .views import View
 from ..models import DataType, Timecourse
+from ..utils import telemetry
 
 
+import functools
 import os
 import re
 import subprocess
 import tempfile
+import uuid
 
 
 class StorageManager(ABC):
@@ -28,68 +36,289 @@ class StorageManager(ABC):
     
     self.local_cache_dir = local_cache_dir
 
-  def store(self, timecourse: Timecourse, payload: fmt.TimecoursePayload):
+  def store(self, timecourse: Timecourse, payload: fmt.TimecoursePayload,
+            **options):
     """Store a timecourse payload in the storage backend.
 
     Args:
         timecourse (Timecourse): The timecourse object containing metadata
         payload (TimecoursePayload): The data payload to store
+        **options: Options passed to the serializer (e.g. compression).
+
+    Returns:
+        dict or None: What the serializer reported about the write, e.g. the
+        maximum absolute error of a quantized payload.
 
     The data will be serialized using the appropriate serializer for the data type
     and stored either directly or through the local cache depending on configuration.
     """
-    data_type = timecourse.data.type
-    serializer = fmt.TYPE_TO_SERIALIZER[(data_type, type(payload))]()
-    path = self._get_local_path_from_data(timecourse, type(payload))
-    uri = timecourse.path
+    return self.prepare_store(timecourse, payload, **options)()
 
+  def prepare_store(self, timecourse: Timecourse,
+                    payload: fmt.TimecoursePayload,
+                    **options) -> Callable[[], Optional[dict]]:
+    """Work out where a payload is stored, without storing it yet.
+
+    The returned function does the serialization and upload without touching
+    the timecourse (or its session), so it can run on another thread.
+
+    Args:
+        timecourse (Timecourse): The timecourse object containing metadata
+        payload (TimecoursePayload): The data payload to store
+        **options: Options passed to the serializer (e.g. compression).
+
+    Returns:
+        Callable: Stores the payload and returns what store() would.
+    """
+    data_type = timecourse.data.type
+    payload_type = fmt.get_payload_type(payload)
+    serializer = fmt.TYPE_TO_SERIALIZER[(data_type, payload_type)](**options)
+    path = self._relative_path(timecourse.path)
+    ext = fmt.TYPE_TO_EXTENSION[data_type, payload_type]
+    return functools.partial(self._store_file, serializer, payload, path,
+                             ext, timecourse.path)
+
+  def _store_file(self, serializer: fmt.PayloadSerializer,
+                  payload: fmt.TimecoursePayload, path: str, ext: str,
+                  uri: str):
     if self.local_cache_dir is not None:
       local_path = os.path.join(self.local_cache_dir, path)
       os.makedirs(os.path.dirname(local_path), exist_ok=True)
-      serializer.to_file(local_path, payload)
-      self._upload_data_to_uri(local_path, uri)
+      report = self._serialize(serializer, local_path, payload)
+      with telemetry.stage("upload"):
+        self._upload_data_to_uri(local_path, uri)
     else:
-      with tempfile.NamedTemporaryFile(
-        suffix=f".{fmt.TYPE_TO_EXTENSION[data_type, type(payload)]}") as tf:
-        serializer.to_file(tf.name, payload)
+      with tempfile.NamedTemporaryFile(suffix=f".{ext}") as tf:
+        report = self._serialize(serializer, tf.name, payload)
         try:
-          self._upload_data_to_uri(tf.name, uri)
+          with telemetry.stage("upload"):
+            self._upload_data_to_uri(tf.name, uri)
         finally:
           tf.close()
-
-  def retrieve(self, timecourse: Timecourse) -> fmt.TimecoursePayload:
+    return report
+
+  def _serialize(self, serializer: fmt.PayloadSerializer, local_path: str,
+                 payload: fmt.TimecoursePayload):
+    with telemetry.stage("serialize"):
+      report = serializer.to_file(local_path, payload)
+      telemetry.add_bytes(os.path.getsize(local_path))
+    return report
+
+  def _deserialize(self, serializer: fmt.PayloadSerializer,
+                   local_path: str) -> fmt.TimecoursePayload:
+    with telemetry.stage("decode"):
+      telemetry.add_bytes(os.path.getsize(local_path))
+      return serializer.from_file(local_path)
+
+  def retrieve(self, timecourse: Timecourse,
+               **options) -> fmt.TimecoursePayload:
     """Retrieve a timecourse payload from storage.
 
     Args:
         timecourse (Timecourse): The timecourse object containing metadata and path
+        **options: Options passed to the serializer.
 
     Returns:
         TimecoursePayload: The deserialized data payload
 
     The data will be retrieved either from local cache if available or downloaded
-    from the storage backend.
+    from the storage backend. Views (see views.py) are applied to their
+    parent's payload, which is retrieved with the same options.
     """
+    return self.prepare_retrieve(timecourse, **options)()
+
+  def retrieve_shared(self, timecourse: Timecourse,
+                      store: SharedPayloadStore, **options) -> SharedPayload:
+    """Retrieve a timecourse payload into shared memory.
+
+    The payload is decoded once per store: later calls for the same
+    timecourse and options return the same handle, with a new reference.
+    Worker processes attach() the handle to map the payload without
+    copying it.
+
+    Args:
+        timecourse (Timecourse): The timecourse object containing metadata and path
+        store (SharedPayloadStore): Owns the shared memory.
+        **options: Options passed to the serializer.
+
+    Returns:
+        SharedPayload: A handle holding one reference, to release() from
+        the store once the workers are done.
+    """
+    key = (timecourse.path, tuple(sorted(options.items())))
+    handle = store.get(key)
+    if handle is None:
+      handle = store.share(self.retrieve(timecourse, **options), key=key)
+    return handle
+
+  def prepare_retrieve(self, timecourse: Timecourse, **options
+                       ) -> Callable[[], fmt.TimecoursePayload]:
+    """Work out where a payload is stored, without retrieving it yet.
+
+    Like prepare_store, the returned function can run on another thread.
+
+    Args:
+        timecourse (Timecourse): The timecourse object containing metadata and path
+        **options: Options passed to the serializer.
+
+    Returns:
+        Callable: Returns the deserialized payload.
+    """
+    serializer, uri, local_path = self._locate(timecourse, **options)
+    if isinstance(serializer, fmt.ViewSerializer):
+      view, parent = self._resolve_view(timecourse, serializer, uri,
+                                        local_path)
+      load_parent = self.prepare_retrieve(parent, **options)
+      return lambda: view.apply(load_parent())
+    return functools.partial(self._retrieve_file, serializer, uri,
+                             local_path)
+
+  def _resolve_view(self, timecourse: Timecourse,
+                    serializer: fmt.ViewSerializer, uri: str,
+                    local_path: Optional[str]) -> Tuple[View, Timecourse]:
+    """Read a view's descriptor and look up its parent timecourse.
+
+    The descriptor is small, so it is read right away, and the parent is
+    looked up in the view's session.
+    """
+    view = self._retrieve_file(serializer, uri, local_path)
+    session = object_session(timecourse)
+    if session is None:
+      raise ValueError(f"Timecourse {timecourse.id} is a view, and must "
+                       f"belong to a session to look up its parent.")
+    parent = session.get(Timecourse, view.parent_id)
+    if parent is None:
+      raise ValueError(f"Parent {view.parent_id} of view {timecourse.id} "
+                       f"does not exist.")
+    return view, parent
+
+  def _locate(self, timecourse: Timecourse, **options
+              ) -> Tuple[fmt.PayloadSerializer, str, Optional[str]]:
+    """The serializer, URI and (if cached) local path of a payload."""
     uri = timecourse.path
     ext = uri.split('.')[-1]
-    data_type, filetype = fmt.EXTENSION_TO_TYPE[ext]
-    serializer = fmt.TYPE_TO_SERIALIZER[(data_type, filetype)]()
-
+    serializer_cls, _ = fmt.get_serializer_for_extension(
+      timecourse.data.type, ext)
+    local_path = None
     if self.local_cache_dir is not None:
-      local_path = os.path.join(
-        self.local_cache_dir,
-        self._get_local_path_from_data(timecourse, filetype))
+      local_path = os.path.join(self.local_cache_dir,
+                                self._relative_path(uri))
+    return serializer_cls(**options), uri, local_path
+
+  def _retrieve_file(self, serializer: fmt.PayloadSerializer, uri: str,
+                     local_path: Optional[str]) -> fmt.TimecoursePayload:
+    if local_path is not None:
       if not os.path.exists(local_path):
-        self._download_data_from_uri(uri, local_path)
-      payload = serializer.from_file(local_path)
+        with telemetry.stage("download"):
+          self._download_data_from_uri(uri, local_path)
+      payload = self._deserialize(serializer, local_path)
 
     else:
+      ext = uri.split('.')[-1]
       tf = tempfile.NamedTemporaryFile(suffix=f".{ext}")
       local_path = tf.name
-      self._download_data_from_uri(uri, local_path)
-      payload = serializer.from_file(local_path)
+      with telemetry.stage("download"):
+        self._download_data_from_uri(uri, local_path)
+      payload = serializer.detach(self._deserialize(serializer, local_path))
       tf.close()
     return payload
 
+  def open_reader(self, timecourse: Timecourse,
+                  **options) -> WindowReader:
+    """Open a timecourse's payload for reading one window of time at a time.
+
+    Args:
+        timecourse (Timecourse): The timecourse object containing metadata and path
+        **options: Options passed to the serializer.
+
+    Returns:
+        WindowReader: A reader that must be closed once done. Formats that
+        support partial reads (fif, blocked fMRI archives) only hold a window
+        in memory at a time.
+    """
+    return self.prepare_open_reader(timecourse, **options)()
+
+  def prepare_open_reader(self, timecourse: Timecourse, **options
+                          ) -> Callable[[], WindowReader]:
+    """Work out where a payload is stored, without opening it yet.
+
+    Like prepare_store, the returned function can run on another thread.
+
+    Args:
+        timecourse (Timecourse): The timecourse object containing metadata and path
+        **options: Options passed to the serializer.
+
+    Returns:
+        Callable: Returns a reader, as open_reader.
+    """
+    serializer, uri, local_path = self._locate(timecourse, **options)
+    if isinstance(serializer, fmt.ViewSerializer):
+      # Views are applied to the whole payload, then read from memory.
+      load = self.prepare_retrieve(timecourse, **options)
+      return lambda: reader_for_payload(load())
+    return functools.partial(self._open_file_reader, serializer, uri,
+                             local_path)
+
+  def _open_file_reader(self, serializer: fmt.PayloadSerializer, uri: str,
+                        local_path: Optional[str]) -> WindowReader:
+    if local_path is not None:
+      if not os.path.exists(local_path):
+        with telemetry.stage("download"):
+          self._download_data_from_uri(uri, local_path)
+      return serializer.open_reader(local_path)
+
+    ext = uri.split('.')[-1]
+    fd, local_path = tempfile.mkstemp(suffix=f".{ext}")
+    os.close(fd)
+    try:
+      with telemetry.stage("download"):
+        self._download_data_from_uri(uri, local_path)
+      reader = serializer.open_reader(local_path)
+    except BaseException:
+      os.remove(local_path)
+      raise
+    reader.call_on_close(lambda: os.remove(local_path))
+    return reader
+
+  def estimate_nbytes(self, timecourse: Timecourse,
+                      **options) -> Optional[int]:
+    """Estimate the memory a timecourse's payload takes once retrieved.
+
+    If the file is cached locally, its header is read (see
+    PayloadSerializer.estimate_nbytes); the payload itself isn't.
+    Otherwise the size of the stored object is used, which underestimates
+    compressed formats.
+
+    Args:
+        timecourse (Timecourse): The timecourse object containing metadata and path
+        **options: Options passed to the serializer.
+
+    Returns:
+        Optional[int]: The estimate in bytes, or None if the file isn't
+        cached and the backend can't report its size.
+    """
+    serializer, uri, local_path = self._locate(timecourse, **options)
+    if isinstance(serializer, fmt.ViewSerializer):
+      # Views don't grow their parent's payload.
+      _, parent = self._resolve_view(timecourse, serializer, uri, local_path)
+      return self.estimate_nbytes(parent, **options)
+    if local_path is not None and os.path.exists(local_path):
+      return serializer.estimate_nbytes(local_path)
+    return self._remote_nbytes(uri)
+
+  def _remote_nbytes(self, uri: str) -> Optional[int]:
+    """The size of a stored object in bytes, if the backend can tell."""
+    return None
+
+  def _relative_path(self, uri: str) -> str:
+    """The path of a stored payload relative to the local cache directory.
+
+    Payloads are found from the path stored with their timecourse rather
+    than by generating it again, so that files stay readable whatever
+    _get_local_path_from_data named them when they were written.
+    """
+    return uri
+
   def _get_local_path_from_data(self, timecourse: Timecourse,
                                 payload_type: Type[fmt.TimecoursePayload]
                                 ) -> str:
@@ -100,13 +329,17 @@ class StorageManager(ABC):
         payload_type (Type[TimecoursePayload]): The type of payload being stored
 
     Returns:
-        str: The canonical path to the data
+        str: A new path to store the data at
     """
     ext = fmt.TYPE_TO_EXTENSION[(timecourse.data.type, payload_type)]
+    # Timecourses collected at the same time (e.g. derived by transforms in
+    # parallel worker processes) are told apart by a random suffix.
+    timestamp = (f"{timecourse.date_collected.strftime('%Y%m%d_%H%M%S')}_"
+                 f"{uuid.uuid4().hex}")
     path = (f"{timecourse.study.name}/"
             f"{timecourse.subject.code}/{timecourse.data.modality.value}/"
             f"{timecourse.data.type.value}/"
-            f"{timecourse.date_collected.strftime('%Y%m%d_%H%M%S')}.{ext}")
+            f"{timestamp}.{ext}")
     return path
   
   @abstractmethod
@@ -151,8 +384,15 @@ class GCSStorageManager(StorageManager):
   
   def get_uri_from_data(self, timecourse: Timecourse,
                         payload: fmt.TimecoursePayload) -> str:
-    local_path = self._get_local_path_from_data(timecourse, type(payload))
+    local_path = self._get_local_path_from_data(
+      timecourse, fmt.get_payload_type(payload))
     return f"{self.gcs_prefix}/{local_path}"
+
+  def _relative_path(self, uri: str) -> str:
+    # The part after the bucket, which needn't be this one (uploads are
+    # stored in the configured bucket).
+    m = re.match(r"gs://[^/]+/(.*)", uri)
+    return uri if m is None else m.group(1)
   
   def _upload_data_to_uri(self, fname: str, uri: str):
     try:
@@ -164,6 +404,14 @@ class GCSStorageManager(StorageManager):
     except subprocess.CalledProcessError as e:
         print(f"Failed to upload file: {e}")
 
+  def _remote_nbytes(self, uri: str) -> Optional[int]:
+    try:
+      result = subprocess.run(["gcloud", "storage", "du", uri],
+                              check=True, capture_output=True, text=True)
+      return int(result.stdout.split()[0])
+    except (OSError, subprocess.CalledProcessError, ValueError, IndexError):
+      return None
+
   def _download_data_from_uri(self, path: str, local_path: str):
     try:
         subprocess.run(
@@ -189,7 +437,8 @@ class LocalStorageManager(StorageManager):
   
   def get_uri_from_data(self, timecourse: Timecourse,
                         payload: fmt.TimecoursePayload) -> str:
-    return self._get_local_path_from_data(timecourse, type(payload))
+    return self._get_local_path_from_data(timecourse,
+                                          fmt.get_payload_type(payload))
 
   def _upload_data_to_uri(self, fname: str, uri: str):
     pass
@@ -0,0 +1,520 @@
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import json
+import math
+import mmap
+import numpy as np
+import os
+import struct
+import zipfile
+import zlib
+
+
+NPY_SUFFIX = ".npy"
+
+# Member of a blocked archive that holds its format version and array layout.
+FORMAT_MEMBER = "__format__.json"
+BLOCKED_FORMAT_VERSION = 2
+DEFAULT_BLOCK_BYTES = 4 * 1024 * 1024
+
+# Member of an npz archive recording which arrays are quantized, and how.
+QUANTIZATION_MEMBER = "__quantization__.json"
+QUANTIZATION_MODES = ("float16", "int16")
+_INT16_MAX = np.iinfo(np.int16).max
+
+# Layout of a zip local file header, up to (and including) the lengths of the
+# variable-size file name and extra fields that precede the member's data.
+_LOCAL_HEADER = struct.Struct("<4s5H3I2H")
+_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+
+
+def write_npz_member(zf: zipfile.ZipFile, name: str, array: np.ndarray,
+                     compress: bool = False):
+    """Write an array to an open zip archive as an ``.npy`` member.
+
+    This is what ``np.savez``/``np.savez_compressed`` do for every array, but
+    lets the caller choose compression per member, so the resulting archive is
+    still readable with ``np.load``.
+
+    Args:
+        zf: A zip archive opened for writing.
+        name: The array name, without the ``.npy`` suffix.
+        array: The array to write. Object arrays are not supported.
+        compress: Whether to deflate the member. Uncompressed members can be
+            memory-mapped when they are read back.
+    """
+    info = zipfile.ZipInfo(name + NPY_SUFFIX, date_time=(1980, 1, 1, 0, 0, 0))
+    info.compress_type = zipfile.ZIP_DEFLATED if compress else zipfile.ZIP_STORED
+    with zf.open(info, "w", force_zip64=True) as f:
+        np.lib.format.write_array(f, np.asanyarray(array), allow_pickle=False)
+
+
+def _npz_member_data_offset(fname: str, info: zipfile.ZipInfo) -> int:
+    """Return the offset in ``fname`` at which the member's raw bytes start."""
+    with open(fname, "rb") as f:
+        f.seek(info.header_offset)
+        header = f.read(_LOCAL_HEADER.size)
+    fields = _LOCAL_HEADER.unpack(header)
+    if fields[0] != _LOCAL_HEADER_SIGNATURE:
+        raise ValueError(f"Corrupt zip member {info.filename} in {fname}")
+    name_length, extra_length = fields[-2], fields[-1]
+    return info.header_offset + _LOCAL_HEADER.size + name_length + extra_length
+
+
+def read_npz_member(fname: str, info: zipfile.ZipInfo,
+                    mmap_mode: Optional[str] = None) -> np.ndarray:
+    """Read a single ``.npy`` member of an npz archive.
+
+    Args:
+        fname: Path to the archive.
+        info: The member's entry in the archive's central directory.
+        mmap_mode: If set and the member is stored uncompressed, the array is
+            memory-mapped with this mode (see ``np.memmap``) instead of being
+            read into memory.
+
+    Returns:
+        np.ndarray: The member's array.
+    """
+    if mmap_mode is not None and info.compress_type == zipfile.ZIP_STORED:
+        offset = _npz_member_data_offset(fname, info)
+        with open(fname, "rb") as f:
+            f.seek(offset)
+            version = np.lib.format.read_magic(f)
+            if version == (1, 0):
+                shape, fortran_order, dtype = (
+                    np.lib.format.read_array_header_1_0(f))
+            else:
+                shape, fortran_order, dtype = (
+                    np.lib.format.read_array_header_2_0(f))
+            data_offset = f.tell()
+        if not dtype.hasobject:
+            return np.memmap(fname, dtype=dtype, mode=mmap_mode,
+                             offset=data_offset, shape=shape,
+                             order="F" if fortran_order else "C")
+
+    with zipfile.ZipFile(fname) as zf, zf.open(info) as f:
+        return np.lib.format.read_array(f, allow_pickle=False)
+
+
+def quantize(array: np.ndarray, mode: str, axis: int = -1
+             ) -> Tuple[np.ndarray, Dict[str, np.ndarray], float]:
+    """Quantize a float array for storage.
+
+    Args:
+        array: The float array to quantize.
+        mode: "float16" to cast to half precision, or "int16" to store
+            ``round((array - offset) / scale)`` with a scale and offset per
+            channel, i.e. per 1D slice along ``axis``.
+        axis: The time axis; values along it share a scale and offset.
+
+    Returns:
+        The quantized array, the parameters needed by dequantize() ("scale"
+        and "offset" for int16, none for float16), and the maximum absolute
+        error introduced.
+    """
+    if mode not in QUANTIZATION_MODES:
+        raise ValueError(f"Unknown quantization mode {mode}, expected one of "
+                         f"{QUANTIZATION_MODES}")
+    array = np.asarray(array)
+    if not np.issubdtype(array.dtype, np.floating):
+        raise ValueError(f"Only float arrays can be quantized, got "
+                         f"{array.dtype}")
+    if mode == "float16":
+        quantized = array.astype(np.float16)
+        if np.any(np.isinf(quantized) & np.isfinite(array)):
+            raise ValueError("Array values exceed the float16 range; use "
+                             "int16 quantization instead.")
+        params: Dict[str, np.ndarray] = {}
+    else:
+        if np.isnan(array).any():
+            raise ValueError("Arrays containing NaN cannot be quantized to "
+                             "int16.")
+        lo = array.min(axis=axis, keepdims=True) if array.size else 0
+        hi = array.max(axis=axis, keepdims=True) if array.size else 0
+        offset = (hi + lo) / 2
+        scale = (hi - lo) / (2 * _INT16_MAX)
+        scale = np.where(scale > 0, scale, 1).astype(np.float64)
+        quantized = np.rint((array - offset) / scale).astype(np.int16)
+        params = {"scale": scale, "offset": np.asarray(offset, np.float64)}
+    restored = dequantize(quantized, params, mode, array.dtype)
+    max_abs_error = float(np.max(np.abs(restored - array))) if array.size else 0.
+    return quantized, params, max_abs_error
+
+
+def dequantize(quantized: np.ndarray, params: Dict[str, np.ndarray],
+               mode: str, dtype) -> np.ndarray:
+    """Invert quantize(), returning an array of the original ``dtype``."""
+    if mode == "float16":
+        return quantized.astype(dtype)
+    return (quantized * params["scale"] + params["offset"]).astype(dtype)
+
+
+class LazyArrayDict(Mapping):
+    """A read-only mapping from names to the arrays of an npz archive.
+
+    Each array is read from the archive the first time it is accessed, so only
+    the arrays that are actually used are paid for. Arrays that were stored
+    uncompressed are memory-mapped rather than read. Arrays recorded as
+    quantized in the archive are dequantized when they are read.
+
+    Args:
+        fname: Path to the npz archive.
+        mmap_mode: Mode used to memory-map uncompressed arrays. The default,
+            ``"c"`` (copy-on-write), gives writable arrays that never modify
+            the file. ``None`` disables memory-mapping.
+    """
+
+    def __init__(self, fname: str, mmap_mode: Optional[str] = "c"):
+        self.fname = fname
+        self.mmap_mode = mmap_mode
+        with zipfile.ZipFile(fname) as zf:
+            # Names starting with "__" hold metadata, not payload arrays.
+            self._all_members: Dict[str, zipfile.ZipInfo] = {
+                info.filename[:-len(NPY_SUFFIX)]: info
+                for info in zf.infolist()
+                if info.filename.endswith(NPY_SUFFIX)
+            }
+            self.quantization: Dict[str, Dict[str, Any]] = (
+                json.loads(zf.read(QUANTIZATION_MEMBER))
+                if QUANTIZATION_MEMBER in zf.namelist() else {})
+        self._members = {name: info for name, info in self._all_members.items()
+                         if not name.startswith("__")}
+        self._arrays: Dict[str, np.ndarray] = {}
+
+    def __getitem__(self, key: str) -> np.ndarray:
+        if key not in self._arrays:
+            array = read_npz_member(self.fname, self._members[key],
+                                    self.mmap_mode)
+            if key in self.quantization:
+                spec = self.quantization[key]
+                params = {
+                    name: read_npz_member(
+                        self.fname, self._all_members[f"__{name}__/{key}"])
+                    for name in spec["params"]
+                }
+                array = dequantize(array, params, spec["mode"], spec["dtype"])
+            self._arrays[key] = array
+        return self._arrays[key]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._members)
+
+    def __len__(self) -> int:
+        return len(self._members)
+
+    @property
+    def loaded_keys(self):
+        """The names of the arrays that have been read so far."""
+        return list(self._arrays)
+
+    def load_all(self) -> "LazyArrayDict":
+        """Read (or memory-map) every array in the archive."""
+        for key in self:
+            self[key]
+        return self
+
+    def __repr__(self) -> str:
+        return (f"LazyArrayDict({self.fname}, keys={list(self)}, "
+                f"loaded={self.loaded_keys})")
+
+
+def release_pages(array: np.ndarray):
+    """Drop the resident pages of a file-backed memory-mapped array.
+
+    Pages are read back from the file on the next access, so this only bounds
+    the resident memory of a pass over a large file-backed array. Writable
+    maps are flushed first; copy-on-write ("c") maps are left alone, since
+    their changes only live in memory.
+    """
+    mm = getattr(array, "_mmap", None)
+    if not (isinstance(array, np.memmap) and mm is not None
+            and array.mode in ("r", "r+", "w+")
+            and hasattr(mmap, "MADV_DONTNEED")):
+        return
+    if array.mode != "r":
+        array.flush()
+    mm.madvise(mmap.MADV_DONTNEED)
+
+
+def _block_index(ndim: int, axis: int, start: int, stop: int) -> Tuple:
+    index: List[Any] = [slice(None)] * ndim
+    index[axis] = slice(start, stop)
+    return tuple(index)
+
+
+class BlockedArchiveWriter:
+    """Writes arrays to a zip archive as independently compressed blocks.
+
+    Each array is split along its slowest-varying axis (the first axis of a C
+    ordered array, the last of a Fortran ordered one) into blocks of roughly
+    ``block_bytes``. Blocks are zlib-compressed on a thread pool (zlib releases
+    the GIL) and stored uncompressed in the zip, so they can be decompressed in
+    parallel, or individually, when read back. A JSON member records the
+    format version and the layout of every array.
+
+    Args:
+        fname: Path of the archive to create.
+        n_threads: Number of compression threads. Defaults to the CPU count.
+        compression_level: zlib compression level, from 0 to 9.
+        block_bytes: Target uncompressed size of each block.
+    """
+
+    def __init__(self, fname: str, n_threads: Optional[int] = None,
+                 compression_level: int = zlib.Z_DEFAULT_COMPRESSION,
+                 block_bytes: int = DEFAULT_BLOCK_BYTES):
+        self.n_threads = n_threads or os.cpu_count() or 1
+        self.compression_level = compression_level
+        self.block_bytes = block_bytes
+        self.attrs: Dict[str, Any] = {}
+        self._arrays: Dict[str, Dict[str, Any]] = {}
+        self._zf = zipfile.ZipFile(fname, mode="w", allowZip64=True)
+        self._executor = ThreadPoolExecutor(self.n_threads)
+
+    def write_array(self, name: str, array: np.ndarray):
+        """Compress and write an array under the given name."""
+        array = np.asanyarray(array)
+        if array.dtype.hasobject:
+            raise ValueError(f"Cannot store object arrays, got {array.dtype}")
+        order = "F" if (array.flags.f_contiguous
+                        and not array.flags.c_contiguous) else "C"
+        # Keep a view of the caller's array where possible: slicing a memmap
+        # only touches the pages of the block being compressed.
+        work = array.reshape(array.shape or (1,), order=order)
+        if not (work.flags.c_contiguous or work.flags.f_contiguous):
+            work = np.ascontiguousarray(work)
+        axis = 0 if order == "C" else work.ndim - 1
+        row_bytes = work.itemsize * math.prod(
+            n for i, n in enumerate(work.shape) if i != axis)
+        step = max(1, self.block_bytes // max(row_bytes, 1))
+        bounds = [(start, min(start + step, work.shape[axis]))
+                  for start in range(0, work.shape[axis], step)]
+
+        def compress(start: int, stop: int) -> bytes:
+            block = work[_block_index(work.ndim, axis, start, stop)]
+            return zlib.compress(block.reshape(-1, order=order),
+                                 self.compression_level)
+
+        # Bound the number of compressed blocks held in memory at once, and
+        # the resident pages of memory-mapped sources.
+        pending = deque()
+        for i, (start, stop) in enumerate(bounds):
+            pending.append((i, self._executor.submit(compress, start, stop)))
+            if len(pending) >= 2 * self.n_threads:
+                self._write_block(name, *pending.popleft())
+                release_pages(array)
+        while pending:
+            self._write_block(name, *pending.popleft())
+        release_pages(array)
+
+        self._arrays[name] = {
+            "shape": list(array.shape),
+            "dtype": array.dtype.str,
+            "order": order,
+            "axis": axis,
+            "bounds": bounds,
+            "codec": "zlib",
+        }
+
+    def _write_block(self, name: str, i: int, future):
+        info = zipfile.ZipInfo(f"{name}/{i:06d}",
+                               date_time=(1980, 1, 1, 0, 0, 0))
+        self._zf.writestr(info, future.result())
+
+    def close(self):
+        header = {
+            "version": BLOCKED_FORMAT_VERSION,
+            "arrays": self._arrays,
+            "attrs": self.attrs,
+        }
+        try:
+            self._zf.writestr(FORMAT_MEMBER, json.dumps(header))
+        finally:
+            self._zf.close()
+            self._executor.shutdown()
+
+    def __enter__(self) -> "BlockedArchiveWriter":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class BlockedArchiveReader:
+    """Reads arrays written by a BlockedArchiveWriter.
+
+    Args:
+        fname: Path of the archive.
+        n_threads: Number of decompression threads. Defaults to the CPU count.
+    """
+
+    def __init__(self, fname: str, n_threads: Optional[int] = None):
+        self.n_threads = n_threads or os.cpu_count() or 1
+        self._zf = zipfile.ZipFile(fname)
+        header = json.loads(self._zf.read(FORMAT_MEMBER))
+        if header["version"] > BLOCKED_FORMAT_VERSION:
+            self._zf.close()
+            raise ValueError(
+                f"{fname} uses blocked format version {header['version']}, "
+                f"but only versions up to {BLOCKED_FORMAT_VERSION} are "
+                f"supported.")
+        self.version: int = header["version"]
+        self.arrays: Dict[str, Dict[str, Any]] = header["arrays"]
+        self.attrs: Dict[str, Any] = header["attrs"]
+
+    @staticmethod
+    def is_blocked_archive(fname: str) -> bool:
+        """Whether the file is a blocked archive (as opposed to a plain npz)."""
+        if not zipfile.is_zipfile(fname):
+            return False
+        with zipfile.ZipFile(fname) as zf:
+            return FORMAT_MEMBER in zf.namelist()
+
+    def read_array(self, name: str) -> np.ndarray:
+        """Read a whole array, decompressing its blocks in parallel."""
+        layout = self.arrays[name]
+        dtype = np.dtype(layout["dtype"])
+        shape = tuple(layout["shape"])
+        out = np.empty(shape or (1,), dtype=dtype, order=layout["order"])
+        self._read_blocks(name, range(len(layout["bounds"])), out, 0)
+        return out.reshape(shape, order=layout["order"])
+
+    def read_range(self, name: str, start: int, stop: int) -> np.ndarray:
+        """Read ``[start, stop)`` along the array's blocked axis.
+
+        Only the blocks overlapping the range are decompressed.
+        """
+        layout = self.arrays[name]
+        axis, bounds = layout["axis"], layout["bounds"]
+        shape = list(layout["shape"] or [1])
+        start, stop = max(start, 0), min(stop, shape[axis])
+        stop = max(start, stop)
+        blocks = [i for i, (a, b) in enumerate(bounds) if a < stop and b > start]
+        first = bounds[blocks[0]][0] if blocks else start
+        last = bounds[blocks[-1]][1] if blocks else start
+        shape[axis] = last - first
+        out = np.empty(shape, dtype=np.dtype(layout["dtype"]),
+                       order=layout["order"])
+        self._read_blocks(name, blocks, out, first)
+        return out[_block_index(out.ndim, axis, start - first, stop - first)]
+
+    def _read_blocks(self, name: str, blocks, out: np.ndarray, origin: int):
+        layout = self.arrays[name]
+        axis, order = layout["axis"], layout["order"]
+
+        def decompress(i: int):
+            start, stop = layout["bounds"][i]
+            index = _block_index(out.ndim, axis, start - origin, stop - origin)
+            target = out[index]
+            raw = zlib.decompress(self._zf.read(f"{name}/{i:06d}"))
+            target[...] = np.frombuffer(raw, dtype=out.dtype).reshape(
+                target.shape, order=order)
+
+        with ThreadPoolExecutor(self.n_threads) as executor:
+            # Iterate to surface exceptions raised in the workers.
+            for _ in executor.map(decompress, blocks):
+                pass
+
+    def close(self):
+        self._zf.close()
+
+    def __enter__(self) -> "BlockedArchiveReader":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class MaskedVolume:
+    """A 4D ``(x, y, z, t)`` volume stored as the voxels inside a mask.
+
+    Holds a boolean ``(x, y, z)`` mask and a dense ``(n_voxels, t)`` matrix of
+    the in-mask voxels, in the order ``data[mask]`` would produce them.
+    Indexing reconstructs only the requested timepoints, so ``vol[..., t]``
+    never builds the full 4D array; ``np.asarray(vol)`` does.
+
+    Args:
+        mask: Boolean array of the volume's spatial shape.
+        data: Array of shape ``(mask.sum(), t)``.
+        fill_value: Value of voxels outside the mask.
+    """
+
+    def __init__(self, mask: np.ndarray, data: np.ndarray,
+                 fill_value: float = 0):
+        mask = np.asarray(mask, dtype=bool)
+        if data.ndim != 2 or data.shape[0] != np.count_nonzero(mask):
+            raise ValueError(
+                f"Expected data of shape ({np.count_nonzero(mask)}, t) for "
+                f"the mask, got {data.shape}")
+        self.mask = mask
+        self.data = data
+        self.fill_value = fill_value
+
+    @classmethod
+    def from_dense(cls, volume: np.ndarray,
+                   mask: Optional[np.ndarray] = None) -> "MaskedVolume":
+        """Build a MaskedVolume from a dense ``(x, y, z, t)`` array.
+
+        If no mask is given, voxels that are zero at every timepoint (e.g.
+        outside a skull-stripped brain) are masked out.
+        """
+        if volume.ndim != 4:
+            raise ValueError(
+                f"Masked volumes must have 4 dimensions but got {volume.ndim}")
+        if mask is None:
+            mask = np.any(volume != 0, axis=-1)
+        mask = np.asarray(mask, dtype=bool)
+        if mask.shape != volume.shape[:3]:
+            raise ValueError(f"Mask shape {mask.shape} does not match volume "
+                             f"shape {volume.shape[:3]}")
+        return cls(mask, volume[mask])
+
+    @property
+    def shape(self) -> Tuple[int, ...]:
+        return self.mask.shape + (self.data.shape[1],)
+
+    @property
+    def ndim(self) -> int:
+        return 4
+
+    @property
+    def dtype(self) -> np.dtype:
+        return self.data.dtype
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def _volumes(self, time_index) -> np.ndarray:
+        data = self.data[:, time_index]
+        out = np.full(self.mask.shape + data.shape[1:], self.fill_value,
+                      dtype=self.data.dtype)
+        out[self.mask] = data
+        return out
+
+    def __getitem__(self, index) -> np.ndarray:
+        if not isinstance(index, tuple):
+            index = (index,)
+        if any(i is Ellipsis for i in index):
+            i = index.index(Ellipsis)
+            fill = (slice(None),) * (4 - len(index) + 1)
+            index = index[:i] + fill + index[i + 1:]
+        index = index + (slice(None),) * (4 - len(index))
+        spatial, time_index = index[:3], index[3]
+        volumes = self._volumes(time_index)
+        if np.ndim(time_index) == 0 and not isinstance(time_index, slice):
+            return volumes[spatial]
+        return volumes[spatial + (slice(None),)]
+
+    def to_dense(self) -> np.ndarray:
+        """Reconstruct the full 4D array."""
+        return self._volumes(slice(None))
+
+    def __array__(self, dtype=None, copy=None) -> np.ndarray:
+        dense = self.to_dense()
+        return dense if dtype is None else dense.astype(dtype, copy=False)
+
+    def __repr__(self) -> str:
+        return (f"MaskedVolume(shape={self.shape}, "
+                f"n_voxels={self.data.shape[0]}, dtype={self.dtype})")
@@ -0,0 +1,172 @@
+"""
+Views: derived payloads stored as a reference to a parent plus operations.
+
+Many transforms only crop, pick channels, mark bad channels, rescale or
+re-reference a recording, yet storing their output writes a full copy of
+it. A transform can instead return a View, which is stored as a small JSON
+descriptor (a ".view" file) naming the parent timecourse and a list of
+cheap operations. Retrieving the view retrieves the parent's payload and
+applies the operations to it. The view's timecourse, lineage and
+TransformData are recorded as for any other output.
+
+Operations are dicts with an "op" name, built with the functions below,
+and apply to numpy arrays (whose time axis is the last) and MNE Raw
+objects:
+
+    View.of(parent, crop(0, 1000), pick(["Fz", "Cz"]), mark_bad(["Cz"]))
+"""
+from typing import Any, Callable, Dict, List, Optional, Sequence, Union
+
+import dataclasses
+import json
+
+import mne
+import numpy as np
+
+from ..models import Timecourse
+
+
+Operation = Dict[str, Any]
+
+
+def crop(start: Optional[int] = None, stop: Optional[int] = None
+         ) -> Operation:
+    """Keep samples ``[start, stop)`` of the time axis."""
+    return {"op": "crop", "start": start, "stop": stop}
+
+
+def pick(channels: Sequence[Union[int, str]]) -> Operation:
+    """Keep the given channels (names for Raw, first-axis indices for arrays)."""
+    return {"op": "pick", "channels": list(channels)}
+
+
+def scale(factor: float) -> Operation:
+    """Multiply the data by a factor."""
+    return {"op": "scale", "factor": float(factor)}
+
+
+def mark_bad(channels: Sequence[str]) -> Operation:
+    """Add channels to a Raw's bad channels."""
+    return {"op": "mark_bad", "channels": list(channels)}
+
+
+def annotate(onset: Sequence[float], duration: Sequence[float],
+             description: Sequence[str]) -> Operation:
+    """Add annotations, in seconds from the start of the Raw."""
+    return {"op": "annotate", "onset": [float(o) for o in onset],
+            "duration": [float(d) for d in duration],
+            "description": list(description)}
+
+
+def set_reference(channels: Union[str, Sequence[str]] = "average"
+                  ) -> Operation:
+    """Re-reference a Raw's EEG channels ("average" or channel names)."""
+    if not isinstance(channels, str):
+        channels = list(channels)
+    return {"op": "set_reference", "channels": channels}
+
+
+def _crop(payload: Any, start: Optional[int], stop: Optional[int]) -> Any:
+    if isinstance(payload, mne.io.BaseRaw):
+        start, stop, _ = slice(start, stop).indices(payload.n_times)
+        if stop <= start:
+            raise ValueError(f"Empty crop [{start}, {stop}).")
+        return payload.crop(tmin=payload.times[start],
+                            tmax=payload.times[stop - 1],
+                            include_tmax=True)
+    return payload[..., start:stop]
+
+
+def _pick(payload: Any, channels: List[Union[int, str]]) -> Any:
+    if isinstance(payload, mne.io.BaseRaw):
+        return payload.pick(channels)
+    return payload[channels]
+
+
+def _scale(payload: Any, factor: float) -> Any:
+    if isinstance(payload, mne.io.BaseRaw):
+        payload._data *= factor
+        return payload
+    return payload * factor
+
+
+def _mark_bad(payload: mne.io.BaseRaw, channels: List[str]
+              ) -> mne.io.BaseRaw:
+    payload.info["bads"] = sorted(set(payload.info["bads"]) | set(channels))
+    return payload
+
+
+def _annotate(payload: mne.io.BaseRaw, onset: List[float],
+              duration: List[float], description: List[str]
+              ) -> mne.io.BaseRaw:
+    added = mne.Annotations(onset, duration, description,
+                            orig_time=payload.annotations.orig_time)
+    return payload.set_annotations(payload.annotations + added)
+
+
+def _set_reference(payload: mne.io.BaseRaw,
+                   channels: Union[str, List[str]]) -> mne.io.BaseRaw:
+    payload.set_eeg_reference(channels, verbose=False)
+    return payload
+
+
+_OPERATIONS: Dict[str, Callable[..., Any]] = {
+    "crop": _crop,
+    "pick": _pick,
+    "scale": _scale,
+    "mark_bad": _mark_bad,
+    "annotate": _annotate,
+    "set_reference": _set_reference,
+}
+# Operations that only make sense for MNE Raw payloads.
+_RAW_ONLY = {"mark_bad", "annotate", "set_reference"}
+
+
+@dataclasses.dataclass
+class View:
+    """A payload defined as operations applied to a parent's payload.
+
+    Attributes:
+        parent_id: The id of the parent timecourse, which must be committed.
+        ops: The operations, applied in order.
+    """
+    parent_id: int
+    ops: List[Operation] = dataclasses.field(default_factory=list)
+
+    def __post_init__(self):
+        for op in self.ops:
+            if op.get("op") not in _OPERATIONS:
+                raise ValueError(f"Unknown view operation {op!r}.")
+
+    @classmethod
+    def of(cls, parent: Timecourse, *ops: Operation) -> 'View':
+        """A view of a (committed) timecourse."""
+        if parent.id is None:
+            raise ValueError("Views can only be taken of committed "
+                             "timecourses.")
+        return cls(parent.id, list(ops))
+
+    def apply(self, payload: Any) -> Any:
+        """Apply the operations to the parent's (freshly retrieved) payload.
+
+        Raises:
+            TypeError: If an operation doesn't apply to the payload's type.
+        """
+        for op in self.ops:
+            name = op["op"]
+            is_raw = isinstance(payload, mne.io.BaseRaw)
+            if not (is_raw or isinstance(payload, np.ndarray)) or (
+                    name in _RAW_ONLY and not is_raw):
+                raise TypeError(f"Can't apply {name} to a "
+                                f"{type(payload).__name__} payload.")
+            args = {k: v for k, v in op.items() if k != "op"}
+            payload = _OPERATIONS[name](payload, **args)
+        return payload
+
+    def to_json(self) -> str:
+        return json.dumps({"parent_id": self.parent_id, "ops": self.ops})
+
+    @classmethod
+    def from_json(cls, text: str) -> 'View':
+        descriptor = json.loads(text)
+        return cls(descriptor["parent_id"], descriptor["ops"])
@@ -1,8 +1,55 @@
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker
-from ..models import Base
+from ..models import Base, Data, DataType, Modality, Study, Subject
+from ..models import Timecourse, TransformData
+from ..storage import LocalStorageManager
+from ..transforms import Transform
 
+from datetime import datetime
+import functools
+import numpy as np
 import pytest
+import subprocess
+
+FMRI = Data(sampling_rate=1.0, modality=Modality.IMAGING, type=DataType.FMRI)
+
+
+# Transforms run in spawned worker processes are pickled by reference, so
+# they must be importable (expdb.tests.conftest).
+class ScaleTransform(Transform):
+    input_datatype = FMRI
+    output_datatype = FMRI
+
+    def transform(self, data):
+        if data[0][0, 0, 0, 0] == self.params.get("fail_on"):
+            raise ValueError("Refusing to scale this timecourse")
+        # In place, which transforms may do to their input.
+        data[0] *= self.params["factor"]
+        data[0] += self.params.get("offset", 0)
+        return data[0]
+
+
+def add_roots(session, storage_manager, values, study=None, subject=None):
+    """Store and commit an FMRI upload filled with each value."""
+    if study is None:
+        study = Study(name="test_study", github_repo="test/repo")
+    if subject is None:
+        subject = Subject(name="Testy McTesterson", code="TT",
+                          age=20, meditation_experience=5)
+    roots = []
+    for i, value in enumerate(values):
+        payload = np.full((2, 2, 2, 3), value, dtype=np.float32)
+        tc = Timecourse(study=study, subject=subject, data=FMRI,
+                        is_pilot=False,
+                        transform=TransformData("[]", "[]", "abc1234"),
+                        date_collected=datetime(2024, 1, 1, 12, 0, i))
+        tc.path = storage_manager.get_uri_from_data(tc, payload)
+        storage_manager.store(tc, payload)
+        session.add(tc)
+        roots.append(tc)
+    session.commit()
+    return roots
+
 
 # Use an in-memory SQLite database for fast tests
 @pytest.fixture(scope="session")
@@ -24,3 +71,43 @@ def session(engine, tables):
     session = Session()
     yield session
     session.close()
+
+# Derivations are only reused from a clean git checkout (see
+# Transform.derivation_key), so tests run in one rather than in whatever
+# state the working tree is in. Worker processes inherit the directory.
+@pytest.fixture(scope="session")
+def git_checkout(tmp_path_factory):
+    path = tmp_path_factory.mktemp("checkout")
+    (path / "README").write_text("expdb tests\n")
+    for args in (["init", "-q"], ["add", "-A"],
+                 ["commit", "-q", "-m", "initial"]):
+        subprocess.run(["git", "-c", "user.name=test", "-c",
+                        "user.email=t@t", *args],
+                       cwd=path, check=True, capture_output=True)
+    return path
+
+@pytest.fixture(autouse=True)
+def in_git_checkout(git_checkout, monkeypatch):
+    monkeypatch.chdir(git_checkout)
+
+# A database in a file, which worker processes can open too.
+@pytest.fixture
+def file_engine(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'expdb.sqlite'}")
+    Base.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+@pytest.fixture
+def file_session(file_engine):
+    session = sessionmaker(bind=file_engine)()
+    yield session
+    session.close()
+
+@pytest.fixture
+def storage_root(tmp_path):
+    return str(tmp_path / "files")
+
+@pytest.fixture
+def storage_factory(storage_root):
+    return functools.partial(LocalStorageManager, file_root=storage_root)
@@ -0,0 +1,64 @@
+import pytest
+import os
+import numpy as np
+import pandas as pd
+import mne
+from concurrent.futures import ThreadPoolExecutor
+
+from ..utils import data_utils as du
+
+
+@pytest.fixture
+def raw():
+    info = mne.create_info(["Fz", "Cz"], sfreq=100.0, ch_types="eeg")
+    return mne.io.RawArray(np.random.randn(2, 500) * 1e-6, info, verbose=False)
+
+def test_sniff_format(tmp_path, raw):
+    npz_path = str(tmp_path / "arrays.bin")
+    with open(npz_path, "wb") as f:
+        np.savez(f, a=np.arange(3))
+    parquet_path = str(tmp_path / "table.bin")
+    pd.DataFrame({"a": [1, 2]}).to_parquet(parquet_path)
+    fif_path = str(tmp_path / "data_raw.fif")
+    raw.save(fif_path, verbose=False)
+
+    # Formats are recognized by content, whatever the file is called.
+    assert du.sniff_format(npz_path) == "npz"
+    assert du.sniff_format(parquet_path) == "parquet"
+    assert du.sniff_format(fif_path) == "fif"
+
+    unknown = tmp_path / "unknown.txt"
+    unknown.write_text("hello")
+    assert du.sniff_format(str(unknown)) is None
+    with pytest.raises(ValueError):
+        du.load_data_from_local(str(unknown))
+
+def test_load_data_from_local(tmp_path, raw):
+    npz_path = str(tmp_path / "arrays.npz")
+    np.savez(npz_path, a=np.arange(3), b=np.ones(2))
+    data = du.load_data_from_local(npz_path)
+    assert sorted(data) == ["a", "b"]
+    np.testing.assert_array_equal(data["a"], np.arange(3))
+
+    fif_path = str(tmp_path / "data_raw.fif")
+    raw.save(fif_path, verbose=False)
+    loaded = du.load_data_from_local(fif_path)
+    np.testing.assert_allclose(loaded.get_data(), raw.get_data())
+
+def test_bytes_to_data_concurrent():
+    """Concurrent decodes must not share scratch files."""
+    frames = [pd.DataFrame({"value": np.arange(100) + i}) for i in range(16)]
+
+    def round_trip(df):
+        return du.bytes_to_data(df.to_parquet(), "parquet")
+
+    with ThreadPoolExecutor(8) as executor:
+        results = list(executor.map(round_trip, frames))
+    for df, result in zip(frames, results):
+        pd.testing.assert_frame_equal(df, result)
+
+def test_scratch_file_is_removed():
+    with du.scratch_file(suffix=".bdf") as path:
+        assert os.path.exists(path)
+        assert path.endswith(".bdf")
+    assert not os.path.exists(path)
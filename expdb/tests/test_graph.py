@@ -0,0 +1,141 @@
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from ..models import Data, DataType, Modality, Timecourse, TransformData
+from ..models import Study, Subject
+from ..storage import LocalStorageManager
+from ..transforms import (GraphNode, GraphScheduler, Transform,
+                          TransformGraph)
+from . import conftest
+from .conftest import FMRI, ScaleTransform, add_roots
+
+
+BEHAVIOR = Data(sampling_rate=0.0, modality=Modality.BEHAVIORAL,
+                type=DataType.INPUT_RESPONSE)
+
+
+# Defined at module level, to be importable by the worker processes.
+class GraphJoin(Transform):
+    input_datatype = FMRI
+    output_datatype = FMRI
+
+    def transform(self, data):
+        volumes, events = data
+        return volumes + len(events)
+
+
+def add_subject(session, storage_manager, study, code, value,
+                behavior=True):
+    subject = Subject(name=f"Subject {code}", code=code, age=20,
+                      meditation_experience=5)
+    if behavior:
+        payload = pd.DataFrame({"onset": [1.0, 2.5]})
+        tc = Timecourse(study=study, subject=subject, data=BEHAVIOR,
+                        is_pilot=False,
+                        transform=TransformData("[]", "[]", "abc1234"),
+                        date_collected=datetime(2024, 1, 1, 12, 1, 0))
+        tc.path = storage_manager.get_uri_from_data(tc, payload)
+        session.add(tc)
+        storage_manager.store(tc, payload)
+    add_roots(session, storage_manager, [value], study=study,
+              subject=subject)
+    return subject
+
+
+def make_graph(**scale_params):
+    return TransformGraph(
+        sources={"fmri": DataType.FMRI, "behavior": DataType.INPUT_RESPONSE},
+        nodes={
+            "joined": GraphNode(GraphJoin, ["scaled", "behavior"]),
+            "scaled": GraphNode(ScaleTransform, ["fmri"],
+                                {"factor": 2.0, **scale_params}),
+            "tripled": GraphNode(ScaleTransform, ["fmri"], {"factor": 3.0}),
+        })
+
+
+def test_graph_runs_every_subject(file_session, storage_factory):
+    storage_manager = storage_factory()
+    study = Study(name="graph_study", github_repo="test/repo")
+    subjects = [add_subject(file_session, storage_manager, study, code, value)
+                for code, value in [("AA", 1.0), ("BB", 5.0)]]
+    messages = []
+    scheduler = GraphScheduler(
+        make_graph(), file_session.query(Subject), study=study,
+        storage_manager_factory=storage_factory, n_workers=2,
+        progress=messages.append)
+    report = scheduler.run()
+
+    assert not report.failed and not report.skipped
+    assert len(report.created) == 6
+    assert len(messages) == 6
+    joined = report.outputs("joined")
+    for subject, value in zip(subjects, [1.0, 5.0]):
+        child = file_session.get(Timecourse, joined[subject.id])
+        assert report.outputs("scaled")[subject.id] in [
+            parent.id for parent in child.derived_from]
+        np.testing.assert_array_equal(storage_manager.retrieve(child),
+                                      np.full((2, 2, 2, 3), value * 2 + 2))
+
+    again = GraphScheduler(make_graph(), file_session.query(Subject),
+                           storage_manager_factory=storage_factory,
+                           n_workers=2, progress=None).run()
+    assert not again.created
+    assert again.reused == report.created
+    assert file_session.query(Timecourse).count() == 10
+
+
+def test_graph_skips_downstream_of_failures(session, tmp_path):
+    storage_manager = LocalStorageManager(file_root=str(tmp_path))
+    study = Study(name="graph_study", github_repo="test/repo")
+    failing = add_subject(session, storage_manager, study, "AA", 1.0)
+    unmatched = add_subject(session, storage_manager, study, "BB", 5.0,
+                            behavior=False)
+    report = GraphScheduler(
+        make_graph(fail_on=1.0), session.query(Subject),
+        storage_manager_factory=lambda: storage_manager, n_workers=0,
+        progress=None).run()
+
+    assert list(report.failed) == [(failing.id, "scaled")]
+    assert "Refusing to scale" in report.failed[(failing.id, "scaled")]
+    assert report.skipped == {
+        (failing.id, "joined"): "input scaled was not computed",
+        (unmatched.id, "joined"): "no behavior source",
+    }
+    assert sorted(report.created) == [(failing.id, "tripled"),
+                                      (unmatched.id, "scaled"),
+                                      (unmatched.id, "tripled")]
+
+    # Only what the targets need runs.
+    report = GraphScheduler(
+        make_graph(factor=4.0), [unmatched], session=session,
+        storage_manager_factory=lambda: storage_manager, n_workers=0,
+        progress=None).run(targets=["scaled"])
+    assert list(report.created) == [(unmatched.id, "scaled")]
+
+
+def test_graph_spec_is_validated():
+    spec = {
+        "sources": {"fmri": "FMRI"},
+        "nodes": {
+            "a": {"transform": "ScaleTransform", "inputs": ["fmri"],
+                  "params": {"factor": 2.0}},
+            "b": {"transform": f"{conftest.__name__}:ScaleTransform",
+                  "inputs": ["a"], "params": {"factor": 2.0}},
+        },
+    }
+    graph = TransformGraph.from_spec(spec)
+    assert graph.order == ["a", "b"]
+    assert graph.nodes["b"].transform_cls is ScaleTransform
+    assert graph.required(["a"]) == ["a"]
+
+    spec["nodes"]["a"]["inputs"] = ["b"]
+    with pytest.raises(ValueError, match="cycle"):
+        TransformGraph.from_spec(spec)
+    with pytest.raises(ValueError, match="unknown inputs"):
+        TransformGraph({}, {"a": GraphNode(ScaleTransform, ["fmri"])})
+    with pytest.raises(ValueError, match="takes"):
+        TransformGraph({"events": DataType.INPUT_RESPONSE},
+                       {"a": GraphNode(ScaleTransform, ["events"])})
@@ -0,0 +1,59 @@
+import pytest
+import gzip
+import struct
+import numpy as np
+
+from ..storage import format as fmt
+from ..utils import ingest
+
+
+def write_nifti(path, data, tr=2.0, slope=0.0, inter=0.0, compress=False):
+    """Write a minimal single-file NIfTI-1 volume."""
+    header = bytearray(352)
+    struct.pack_into("<i", header, 0, 348)
+    dim = [data.ndim] + list(data.shape) + [1] * (7 - data.ndim)
+    struct.pack_into("<8h", header, 40, *dim)
+    code = {v: k for k, v in ingest.NIFTI_DTYPES.items()}[data.dtype.type]
+    struct.pack_into("<2h", header, 70, code, data.dtype.itemsize * 8)
+    struct.pack_into("<8f", header, 76, 1, 1, 1, 1, tr, 1, 1, 1)
+    struct.pack_into("<3f", header, 108, 352, slope, inter)
+    header[123] = 0x08 | 0x02  # seconds, millimeters
+    header[344:348] = b"n+1\x00"
+    content = bytes(header) + data.tobytes(order="F")
+    opener = gzip.open if compress else open
+    with opener(path, "wb") as f:
+        f.write(content)
+
+@pytest.mark.parametrize("compress", [False, True])
+def test_nifti_plugin_memory_maps(tmp_path, compress):
+    data = np.random.rand(4, 5, 3, 10).astype(np.float32)
+    path = str(tmp_path / ("scan.nii.gz" if compress else "scan.nii"))
+    write_nifti(path, data, tr=2.0, compress=compress)
+
+    assert ingest.get_plugin(path) is ingest.NiftiPlugin
+    with ingest.NiftiPlugin(path) as plugin:
+        volume = plugin.load()
+        assert isinstance(volume, np.memmap)
+        assert plugin.sampling_rate == pytest.approx(0.5)
+        np.testing.assert_array_equal(volume, data)
+
+        # Converting to the storage format works block by block.
+        fname = str(tmp_path / "converted.npz")
+        serializer = fmt.FMRIPayloadSerializer(block_bytes=4 * 5 * 3 * 4)
+        serializer.to_file(fname, volume)
+        np.testing.assert_array_equal(serializer.from_file(fname), data)
+
+def test_nifti_plugin_applies_scaling(tmp_path):
+    data = np.arange(4 * 4 * 2 * 6, dtype=np.int16).reshape(4, 4, 2, 6)
+    path = str(tmp_path / "scaled.nii")
+    write_nifti(path, data, slope=0.5, inter=10.0)
+
+    with ingest.NiftiPlugin(path) as plugin:
+        volume = plugin.load()
+        assert volume.dtype == np.float32
+        np.testing.assert_allclose(volume, data * 0.5 + 10.0)
+
+def test_unknown_format_has_no_plugin(tmp_path):
+    path = tmp_path / "notes.txt"
+    path.write_text("not a scan")
+    assert ingest.get_plugin(str(path)) is None
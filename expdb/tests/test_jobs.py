@@ -0,0 +1,107 @@
+import multiprocessing
+from datetime import timedelta
+
+import numpy as np
+from sqlalchemy.orm import sessionmaker
+
+from ..models import JobStatus, Timecourse, TransformJob
+from ..storage import LocalStorageManager
+from ..transforms import QueueWorker, enqueue
+from ..transforms import jobs
+from . import conftest
+from .conftest import ScaleTransform, add_roots
+
+
+def test_claims_are_exclusive(file_engine):
+    Session = sessionmaker(bind=file_engine)
+    with Session() as session:
+        enqueue(session, ScaleTransform, [1, 2], factor=2.0)
+    with Session() as a, Session() as b:
+        first = jobs.claim_job(a, "a")
+        second = jobs.claim_job(b, "b")
+        assert {first.id, second.id} == {1, 2}
+        assert first.status == JobStatus.RUNNING and first.attempts == 1
+        assert jobs.claim_job(a, "a") is None
+
+
+def test_worker_runs_jobs(file_engine, storage_factory):
+    Session = sessionmaker(bind=file_engine)
+    storage_manager = storage_factory()
+    with Session() as session:
+        roots = [tc.id for tc in add_roots(session, storage_manager,
+                                           range(2))]
+        enqueued = [job.id for job in
+                    enqueue(session, ScaleTransform, roots, factor=2.0)]
+        (failing,) = [job.id for job in
+                      enqueue(session, ScaleTransform, roots[:1],
+                              max_attempts=2, factor=2.0, fail_on=0.0)]
+
+    worker = QueueWorker(Session, storage_manager, worker_id="w",
+                         heartbeat_interval=0.05, dead_after=60)
+    # The failing job is tried twice.
+    assert worker.run(stop_when_empty=True) == 4
+
+    with Session() as session:
+        for job_id, root_id in zip(enqueued, roots):
+            job = session.get(TransformJob, job_id)
+            assert job.status == JobStatus.DONE
+            np.testing.assert_array_equal(
+                storage_manager.retrieve(job.output_timecourse),
+                storage_manager.retrieve(session.get(Timecourse, root_id))
+                * 2.0)
+        job = session.get(TransformJob, failing)
+        assert job.status == JobStatus.FAILED
+        assert job.attempts == 2
+        assert "Refusing to scale" in job.error
+
+
+def test_dead_workers_jobs_are_requeued(file_engine):
+    Session = sessionmaker(bind=file_engine)
+    with Session() as session:
+        enqueue(session, ScaleTransform, [1, 2], factor=2.0, max_attempts=1)
+        enqueue(session, ScaleTransform, [3], factor=2.0)
+        for worker_id in ("dead", "dead", "alive"):
+            jobs.claim_job(session, worker_id)
+        stale = jobs._utcnow() - timedelta(minutes=5)
+        for job in session.query(TransformJob).filter(
+                TransformJob.worker_id == "dead"):
+            job.heartbeat_at = stale
+        session.query(TransformJob).filter(
+            TransformJob.id == 3).one().heartbeat_at = stale
+        session.commit()
+
+        assert jobs.requeue_dead_jobs(session, timeout=60) == 3
+        statuses = {job.id: job.status for job in session.query(TransformJob)}
+        # Jobs 1 and 2 used their only attempt.
+        assert statuses == {1: JobStatus.FAILED, 2: JobStatus.FAILED,
+                            3: JobStatus.QUEUED}
+
+
+def _run_worker(url, storage_root):
+    jobs.main(["--database-url", url, "--storage-root", storage_root,
+               "--import", conftest.__name__, "--stop-when-empty",
+               "--heartbeat-interval", "0.5", "--dead-after", "60"])
+
+
+def test_workers_in_parallel(file_engine, storage_root):
+    url = file_engine.url.render_as_string(hide_password=False)
+    Session = sessionmaker(bind=file_engine)
+    storage_manager = LocalStorageManager(file_root=storage_root)
+    with Session() as session:
+        roots = add_roots(session, storage_manager, range(6))
+        enqueue(session, ScaleTransform, roots, factor=3.0)
+
+    context = multiprocessing.get_context("spawn")
+    workers = [context.Process(target=_run_worker, args=(url, storage_root))
+               for _ in range(2)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join(60)
+        assert worker.exitcode == 0
+
+    with Session() as session:
+        done = session.query(TransformJob).filter(
+            TransformJob.status == JobStatus.DONE).all()
+        assert len(done) == 6
+        assert len({job.output_timecourse_id for job in done}) == 6
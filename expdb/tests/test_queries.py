@@ -6,7 +6,9 @@ from sqlalchemy.orm import sessionmaker
 from ..models import (
     Study, Subject, Timecourse, Data, Modality, DataType, TransformData
 )
-from ..lib.queries import get_latest_timecourses_by_modality
+from ..lib.benchmarks import benchmark_latest, build_synthetic_study
+from ..lib.queries import (_find_original_upload, get_latest_timecourses,
+                           get_latest_timecourses_by_modality)
 
 def create_timecourse(session, subject, study, modality, type_, sampling_rate,
                      path, date_collected, transform_names=None,
@@ -181,4 +183,63 @@ def test_get_latest_timecourses_no_derivatives(session):
     )
     
     assert len(latest) == 1
-    assert latest[0] == upload 
\ No newline at end of file
+    assert latest[0] == upload 
+
+
+def test_get_latest_timecourses_for_a_study(session, test_data):
+    """Test getting latest timecourses for many subjects in one query"""
+    study = test_data['study']
+    base_time = datetime(2024, 1, 1, 12, 0)
+    other = Subject(name="Other Subject", code="OS", age=30,
+                    meditation_experience=0)
+    other_upload = create_timecourse(
+        session, other, study, Modality.IMAGING, DataType.EEG, 256.0,
+        "/data/other_upload.eeg", base_time)
+    # Derivatives of another data type don't continue the upload's chain.
+    fmri = create_timecourse(
+        session, other, study, Modality.IMAGING, DataType.FMRI, 1.0,
+        "/data/other_fmri.npy", base_time + timedelta(hours=1))
+    fmri.derived_from.append(other_upload)
+    past_fmri = create_timecourse(
+        session, other, study, Modality.IMAGING, DataType.EEG, 256.0,
+        "/data/other_past_fmri.eeg", base_time + timedelta(hours=2))
+    past_fmri.derived_from.append(fmri)
+    # A derivative of both EEG uploads is the latest of each.
+    merged = create_timecourse(
+        session, test_data['subject'], study, Modality.IMAGING,
+        DataType.EEG, 256.0, "/data/merged.eeg",
+        base_time + timedelta(days=2))
+    merged.derived_from.append(test_data['eeg_proc1'])
+    merged.derived_from.append(test_data['eeg_upload2'])
+    session.commit()
+
+    latest = get_latest_timecourses(session, Modality.IMAGING, study=study)
+    assert [(row.upload_id, row.timecourse.id) for row in latest] == [
+        (test_data['eeg_upload1'].id, merged.id),
+        (test_data['eeg_upload2'].id, merged.id),
+        (other_upload.id, other_upload.id),
+    ]
+    assert latest[-1].subject_id == other.id
+    assert get_latest_timecourses_by_modality(
+        session, test_data['subject'], Modality.IMAGING) == [merged]
+    assert [row.timecourse for row in get_latest_timecourses(
+        session, Modality.IMAGING, subjects=[other.id])] == [other_upload]
+
+
+def test_benchmark_study_matches_parent_walk(session):
+    """Test the set-based query against walking up each timecourse's parents"""
+    study = build_synthetic_study(session, 3, uploads_per_subject=2, depth=4,
+                                  merge_rate=0.0)
+    expected = {}
+    for tc in session.query(Timecourse).filter(
+            Timecourse.modality == Modality.IMAGING):
+        upload = _find_original_upload(tc)
+        best = expected.get(upload.id)
+        if best is None or tc.date_collected > best.date_collected:
+            expected[upload.id] = tc
+
+    latest = get_latest_timecourses(session, Modality.IMAGING, study=study)
+    assert {row.upload_id: row.timecourse for row in latest} == expected
+    results = benchmark_latest(session, study, repeats=1)
+    assert results["study"]["statements"] == 1
+    assert results["per_subject"]["statements"] == 3
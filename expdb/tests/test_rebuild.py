@@ -0,0 +1,165 @@
+import importlib
+import subprocess
+import sys
+import uuid
+
+import numpy as np
+import pytest
+
+from ..models import Timecourse
+from ..transforms import Rebuilder
+from .conftest import add_roots
+
+
+TRANSFORMS_SOURCE = '''
+from expdb.models import Data, DataType, Modality
+from expdb.transforms import Transform
+
+FMRI = Data(sampling_rate=1.0, modality=Modality.IMAGING, type=DataType.FMRI)
+
+
+class RebuildScale(Transform):
+    input_datatype = FMRI
+    output_datatype = FMRI
+
+    def transform(self, data):
+        return data[0] * {factor}
+'''
+
+OFFSET_SOURCE = '''
+from expdb.models import Data, DataType, Modality
+from expdb.transforms import Transform
+
+FMRI = Data(sampling_rate=1.0, modality=Modality.IMAGING, type=DataType.FMRI)
+
+
+class RebuildOffset(Transform):
+    input_datatype = FMRI
+    output_datatype = FMRI
+
+    def transform(self, data):
+        return data[0] + self.params["offset"]
+'''
+
+
+def git(repo, *args):
+    subprocess.run(["git", "-c", "user.name=test", "-c", "user.email=t@t",
+                    *args], cwd=repo, check=True, capture_output=True)
+
+
+class Repo:
+    """A git repository of transform modules, importable by workers."""
+
+    def __init__(self, path, monkeypatch):
+        self.path = path
+        self.prefix = f"rebuild_{uuid.uuid4().hex[:8]}"
+        git(path, "init", "-q")
+        monkeypatch.chdir(path)
+        monkeypatch.syspath_prepend(str(path))
+
+    def write(self, name, source):
+        (self.path / f"{self.prefix}_{name}.py").write_text(source)
+        git(self.path, "add", "-A")
+        git(self.path, "commit", "-q", "-m", f"update {name}")
+        module_name = f"{self.prefix}_{name}"
+        if module_name in sys.modules:
+            return importlib.reload(sys.modules[module_name])
+        return importlib.import_module(module_name)
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    path = tmp_path / "analysis"
+    path.mkdir()
+    return Repo(path, monkeypatch)
+
+
+def derive(transform_cls, parent, storage_manager, **params):
+    transform = transform_cls(parent, None, storage_manager=storage_manager,
+                              **params)
+    new_timecourse = transform.apply_transform()
+    transform.commit()
+    return new_timecourse
+
+
+def build_tree(repo, session, storage_manager):
+    scale = repo.write("scale", TRANSFORMS_SOURCE.format(factor=2.0))
+    offset = repo.write("offset", OFFSET_SOURCE)
+    root, = add_roots(session, storage_manager, [1.5])
+    payload = np.asarray(storage_manager.retrieve(root))
+    scaled = derive(scale.RebuildScale, root, storage_manager)
+    shifted = derive(offset.RebuildOffset, scaled, storage_manager,
+                     offset=1.0)
+    sibling = derive(offset.RebuildOffset, root, storage_manager, offset=1.0)
+    return root, payload, scaled, shifted, sibling
+
+
+def test_rebuild_after_code_change(repo, session, storage_factory):
+    storage_manager = storage_factory()
+    root, payload, scaled, shifted, sibling = build_tree(repo, session,
+                                                         storage_manager)
+    query = session.query(Timecourse).filter(Timecourse.id == root.id)
+
+    report = Rebuilder(query, storage_manager_factory=storage_factory,
+                       n_workers=0, progress=None).run()
+    assert not report.stale
+    assert set(report.skipped) == {scaled.id, shifted.id, sibling.id}
+
+    repo.write("scale", TRANSFORMS_SOURCE.format(factor=3.0))
+    report = Rebuilder(query, storage_manager_factory=storage_factory,
+                       n_workers=0, progress=None).run()
+
+    assert set(report.stale) == {scaled.id, shifted.id}
+    assert "scale.py changed" in report.stale[scaled.id]
+    assert report.skipped == {sibling.id: "up to date"}
+    assert not report.failed
+    new_shifted = session.get(Timecourse, report.rebuilt[shifted.id])
+    assert new_shifted.derived_from.all() == [
+        session.get(Timecourse, report.rebuilt[scaled.id])]
+    np.testing.assert_array_equal(storage_manager.retrieve(new_shifted),
+                                  payload * 3.0 + 1.0)
+
+    # Rebuilding again reuses the replacements.
+    count = session.query(Timecourse).count()
+    again = Rebuilder(query, storage_manager_factory=storage_factory,
+                      n_workers=0, progress=None).run()
+    assert again.rebuilt == report.rebuilt
+    assert session.query(Timecourse).count() == count
+
+
+def test_rebuild_after_param_change(repo, session, storage_factory):
+    storage_manager = storage_factory()
+    root, payload, scaled, shifted, sibling = build_tree(repo, session,
+                                                         storage_manager)
+    query = session.query(Timecourse).filter(Timecourse.id == root.id)
+
+    rebuilder = Rebuilder(query, params={"RebuildOffset": {"offset": 5.0}},
+                          storage_manager_factory=storage_factory,
+                          n_workers=0, progress=None)
+    report, _ = rebuilder.plan()
+    assert set(report.stale) == {shifted.id, sibling.id}
+    assert report.skipped == {scaled.id: "up to date"}
+
+    report = rebuilder.run()
+    np.testing.assert_array_equal(
+        storage_manager.retrieve(
+            session.get(Timecourse, report.rebuilt[shifted.id])),
+        payload * 2.0 + 5.0)
+
+
+def test_rebuild_in_parallel(repo, file_session, storage_factory):
+    session = file_session
+    storage_manager = storage_factory()
+    root, payload, scaled, shifted, sibling = build_tree(repo, session,
+                                                         storage_manager)
+
+    repo.write("scale", TRANSFORMS_SOURCE.format(factor=3.0))
+    report = Rebuilder(session.query(Timecourse),
+                       storage_manager_factory=storage_factory, n_workers=2,
+                       progress=None).run()
+
+    assert set(report.rebuilt) == {scaled.id, shifted.id}
+    np.testing.assert_array_equal(
+        storage_manager.retrieve(
+            session.get(Timecourse, report.rebuilt[shifted.id])),
+        payload * 3.0 + 1.0)
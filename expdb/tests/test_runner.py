@@ -0,0 +1,129 @@
+import json
+import time
+from concurrent.futures import Future
+
+import numpy as np
+import pytest
+
+from ..models import Timecourse
+from ..storage import LocalStorageManager
+from ..transforms import (MemoryBudget, MemoryEstimator, Transform,
+                          TransformRunner, runner)
+from .conftest import FMRI, ScaleTransform, add_roots
+
+
+class TimedScale(Transform):
+    input_datatype = FMRI
+    output_datatype = FMRI
+    memory_multiplier = 10.0
+
+    def transform(self, data):
+        start = time.time()
+        time.sleep(0.3)
+        log = f"{self.params['log_dir']}/{self.input_timecourses[0].id}"
+        with open(log, "w") as f:
+            json.dump([start, time.time()], f)
+        return data[0] * 2
+
+
+def test_runner_transforms_every_timecourse(file_session, storage_factory):
+    storage_manager = storage_factory()
+    add_roots(file_session, storage_manager, range(3))
+    progress = []
+    runner = TransformRunner(
+        ScaleTransform, file_session.query(Timecourse),
+        params={"factor": 2.0}, storage_manager_factory=storage_factory,
+        n_workers=2, progress=lambda *args: progress.append(args))
+    summary = runner.run()
+
+    assert not summary.failed
+    assert len(summary.created) == 3
+    assert len(progress) == 3
+    for input_id, output_id in summary.created.items():
+        parent = file_session.get(Timecourse, input_id)
+        child = file_session.get(Timecourse, output_id)
+        assert child.derived_from.all() == [parent]
+        np.testing.assert_array_equal(storage_manager.retrieve(child),
+                                      storage_manager.retrieve(parent) * 2.0)
+    assert file_session.query(Timecourse).count() == 6
+
+
+def test_runner_reports_failures(file_session, storage_factory):
+    add_roots(file_session, storage_factory(), range(2))
+    runner = TransformRunner(
+        ScaleTransform, file_session.query(Timecourse),
+        params={"factor": 2.0, "fail_on": 1.0},
+        storage_manager_factory=storage_factory, n_workers=2, max_retries=1,
+        progress=None)
+    summary = runner.run()
+
+    assert len(summary.created) == 1
+    assert len(summary.failed) == 1
+    (failed_id,) = summary.failed
+    assert "Refusing to scale" in summary.failed[failed_id]
+    assert summary.attempts[failed_id] == 2
+    assert file_session.query(Timecourse).count() == 3
+
+
+def test_runner_rejects_in_memory_database(session):
+    with pytest.raises(ValueError):
+        TransformRunner(ScaleTransform, session.query(Timecourse),
+                        storage_manager_factory=LocalStorageManager)
+
+
+def test_worker_api(file_engine, file_session, storage_factory, monkeypatch):
+    monkeypatch.setattr(runner, "_worker_session_factory", None)
+    monkeypatch.setattr(runner, "_worker_storage_manager", None)
+    with pytest.raises(RuntimeError, match="init_worker"):
+        runner.worker_session()
+
+    roots = add_roots(file_session, storage_factory(), [1.0])
+    runner.init_worker(file_engine.url.render_as_string(hide_password=False),
+                       storage_factory)
+    new_id = runner.derive_in_worker([ScaleTransform], [{"factor": 2.0}],
+                                     [roots[0].id])
+    new = file_session.get(Timecourse, new_id)
+    np.testing.assert_array_equal(storage_factory().retrieve(new), 2.0)
+
+    future = Future()
+    future.set_exception(ValueError("no such timecourse"))
+    result, error = runner.result_or_error(future)
+    assert result is None and "ValueError: no such timecourse" in error
+
+
+def test_memory_budget_admits_what_fits():
+    budget = MemoryBudget(100)
+    assert budget.try_acquire(60)
+    assert not budget.try_acquire(50)
+    assert budget.try_acquire(40)
+    budget.release(60)
+    budget.release(40)
+    # Larger than the whole budget, so it runs alone.
+    assert budget.try_acquire(500)
+    assert not budget.try_acquire(1)
+
+
+def test_runner_admits_runs_by_memory(file_session, storage_factory,
+                                      tmp_path):
+    add_roots(file_session, storage_factory(), range(3))
+    estimator = MemoryEstimator()
+    # Each (2, 2, 2, 3) float32 input is 96 bytes, so two runs don't fit.
+    runner = TransformRunner(
+        TimedScale, file_session.query(Timecourse),
+        params={"log_dir": str(tmp_path)},
+        storage_manager_factory=storage_factory, n_workers=3,
+        progress=None, memory_budget=1500, memory_estimator=estimator)
+    summary = runner.run()
+
+    assert len(summary.created) == 3
+    assert set(summary.estimated_memory.values()) == {960}
+    spans = sorted(json.loads((tmp_path / str(tc_id)).read_text())
+                   for tc_id in summary.created)
+    for (_, end), (start, _) in zip(spans, spans[1:]):
+        assert end <= start
+    # What the workers observed replaces the declared estimate.
+    assert estimator.learned_ratio("TimedScale") is not None
+    transform = TimedScale(file_session.get(Timecourse, 1), None,
+                           storage_manager=storage_factory())
+    assert estimator.estimate(transform) == int(
+        96 * estimator.learned_ratio("TimedScale") * 1.2)
@@ -1,10 +1,15 @@
 import pytest
 import os
 import tempfile
+import mne
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from unittest.mock import patch
+import multiprocessing
 from ..storage import GCSStorageManager, LocalStorageManager
+from ..storage import SharedPayloadStore, View
+from ..storage import views
 from ..models import Data, DataType, Modality, Timecourse, Study, Subject
 from ..storage import format as fmt
 
@@ -87,6 +92,39 @@ def test_store_retrieve_with_ndarray_payload(local_storage_manager,
     np.testing.assert_array_equal(payload2, ndarray_payload)  # check that the payload matches payload2
     os.remove(local_path)
 
+# Files were named by their timestamp alone before the unique suffix.
+OLD_PATH = "study_name/TT/IMAGING/FMRI/20240101_120000.npz"
+
+def test_retrieve_file_stored_under_old_name(local_storage_manager,
+                                             real_timecourse, ndarray_payload):
+    real_timecourse.date_collected = datetime(2024, 1, 1, 12, 0, 0, 123456)
+    local_path = os.path.join(local_storage_manager.local_cache_dir, OLD_PATH)
+    os.makedirs(os.path.dirname(local_path))
+    fmt.FMRIPayloadSerializer().to_file(local_path, ndarray_payload)
+    real_timecourse.path = OLD_PATH
+
+    np.testing.assert_array_equal(
+        local_storage_manager.retrieve(real_timecourse), ndarray_payload)
+    # New files are never named alike, even at the same time.
+    assert (local_storage_manager.get_uri_from_data(
+        real_timecourse, ndarray_payload) != local_storage_manager
+        .get_uri_from_data(real_timecourse, ndarray_payload))
+
+@patch("subprocess.run")
+def test_gcs_cache_finds_file_stored_under_old_name(
+        mock_subprocess, tmp_path, real_timecourse, ndarray_payload):
+    storage_manager = GCSStorageManager(gcs_bucket="gs://bucket_name",
+                                        local_cache_dir=str(tmp_path))
+    real_timecourse.date_collected = datetime(2024, 1, 1, 12, 0, 0, 123456)
+    local_path = str(tmp_path / OLD_PATH)
+    os.makedirs(os.path.dirname(local_path))
+    fmt.FMRIPayloadSerializer().to_file(local_path, ndarray_payload)
+    real_timecourse.path = f"gs://bucket_name/{OLD_PATH}"
+
+    np.testing.assert_array_equal(storage_manager.retrieve(real_timecourse),
+                                  ndarray_payload)
+    mock_subprocess.assert_not_called()
+
 # def test_retrieve_with_ndarray_payload(local_storage_manager, real_timecourse, ndarray_payload):
 #     # Retrieve the actual serializer for np.ndarray
 #     serializer = fmt.TYPE_TO_SERIALIZER[("np_array", np.ndarray)]()
@@ -103,3 +141,302 @@ def test_store_retrieve_with_ndarray_payload(local_storage_manager,
 
 #     # Clean up the created file after the test
 #     os.remove(local_path)
+
+def test_store_retrieve_with_dict_payload(local_storage_manager,
+                                          real_timecourse):
+    payload = {
+        "epochs": np.random.rand(4, 3, 50),
+        "labels": np.arange(4),
+        "times": np.linspace(0, 1, 50),
+    }
+    real_timecourse.path = local_storage_manager.get_uri_from_data(
+        real_timecourse, payload)
+    assert real_timecourse.path.endswith(".npzd")
+
+    local_storage_manager.store(real_timecourse, payload, compress=["epochs"])
+    retrieved = local_storage_manager.retrieve(real_timecourse)
+
+    # Nothing is read until a key is accessed.
+    assert isinstance(retrieved, fmt.LazyArrayDict)
+    assert retrieved.loaded_keys == []
+    assert sorted(retrieved) == ["epochs", "labels", "times"]
+
+    # Uncompressed arrays are memory-mapped, compressed ones are read.
+    assert isinstance(retrieved["labels"], np.memmap)
+    assert not isinstance(retrieved["epochs"], np.memmap)
+    assert retrieved.loaded_keys == ["labels", "epochs"]
+    for key, array in payload.items():
+        np.testing.assert_array_equal(retrieved[key], array)
+
+    # The archive is an ordinary npz file.
+    local_path = os.path.join(local_storage_manager.local_cache_dir,
+                              real_timecourse.path)
+    with np.load(local_path) as npz:
+        np.testing.assert_array_equal(npz["times"], payload["times"])
+    os.remove(local_path)
+
+def test_get_payload_type():
+    assert fmt.get_payload_type({"a": np.zeros(2)}) is dict
+    assert fmt.get_payload_type(np.zeros(2)) is np.ndarray
+    assert fmt.get_payload_type(np.zeros(2).view(np.memmap)) is np.ndarray
+
+@pytest.mark.parametrize("order", ["C", "F"])
+def test_fmri_blocked_round_trip(tmp_path, order):
+    payload = np.asarray(np.random.rand(6, 5, 4, 30), order=order)
+    fname = str(tmp_path / "run.npz")
+    # Small blocks so the array spans several of them.
+    serializer = fmt.FMRIPayloadSerializer(n_threads=3, block_bytes=1024)
+    serializer.to_file(fname, payload)
+
+    with fmt.BlockedArchiveReader(fname) as reader:
+        assert len(reader.arrays["data"]["bounds"]) > 1
+        axis = reader.arrays["data"]["axis"]
+        np.testing.assert_array_equal(
+            reader.read_range("data", 2, 4), payload.take(range(2, 4), axis))
+
+    np.testing.assert_array_equal(serializer.from_file(fname), payload)
+
+def test_fmri_reads_legacy_npz(tmp_path):
+    payload = np.random.rand(4, 4, 4, 3)
+    fname = str(tmp_path / "legacy.npz")
+    np.savez_compressed(fname, data=payload)
+    np.testing.assert_array_equal(
+        fmt.FMRIPayloadSerializer().from_file(fname), payload)
+
+def test_fmri_masked_round_trip(local_storage_manager, real_timecourse):
+    payload = np.zeros((8, 8, 6, 20))
+    payload[2:6, 2:6, 1:5] = np.random.rand(4, 4, 4, 20)
+    real_timecourse.path = local_storage_manager.get_uri_from_data(
+        real_timecourse, payload)
+    local_storage_manager.store(real_timecourse, payload, mask="auto")
+
+    compact = local_storage_manager.retrieve(real_timecourse, layout="compact")
+    assert compact.shape == (64, 20)
+
+    volume = local_storage_manager.retrieve(real_timecourse)
+    assert isinstance(volume, fmt.MaskedVolume)
+    assert volume.shape == payload.shape
+    np.testing.assert_array_equal(volume[..., 3], payload[..., 3])
+    np.testing.assert_array_equal(volume[2:4, :, 1, 5:7],
+                                  payload[2:4, :, 1, 5:7])
+    np.testing.assert_array_equal(np.asarray(volume), payload)
+
+    # A retrieved masked volume can be stored again without densifying it.
+    local_storage_manager.store(real_timecourse, volume)
+    np.testing.assert_array_equal(
+        local_storage_manager.retrieve(real_timecourse, layout="compact"),
+        compact)
+
+@pytest.mark.parametrize("mode", ["float16", "int16"])
+def test_fmri_quantized_round_trip(local_storage_manager, real_timecourse,
+                                   mode):
+    payload = np.random.rand(5, 5, 5, 40) * 100
+    real_timecourse.path = local_storage_manager.get_uri_from_data(
+        real_timecourse, payload)
+    report = local_storage_manager.store(real_timecourse, payload,
+                                         quantize=mode)
+
+    retrieved = local_storage_manager.retrieve(real_timecourse)
+    assert retrieved.dtype == payload.dtype
+    error = np.max(np.abs(retrieved - payload))
+    assert error == pytest.approx(report["max_abs_error"])
+    assert error < 0.05
+
+def test_dict_quantized_round_trip(local_storage_manager, real_timecourse):
+    payload = {"epochs": np.random.randn(4, 3, 50).astype(np.float32),
+               "labels": np.arange(4)}
+    real_timecourse.path = local_storage_manager.get_uri_from_data(
+        real_timecourse, payload)
+    report = local_storage_manager.store(real_timecourse, payload,
+                                         quantize="int16")
+
+    retrieved = local_storage_manager.retrieve(real_timecourse)
+    assert sorted(retrieved) == ["epochs", "labels"]
+    assert retrieved["epochs"].dtype == np.float32
+    np.testing.assert_allclose(retrieved["epochs"], payload["epochs"],
+                               atol=report["max_abs_error"] * 1.01)
+    np.testing.assert_array_equal(retrieved["labels"], payload["labels"])
+
+def test_quantize_rejects_non_float():
+    with pytest.raises(ValueError):
+        fmt.quantize(np.arange(4), "int16")
+
+@pytest.mark.parametrize("order,options", [
+    ("F", {}), ("C", {}), ("F", {"mask": "auto"}),
+    ("F", {"quantize": "int16"})])
+def test_fmri_window_reader(local_storage_manager, real_timecourse, order,
+                            options):
+    payload = np.zeros((6, 5, 4, 30), order=order)
+    payload[1:5, 1:4, 1:3] = np.random.rand(4, 3, 2, 30)
+    real_timecourse.path = local_storage_manager.get_uri_from_data(
+        real_timecourse, payload)
+    local_storage_manager.store(real_timecourse, payload, block_bytes=1024,
+                                **options)
+
+    with local_storage_manager.open_reader(real_timecourse) as reader:
+        assert reader.n_times == 30
+        np.testing.assert_allclose(reader.read(7, 19), payload[..., 7:19],
+                                   atol=1e-4)
+        np.testing.assert_allclose(reader.read(28, 40), payload[..., 28:],
+                                   atol=1e-4)
+
+def test_eeg_window_reader(local_storage_manager, real_timecourse):
+    info = mne.create_info(3, 100., "eeg")
+    payload = mne.io.RawArray(np.random.randn(3, 500) * 1e-5, info,
+                              verbose=False)
+    real_timecourse.data = Data(type=DataType.EEG, modality=Modality.IMAGING,
+                                sampling_rate=100.)
+    real_timecourse.path = local_storage_manager.get_uri_from_data(
+        real_timecourse, payload)
+    local_storage_manager.store(real_timecourse, payload)
+
+    with local_storage_manager.open_reader(real_timecourse) as reader:
+        assert not reader.raw.preload
+        np.testing.assert_allclose(reader.read(100, 250),
+                                   payload.get_data()[:, 100:250])
+
+def test_video_window_reader(local_storage_manager, real_timecourse):
+    payload = np.repeat(np.arange(0, 200, 10, dtype=np.uint8),
+                        6 * 8 * 3).reshape(20, 6, 8, 3)
+    real_timecourse.data = Data(type=DataType.VIDEO,
+                                modality=Modality.STIMULUS, sampling_rate=30.)
+    real_timecourse.path = local_storage_manager.get_uri_from_data(
+        real_timecourse, payload)
+    local_storage_manager.store(real_timecourse, payload)
+
+    with local_storage_manager.open_reader(real_timecourse) as reader:
+        assert reader.n_times == 20
+        later = reader.read(12, 16)
+        earlier = reader.read(4, 8)
+        assert later.shape == (6, 8, 3, 4)
+        # The codec is lossy.
+        np.testing.assert_allclose(
+            earlier.mean(axis=(0, 1, 2)), payload[4:8].mean(axis=(1, 2, 3)),
+            atol=8)
+        assert reader.wrap(later).shape == (4, 6, 8, 3)
+
+def test_audio_window_reader(local_storage_manager, real_timecourse):
+    payload = (np.sin(np.arange(44100) / 20.)[:, None] * 0.5).astype(
+        np.float32)
+    real_timecourse.data = Data(type=DataType.AUDITORY_PROMPT,
+                                modality=Modality.STIMULUS,
+                                sampling_rate=44100.)
+    real_timecourse.path = local_storage_manager.get_uri_from_data(
+        real_timecourse, payload)
+    local_storage_manager.store(real_timecourse, payload)
+    whole = local_storage_manager.retrieve(real_timecourse)
+
+    with local_storage_manager.open_reader(real_timecourse) as reader:
+        assert reader.n_times == len(whole)
+        np.testing.assert_allclose(reader.read(1000, 3000),
+                                   whole[1000:3000].T, atol=1e-6)
+        assert reader.wrap(reader.read(0, 10)).shape == (10, 1)
+
+def _negate_shared(handle):
+    data = handle.attach()
+    data *= -1
+    return float(data.sum()), data.flags.f_contiguous
+
+def test_shared_payload_is_mapped_by_workers():
+    payload = np.asfortranarray(np.arange(24, dtype=float).reshape(2, 3, 4))
+    with SharedPayloadStore() as store:
+        handle = store.share(payload)
+        assert handle.nbytes == payload.nbytes
+        with ProcessPoolExecutor(
+                1, mp_context=multiprocessing.get_context("spawn")) as pool:
+            total, fortran = pool.submit(_negate_shared, handle).result()
+        assert total == -payload.sum()
+        assert fortran
+        # The worker wrote to the same memory.
+        np.testing.assert_array_equal(handle.attach(), -payload)
+    assert len(store) == 0
+
+def test_retrieve_shared_counts_references(local_storage_manager,
+                                           real_timecourse):
+    payload = mne.io.RawArray(np.random.rand(2, 500),
+                              mne.create_info(2, 100., "eeg"),
+                              first_samp=10, verbose=False)
+    payload.set_annotations(mne.Annotations([1.], [0.5], ["blink"]))
+    real_timecourse.data = Data(type=DataType.EEG, modality=Modality.IMAGING,
+                                sampling_rate=100.)
+    real_timecourse.path = local_storage_manager.get_uri_from_data(
+        real_timecourse, payload)
+    local_storage_manager.store(real_timecourse, payload)
+
+    store = SharedPayloadStore()
+    handle = local_storage_manager.retrieve_shared(real_timecourse, store)
+    again = local_storage_manager.retrieve_shared(real_timecourse, store)
+    assert again == handle
+    assert store.refcount(handle) == 2
+
+    raw = handle.attach()
+    assert raw.first_samp == 10
+    assert list(raw.annotations.description) == ["blink"]
+    np.testing.assert_allclose(raw.get_data(), payload.get_data(), atol=1e-6)
+
+    # Private attachments can be changed in place, e.g. filtered.
+    private = handle.attach(private=True)
+    private.filter(1., 20., verbose=False)
+    assert not np.allclose(private.get_data(), payload.get_data(), atol=1e-6)
+    np.testing.assert_allclose(handle.attach().get_data(),
+                               payload.get_data(), atol=1e-6)
+
+    store.release(handle)
+    assert len(store) == 1
+    store.release(handle)
+    assert len(store) == 0
+    with pytest.raises(FileNotFoundError):
+        handle.attach()
+    # Attached payloads outlive the segment.
+    np.testing.assert_allclose(raw.get_data(), payload.get_data(), atol=1e-6)
+    private.filter(1., 20., verbose=False)
+    with pytest.raises(KeyError):
+        store.release(handle)
+
+def test_estimate_nbytes_reads_headers(local_storage_manager,
+                                       real_timecourse):
+    volume = np.random.rand(4, 5, 6, 10)
+    real_timecourse.path = local_storage_manager.get_uri_from_data(
+        real_timecourse, volume)
+    assert local_storage_manager.estimate_nbytes(real_timecourse) is None
+    local_storage_manager.store(real_timecourse, volume, quantize="int16")
+    assert local_storage_manager.estimate_nbytes(
+        real_timecourse) == volume.nbytes
+
+    raw = mne.io.RawArray(np.zeros((3, 200), dtype=np.float32),
+                          mne.create_info(3, 100., "eeg"), verbose=False)
+    real_timecourse.data = Data(type=DataType.EEG, modality=Modality.IMAGING,
+                                sampling_rate=100.)
+    real_timecourse.path = local_storage_manager.get_uri_from_data(
+        real_timecourse, raw)
+    local_storage_manager.store(real_timecourse, raw)
+    assert local_storage_manager.estimate_nbytes(real_timecourse) == 3 * 200 * 8
+
+    arrays = {"epochs": np.zeros((5, 3, 20)), "labels": np.arange(5)}
+    real_timecourse.path = local_storage_manager.get_uri_from_data(
+        real_timecourse, arrays)
+    local_storage_manager.store(real_timecourse, arrays, compress=True)
+    assert local_storage_manager.estimate_nbytes(real_timecourse) == (
+        arrays["epochs"].nbytes + arrays["labels"].nbytes)
+
+
+def test_view_operations_on_raw():
+    info = mne.create_info(["Fz", "Cz", "Pz"], 100., "eeg")
+    raw = mne.io.RawArray(np.random.randn(3, 500) * 1e-5, info,
+                          verbose=False)
+    view = View.from_json(View(7, [
+        views.crop(100, 300), views.pick(["Fz", "Cz"]), views.scale(2.0),
+        views.mark_bad(["Cz"]),
+        views.annotate([0.5], [0.1], ["blink"])]).to_json())
+    assert view.parent_id == 7
+
+    result = view.apply(raw.copy())
+    np.testing.assert_allclose(result.get_data(),
+                               raw.get_data()[:2, 100:300] * 2)
+    assert result.info["bads"] == ["Cz"]
+    assert list(result.annotations.description) == ["blink"]
+
+    with pytest.raises(TypeError, match="mark_bad"):
+        View(7, [views.mark_bad(["Cz"])]).apply(np.zeros((3, 10)))
+    with pytest.raises(ValueError, match="Unknown"):
+        View(7, [{"op": "resample"}])
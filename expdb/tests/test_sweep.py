@@ -0,0 +1,82 @@
+import json
+
+import numpy as np
+import pytest
+
+from ..models import SweepMetric, Timecourse
+from ..storage import LocalStorageManager
+from ..transforms import ParameterSweep, param_grid
+from .conftest import ScaleTransform, add_roots
+
+
+def total(output):
+    return np.float32(output.sum())
+
+
+def test_param_grid():
+    assert param_grid({"factor": [1, 2], "offset": [0, 5]}) == [
+        {"factor": 1, "offset": 0}, {"factor": 1, "offset": 5},
+        {"factor": 2, "offset": 0}, {"factor": 2, "offset": 5}]
+    with pytest.raises(ValueError, match="metric"):
+        ParameterSweep(ScaleTransform, [], [{"factor": 1}],
+                       store_outputs=False)
+
+
+def test_sweep_loads_each_input_once(file_session, storage_factory):
+    storage_manager = storage_factory()
+    # ScaleTransform scales its input in place, so each run must get its
+    # own copy of the shared input.
+    inputs = add_roots(file_session, storage_manager, [1.0, 2.0])
+    messages = []
+    sweep = ParameterSweep(
+        ScaleTransform, inputs, {"factor": [2.0, 3.0], "offset": [0.0, 1.0]},
+        metric=total, storage_manager_factory=storage_factory, n_workers=2,
+        progress=messages.append)
+    report = sweep.run()
+
+    assert report.loads == 2
+    assert len(report.results) == len(messages) == 8
+    assert not report.failed
+    for result in report.results:
+        value = 1.0 if result.input_id == inputs[0].id else 2.0
+        expected = value * result.params["factor"] + result.params["offset"]
+        output = file_session.get(Timecourse, result.output_id)
+        assert [p.id for p in output.derived_from] == [result.input_id]
+        assert json.loads(output.transform.transform_params_json) == [
+            result.params]
+        np.testing.assert_array_equal(storage_manager.retrieve(output),
+                                      np.full((2, 2, 2, 3), expected))
+        assert result.metric == pytest.approx(expected * 24)
+    assert file_session.query(SweepMetric).count() == 8
+
+    # Every run is recorded, so nothing is loaded or run again.
+    again = ParameterSweep(
+        ScaleTransform, inputs, {"factor": [2.0, 3.0], "offset": [0.0, 1.0]},
+        metric=total, storage_manager_factory=storage_factory, n_workers=2,
+        progress=None).run()
+    assert again.loads == 0
+    assert all(r.reused for r in again.results)
+    assert ([(r.output_id, r.metric) for r in again.results]
+            == [(r.output_id, r.metric) for r in report.results])
+    frame = again.to_frame()
+    assert list(frame.columns[:3]) == ["input_id", "factor", "offset"]
+
+
+def test_sweep_can_store_only_metrics(session, tmp_path):
+    storage_manager = LocalStorageManager(file_root=str(tmp_path))
+    inputs = add_roots(session, storage_manager, [1.0])
+    report = ParameterSweep(
+        ScaleTransform, inputs,
+        [{"factor": 2.0}, {"factor": 2.0, "fail_on": 1.0}],
+        metric=total, store_outputs=False,
+        storage_manager_factory=lambda: storage_manager, n_workers=0,
+        progress=None).run()
+
+    assert report.loads == 1
+    assert [r.metric for r in report.results] == [48.0, None]
+    assert "Refusing to scale" in report.failed[0].error
+    assert session.query(Timecourse).count() == 1
+    recorded = session.query(SweepMetric).one()
+    assert recorded.output_id is None
+    assert recorded.input_id == inputs[0].id
+    assert recorded.value_json == "48.0"
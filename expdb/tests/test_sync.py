@@ -0,0 +1,122 @@
+from datetime import datetime, timedelta
+
+import mne
+import numpy as np
+import pandas as pd
+import pytest
+
+from ..lib import SyncReader
+from ..models import Data, DataType, Modality, Study, Subject, Timecourse
+from ..models import TransformData
+from ..storage import LocalStorageManager
+from ..storage.readers import RawWindowReader
+
+START = datetime(2024, 1, 1, 12, 0, 0)
+
+
+@pytest.fixture
+def storage_manager(tmp_path):
+    return LocalStorageManager(file_root=str(tmp_path))
+
+
+@pytest.fixture
+def make_timecourse(session, storage_manager):
+    study = Study(name="sync_study", github_repo="test/repo")
+    subject = Subject(name="Testy McTesterson", code="TT",
+                      age=20, meditation_experience=5)
+
+    def make(data_type, modality, sampling_rate, payload, delay=0.0):
+        tc = Timecourse(study=study, subject=subject,
+                        data=Data(sampling_rate=sampling_rate,
+                                  modality=modality, type=data_type),
+                        is_pilot=False,
+                        transform=TransformData("[]", "[]", "abc1234"),
+                        date_collected=START + timedelta(seconds=delay))
+        tc.path = storage_manager.get_uri_from_data(tc, payload)
+        session.add(tc)
+        storage_manager.store(tc, payload)
+        session.commit()
+        return tc
+    return make
+
+
+@pytest.fixture
+def eeg(make_timecourse):
+    # 10 s at 100 Hz, each sample holding its index.
+    ramp = np.tile(np.arange(1000, dtype=float), (2, 1))
+    raw = mne.io.RawArray(ramp, mne.create_info(2, 100., "misc"),
+                          verbose=False)
+    return make_timecourse(DataType.EEG, Modality.IMAGING, 100., raw)
+
+
+def test_windows_are_aligned_across_rates(make_timecourse, eeg,
+                                          storage_manager, monkeypatch):
+    # 20 frames at 4 Hz, starting 1 s after the EEG.
+    frames = np.repeat(np.arange(0, 200, 10, dtype=np.uint8),
+                       6 * 8 * 3).reshape(20, 6, 8, 3)
+    video = make_timecourse(DataType.VIDEO, Modality.STIMULUS, 4., frames,
+                            delay=1.0)
+    reads = []
+    read = RawWindowReader.read
+    monkeypatch.setattr(RawWindowReader, "read", lambda self, start, stop: (
+        reads.append((start, stop)) or read(self, start, stop)))
+
+    with SyncReader([eeg, video], storage_manager, window=1.0,
+                    step=0.5) as reader:
+        # The video covers 1 s to 6 s of the EEG.
+        assert len(reader) == 9
+        assert reader.samples_per_window("eeg") == 100
+        assert reader.samples_per_window("video") == 4
+        windows = list(reader)
+
+    assert windows[0].start == START + timedelta(seconds=1)
+    assert windows[3].offset == pytest.approx(1.5)
+    np.testing.assert_array_equal(windows[3]["eeg"][0],
+                                  np.arange(250, 350))
+    assert windows[3]["video"].shape == (6, 8, 3, 4)
+    np.testing.assert_allclose(windows[3]["video"].mean(axis=(0, 1, 2)),
+                               [60, 70, 80, 90], atol=8)
+    # Only each window's samples were read.
+    assert reads == [(100 + 50 * i, 200 + 50 * i) for i in range(9)]
+
+
+@pytest.mark.parametrize("method,expected", [
+    ("nearest", 100 + np.round(np.arange(40) * 2.5)),
+    ("linear", 100 + np.arange(40) * 2.5),
+])
+def test_resampling(eeg, storage_manager, method, expected):
+    with SyncReader([eeg], storage_manager, window=1.0,
+                    start=START + timedelta(seconds=1), sampling_rate=40.,
+                    method=method) as reader:
+        assert len(reader) == 9
+        window = reader.read_window(0)
+    assert window["eeg"].shape == (2, 40)
+    np.testing.assert_allclose(window["eeg"][0], expected)
+
+
+def test_event_tables_and_sampled_frames(make_timecourse, eeg,
+                                         storage_manager):
+    events = make_timecourse(
+        DataType.INPUT_RESPONSE, Modality.BEHAVIORAL, 0.,
+        pd.DataFrame({"onset": [3.2, 0.5, 2.1, 2.9],
+                      "button": [4, 1, 2, 3]}), delay=1e-4)
+    presses = make_timecourse(
+        DataType.INPUT_RESPONSE, Modality.BEHAVIORAL, 10.,
+        pd.DataFrame({"pressed": np.arange(100) % 2 == 0}))
+
+    with SyncReader({"eeg": eeg, "events": events, "presses": presses},
+                    storage_manager, window=1.0,
+                    event_columns={"events": "onset"}) as reader:
+        assert len(reader) == 10
+        window = reader.read_window(2)
+
+    assert list(window["events"]["button"]) == [2, 3]
+    np.testing.assert_allclose(window["events"]["onset"], [0.1, 0.9],
+                               atol=1e-3)
+    assert len(window["presses"]) == 10
+    assert window["presses"].index[0] == 20
+
+
+def test_duplicate_types_need_names(eeg, storage_manager):
+    with pytest.raises(ValueError, match="names"):
+        SyncReader([eeg, eeg], storage_manager, window=1.0)
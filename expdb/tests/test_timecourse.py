@@ -1,6 +1,9 @@
 from ..models import Data, DataType, Modality, Timecourse, TransformData, Subject, Study
+from ..models.timecourse import (rebuild_lineage_closure,
+                                 timecourse_lineage_closure)
 from ..transforms import Transform
 
+from sqlalchemy import event, select
 from sqlalchemy.exc import IntegrityError, DataError
 import pytest
 
@@ -99,6 +102,48 @@ def test_timecourse_propagation(session):
     assert not tc3.is_pilot
 
 
+def test_is_pilot_propagates_in_bulk(session):
+    """Test that propagating is_pilot on a deep DAG costs a few statements."""
+    study = Study(name="Test Study", github_repo="test/repo")
+    subject = Subject(name="Testy McTesterson", code="TT",
+                      age=20, meditation_experience=5)
+    data = Data(sampling_rate=256.0, modality=Modality.IMAGING,
+                type=DataType.FMRI)
+    transform_data = TransformData("[]", "[]", "abc123")
+
+    def make(name):
+        return Timecourse(subject=subject, study=study, is_pilot=False,
+                          data=data, transform=transform_data,
+                          path=f"/data/{name}.npy")
+
+    # Deeper than the recursion limit allowed walking through the ORM.
+    chain = [make("chain_0")]
+    for i in range(1, 400):
+        chain.append(make(f"chain_{i}"))
+        chain[-1].derived_from.append(chain[-2])
+    sibling, unrelated = make("sibling"), make("unrelated")
+    sibling.derived_from.append(chain[10])
+    session.add_all(chain + [sibling, unrelated])
+    session.commit()
+
+    statements = []
+    listen = lambda *args: statements.append(args[2])
+    event.listen(session.bind, "before_cursor_execute", listen)
+    try:
+        chain[-1].is_pilot = True
+    finally:
+        event.remove(session.bind, "before_cursor_execute", listen)
+    # Flushing the change, the recursive UPDATE and refreshing the object.
+    assert len(statements) <= 4
+
+    # Loaded timecourses are refreshed without reloading them.
+    assert all(tc.is_pilot for tc in chain) and sibling.is_pilot
+    assert not unrelated.is_pilot
+    session.commit()
+    assert session.query(Timecourse).filter(Timecourse.is_pilot).count() \
+        == 401
+
+
 # Test Timecourse: Ensure a Timecourse cannot be created without required fields
 def test_timecourse_missing_required_fields(session):
     '''Test that creating a timecourse without required fields raises an error.'''
@@ -208,3 +253,59 @@ def test_malformed_json_transform_params(session):
             git_commit="abc123"
         )
 
+
+
+def _closure(session):
+    rows = session.execute(select(timecourse_lineage_closure)).all()
+    return sorted(tuple(row) for row in rows)
+
+
+def test_lineage_closure_is_maintained(session):
+    """Test the lineage closure table as edges are added and removed."""
+    study = Study(name="Test Study", github_repo="test/repo")
+    subject = Subject(name="Testy McTesterson", code="TT",
+                      age=20, meditation_experience=5)
+    data = Data(sampling_rate=256.0, modality=Modality.IMAGING,
+                type=DataType.FMRI)
+    transform_data = TransformData("[]", "[]", "abc123")
+    upload, a, b, c, other = [
+        Timecourse(subject=subject, study=study, data=data,
+                   transform=transform_data, path=f"/data/lineage_{i}.npy")
+        for i in range(5)]
+    a.derived_from.append(upload)
+    b.derived_from.append(a)
+    session.add_all([upload, a, b, other])
+    session.commit()
+    assert _closure(session) == [(upload.id, a.id, 1), (upload.id, b.id, 2),
+                                 (a.id, b.id, 1)]
+    assert [tc.id for tc in upload.descendants.order_by(Timecourse.id)] \
+        == [a.id, b.id]
+    assert b.root_uploads() == [upload]
+    assert upload.root_uploads() == []
+
+    # A second parent of an existing timecourse reaches its descendants,
+    # and the shortest path is kept.
+    c.derived_from.append(a)
+    session.add(c)
+    session.commit()
+    b.derived_from.append(other)
+    b.derived_from.append(c)
+    session.commit()
+    assert _closure(session) == sorted([
+        (upload.id, a.id, 1), (upload.id, b.id, 2), (upload.id, c.id, 2),
+        (a.id, b.id, 1), (a.id, c.id, 1), (c.id, b.id, 1),
+        (other.id, b.id, 1)])
+    assert [tc.id for tc in b.root_uploads()] == [upload.id, other.id]
+
+    b.derived_from.remove(a)
+    session.commit()
+    assert (a.id, b.id, 2) in _closure(session)
+    session.delete(c)
+    session.commit()
+    assert _closure(session) == sorted([
+        (upload.id, a.id, 1), (other.id, b.id, 1)])
+
+    # Rebuilding from scratch agrees with the maintained table.
+    rebuild_lineage_closure(session.connection())
+    assert _closure(session) == sorted([
+        (upload.id, a.id, 1), (other.id, b.id, 1)])
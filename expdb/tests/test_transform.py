@@ -0,0 +1,423 @@
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from ..models import Data, DataType, Modality, Timecourse, TransformData
+from ..models import Study, Subject, TransformRun
+from ..lib import get_slowest_stages, summarize_stages_by_commit
+from ..storage import LocalStorageManager, SharedPayloadStore
+from ..storage.views import crop, scale
+from ..transforms import (OverlappingRunner, Pipeline, StreamingTransform,
+                          Transform, TransformBatch, ViewTransform)
+from .conftest import FMRI, add_roots
+
+import json
+import time
+
+
+class CountingScale(Transform):
+    input_datatype = FMRI
+    output_datatype = FMRI
+    calls = 0
+
+    def transform(self, data):
+        CountingScale.calls += 1
+        return data[0] * self.params["factor"]
+
+
+class AddOffset(Transform):
+    input_datatype = FMRI
+    output_datatype = FMRI
+
+    def transform(self, data):
+        return data[0] + self.params["offset"]
+
+
+class CropScale(ViewTransform):
+    input_datatype = FMRI
+    output_datatype = FMRI
+
+    def view_ops(self):
+        return [crop(self.params["start"], self.params["stop"]),
+                scale(self.params["factor"])]
+
+
+def moving_sum(data):
+    padded = np.pad(data, [(0, 0)] * (data.ndim - 1) + [(1, 1)])
+    return padded[..., :-2] + padded[..., 1:-1] + padded[..., 2:]
+
+
+class StreamingMovingSum(StreamingTransform):
+    input_datatype = FMRI
+    output_datatype = FMRI
+    window = 4
+    padding = 1
+
+    def transform_window(self, window):
+        assert window.shape[-1] <= self.window + 2 * self.padding
+        return moving_sum(window)
+
+
+@pytest.fixture
+def storage_manager(tmp_path):
+    return LocalStorageManager(file_root=str(tmp_path))
+
+
+@pytest.fixture
+def root(session, storage_manager):
+    study = Study(name="memo_study", github_repo="test/repo")
+    subject = Subject(name="Testy McTesterson", code="TT",
+                      age=20, meditation_experience=5)
+    payload = np.arange(24, dtype=np.float32).reshape(2, 2, 2, 3)
+    tc = Timecourse(study=study, subject=subject, data=FMRI, is_pilot=False,
+                    transform=TransformData("[]", "[]", "abc1234"),
+                    date_collected=datetime(2024, 1, 1, 12, 0, 0))
+    tc.path = storage_manager.get_uri_from_data(tc, payload)
+    storage_manager.store(tc, payload)
+    session.add(tc)
+    session.commit()
+    CountingScale.calls = 0
+    return tc
+
+
+def run(root, storage_manager, force=False, **params):
+    transform = CountingScale(root, None, storage_manager=storage_manager,
+                              **params)
+    new_timecourse = transform.apply_transform(force=force)
+    transform.commit()
+    return transform, new_timecourse
+
+
+def test_identical_derivation_is_reused(session, root, storage_manager):
+    _, first = run(root, storage_manager, factor=2.0)
+    transform, second = run(root, storage_manager, factor=2.0)
+
+    assert transform.reused
+    assert transform.out_data is None
+    assert second.id == first.id
+    assert CountingScale.calls == 1
+    assert session.query(Timecourse).count() == 2
+
+
+def test_uncommitted_code_is_never_reused(session, root, storage_manager,
+                                          monkeypatch):
+    from ..utils import git_utils
+    monkeypatch.setattr(git_utils, "no_uncommitted_changes", lambda: False)
+    _, first = run(root, storage_manager, factor=2.0)
+    transform, second = run(root, storage_manager, factor=2.0)
+
+    assert first.derivation_key is None
+    assert not transform.reused and second.id != first.id
+    assert CountingScale.calls == 2
+
+    # Outside of a git repository there is no commit to identify the code.
+    monkeypatch.setattr(git_utils, "no_uncommitted_changes", lambda: None)
+    monkeypatch.setattr(git_utils, "get_most_recent_commit", lambda: None)
+    transform = CountingScale(root, None, storage_manager=storage_manager,
+                              factor=2.0)
+    assert transform.derivation_key() is None
+
+
+def test_shared_inputs_are_not_retrieved(root, storage_manager, monkeypatch):
+    with SharedPayloadStore() as store:
+        handle = storage_manager.retrieve_shared(root, store)
+        monkeypatch.setattr(storage_manager, "prepare_retrieve", None)
+        transform = CountingScale(root, None, storage_manager=storage_manager,
+                                  factor=2.0)
+        transform.shared_inputs = {root.id: handle}
+        transform.apply_transform()
+        transform.commit()
+    monkeypatch.undo()
+    np.testing.assert_array_equal(
+        storage_manager.retrieve(transform.new_timecourse),
+        np.arange(24, dtype=np.float32).reshape(2, 2, 2, 3) * 2)
+
+
+def test_views_reference_their_parent(session, root, storage_manager,
+                                      monkeypatch):
+    # Creating a view doesn't load its input.
+    monkeypatch.setattr(storage_manager, "prepare_retrieve", None)
+    transform = CropScale(root, None, storage_manager=storage_manager,
+                          start=1, stop=3, factor=2.0)
+    view = transform.apply_transform()
+    transform.commit()
+    monkeypatch.undo()
+
+    assert view.is_view and not root.is_view
+    assert [parent.id for parent in view.derived_from] == [root.id]
+    assert json.loads(view.transform.transform_params_json) == [
+        {"start": 1, "stop": 3, "factor": 2.0}]
+    expected = np.arange(24, dtype=np.float32).reshape(2, 2, 2, 3)[..., 1:3]
+    np.testing.assert_array_equal(storage_manager.retrieve(view),
+                                  expected * 2)
+
+    # Views of views apply their parents' operations first.
+    transform = CropScale(view, None, storage_manager=storage_manager,
+                          start=1, stop=None, factor=-1.0)
+    nested = transform.apply_transform()
+    transform.commit()
+    np.testing.assert_array_equal(storage_manager.retrieve(nested),
+                                  expected[..., 1:] * -2)
+    with storage_manager.open_reader(nested) as reader:
+        np.testing.assert_array_equal(reader.read(0, 1),
+                                      expected[..., 1:] * -2)
+    assert storage_manager.estimate_nbytes(nested) == \
+        storage_manager.estimate_nbytes(root)
+
+
+def test_derivation_key_ignores_param_order(root, storage_manager):
+    a = CountingScale(root, None, storage_manager=storage_manager,
+                      factor=2.0, offset=1)
+    b = CountingScale(root, None, storage_manager=storage_manager,
+                      offset=1, factor=2.0)
+    assert a.derivation_key() == b.derivation_key()
+
+
+def test_different_params_are_recomputed(session, root, storage_manager):
+    _, first = run(root, storage_manager, factor=2.0)
+    _, second = run(root, storage_manager, factor=3.0)
+
+    assert second.id != first.id
+    assert CountingScale.calls == 2
+
+
+def test_force_recomputes(session, root, storage_manager):
+    _, first = run(root, storage_manager, factor=2.0)
+    transform, second = run(root, storage_manager, force=True, factor=2.0)
+
+    assert not transform.reused
+    assert second.id != first.id
+    assert second.derivation_key == first.derivation_key
+    assert CountingScale.calls == 2
+
+
+def test_pipeline_fuses_steps(session, root, storage_manager):
+    pipeline = Pipeline(root, storage_manager=storage_manager, steps=[
+        (CountingScale, {"factor": 2.0}), (AddOffset, {"offset": 1.0})])
+    new_timecourse = pipeline.apply_transform()
+    pipeline.commit()
+
+    expected = storage_manager.retrieve(root) * 2.0 + 1.0
+    np.testing.assert_array_equal(storage_manager.retrieve(new_timecourse),
+                                  expected)
+    assert json.loads(new_timecourse.transform.transform_names_json) == [
+        "CountingScale", "AddOffset"]
+    assert json.loads(new_timecourse.transform.transform_params_json) == [
+        {"factor": 2.0}, {"offset": 1.0}]
+    assert new_timecourse.derived_from.all() == [root]
+    # No intermediate timecourse is stored without a checkpoint.
+    assert session.query(Timecourse).count() == 2
+
+
+def test_pipeline_checkpoints_and_resumes(session, root, storage_manager):
+    pipeline = Pipeline(root, storage_manager=storage_manager, steps=[
+        (CountingScale, {"factor": 2.0}), (AddOffset, {"offset": 1.0})],
+        checkpoints=["CountingScale"])
+    pipeline.apply_transform()
+    pipeline.commit()
+    checkpoint = pipeline.checkpoint_timecourses[0]
+    np.testing.assert_array_equal(storage_manager.retrieve(checkpoint),
+                                  storage_manager.retrieve(root) * 2.0)
+    assert session.query(Timecourse).count() == 3
+
+    # The checkpoint is the same derivation as running its prefix alone.
+    transform, scaled = run(root, storage_manager, factor=2.0)
+    assert transform.reused and scaled.id == checkpoint.id
+
+    # Changing a later step resumes from the checkpoint.
+    pipeline = Pipeline(root, storage_manager=storage_manager, steps=[
+        (CountingScale, {"factor": 2.0}), (AddOffset, {"offset": 5.0})],
+        checkpoints=[0])
+    new_timecourse = pipeline.apply_transform()
+    pipeline.commit()
+    assert CountingScale.calls == 1
+    np.testing.assert_array_equal(storage_manager.retrieve(new_timecourse),
+                                  storage_manager.retrieve(root) * 2.0 + 5.0)
+    assert session.query(Timecourse).count() == 4
+
+
+def test_pipeline_rejects_mismatched_steps(root, storage_manager):
+    class ToEEG(Transform):
+        input_datatype = FMRI
+        output_datatype = Data(256.0, Modality.IMAGING, DataType.EEG)
+
+        def transform(self, data):
+            return data[0]
+
+    with pytest.raises(ValueError):
+        Pipeline(root, storage_manager=storage_manager,
+                 steps=[ToEEG, (CountingScale, {"factor": 2.0})])
+
+
+@pytest.mark.parametrize("window", [1, 4, 7, 100])
+def test_streaming_matches_whole_payload(root, storage_manager, window):
+    transform = StreamingMovingSum(root, None, storage_manager=storage_manager,
+                                   window=window)
+    new_timecourse = transform.apply_transform()
+    assert isinstance(transform.out_data, np.memmap)
+    transform.commit()
+
+    expected = moving_sum(storage_manager.retrieve(root))
+    np.testing.assert_allclose(storage_manager.retrieve(new_timecourse),
+                               expected)
+
+
+def test_streaming_step_in_pipeline(root, storage_manager):
+    pipeline = Pipeline(root, storage_manager=storage_manager, steps=[
+        (CountingScale, {"factor": 2.0}), StreamingMovingSum])
+    new_timecourse = pipeline.apply_transform()
+    pipeline.commit()
+
+    expected = moving_sum(storage_manager.retrieve(root) * 2.0)
+    np.testing.assert_allclose(storage_manager.retrieve(new_timecourse),
+                               expected)
+
+
+def test_batch_commits_in_groups(session, root, storage_manager,
+                                 monkeypatch):
+    from ..utils import git_utils
+    calls = []
+    get_commit = git_utils.get_most_recent_commit
+    monkeypatch.setattr(git_utils, "get_most_recent_commit",
+                        lambda: calls.append(1) or get_commit())
+
+    with TransformBatch(session, storage_manager, batch_size=2) as batch:
+        outputs = batch.run(CountingScale, [root], factor=2.0)
+        outputs += batch.run(CountingScale, [root], factor=3.0)
+        assert batch.n_committed == 2
+        # Chained on an output of the batch, and reusing a pending output.
+        chained = batch.run(AddOffset, outputs[:1], offset=1.0)
+        again = batch.run(AddOffset, outputs[:1], offset=1.0)
+        assert again[0] is chained[0]
+        assert batch.n_committed == 2
+
+    assert batch.n_committed == 3
+    assert len(calls) == 1
+    assert session.query(Timecourse).count() == 4
+    np.testing.assert_array_equal(storage_manager.retrieve(chained[0]),
+                                  storage_manager.retrieve(root) * 2.0 + 1.0)
+
+
+def test_batch_rolls_back_on_error(session, root, storage_manager):
+    with pytest.raises(RuntimeError):
+        with TransformBatch(session, storage_manager) as batch:
+            transform = CountingScale(root, None, factor=2.0)
+            assert transform.storage_manager is storage_manager
+            transform.apply_transform()
+            transform.commit()
+            raise RuntimeError("interrupted")
+    assert session.query(Timecourse).count() == 1
+    assert session.query(TransformRun).count() == 0
+
+
+def test_run_records_stages(session, root, storage_manager):
+    transform, new_timecourse = run(root, storage_manager, factor=2.0)
+
+    run_record = session.query(TransformRun).one()
+    assert run_record.timecourse_id == new_timecourse.id
+    assert run_record.transform == "CountingScale"
+    assert run_record.git_commit == new_timecourse.transform.git_commit
+    stages = {stage.stage: stage for stage in run_record.stages}
+    assert [stage.stage for stage in run_record.stages] == [
+        "lookup", "load", "load/decode", "transform", "construct", "store",
+        "store/serialize", "store/upload", "db_commit"]
+    size = stages["store/serialize"].bytes
+    assert size > 0 and stages["store"].bytes == size
+    assert stages["load"].bytes == stages["load/decode"].bytes > 0
+    assert stages["transform"].bytes is None
+    assert run_record.wall_time == pytest.approx(sum(
+        stage.wall_time for stage in run_record.stages
+        if "/" not in stage.stage))
+    assert all(stage.cpu_time >= 0 for stage in run_record.stages)
+    assert run_record.max_rss > 0
+
+    # Reusing the output isn't a run.
+    transform, _ = run(root, storage_manager, factor=2.0)
+    assert transform.reused
+    assert session.query(TransformRun).count() == 1
+
+
+def test_runs_are_queryable(session, root, storage_manager):
+    run(root, storage_manager, factor=2.0)
+    run(root, storage_manager, factor=3.0)
+    with TransformBatch(session, storage_manager):
+        run(root, storage_manager, factor=4.0)
+
+    slowest = get_slowest_stages(session, "transform",
+                                 transform="CountingScale")
+    assert len(slowest) == 3
+    assert slowest[0].wall_time >= slowest[-1].wall_time
+
+    summary = summarize_stages_by_commit(session, "CountingScale")
+    by_stage = {row.stage: row for row in summary}
+    assert by_stage["transform"].runs == 3
+    # Batched runs share the batch's commit.
+    assert by_stage["db_commit"].runs == 2
+
+
+class SlowStorageManager(LocalStorageManager):
+    def _upload_data_to_uri(self, fname, uri):
+        time.sleep(0.1)
+
+
+class SlowScale(Transform):
+    input_datatype = FMRI
+    output_datatype = FMRI
+
+    def prepare_load(self):
+        load = super().prepare_load()
+
+        def slow_load():
+            time.sleep(0.1)
+            return load()
+        return slow_load
+
+    def transform(self, data):
+        time.sleep(0.1)
+        if self.params.get("fail_on") == float(data[0].flat[0]):
+            raise ValueError("Asked to fail")
+        return data[0] * self.params["factor"]
+
+
+# Outputs being stored aren't in the session, yet flushes don't warn.
+@pytest.mark.filterwarnings("error::sqlalchemy.exc.SAWarning")
+def test_overlapping_runner_overlaps_io(session, tmp_path):
+    storage_manager = SlowStorageManager(file_root=str(tmp_path))
+    roots = add_roots(session, storage_manager, range(6))
+    expected = [storage_manager.retrieve(tc) * 2.0 for tc in roots]
+
+    start = time.perf_counter()
+    outputs = OverlappingRunner(SlowScale, {"factor": 2.0},
+                                storage_manager=storage_manager,
+                                prefetch=2).run(roots)
+    elapsed = time.perf_counter() - start
+
+    # Loading, transforming and storing each take 0.1s per input, so 1.8s
+    # one after another and a little over 0.6s overlapped.
+    assert elapsed < 1.3
+    assert [tc.derived_from.one().id for tc in outputs] == [
+        tc.id for tc in roots]
+    for output, payload in zip(outputs, expected):
+        np.testing.assert_array_equal(storage_manager.retrieve(output),
+                                      payload)
+    run_record = session.query(TransformRun).filter_by(
+        timecourse_id=outputs[0].id).one()
+    stages = [stage.stage for stage in run_record.stages]
+    assert "load/decode" in stages and "store/upload" in stages
+
+    # Everything is reused the second time.
+    again = OverlappingRunner(SlowScale, {"factor": 2.0},
+                              storage_manager=storage_manager).run(roots)
+    assert [tc.id for tc in again] == [tc.id for tc in outputs]
+
+
+def test_overlapping_runner_stops_on_error(session, storage_manager):
+    roots = add_roots(session, storage_manager, range(5))
+    runner = OverlappingRunner(SlowScale, {"factor": 2.0, "fail_on": 2.0},
+                               storage_manager=storage_manager,
+                               max_buffered_bytes=1)
+    with pytest.raises(ValueError, match="Asked to fail"):
+        runner.run(roots)
+    # The outputs before the failure were committed.
+    assert session.query(Timecourse).count() == 5 + 2
@@ -1 +1,11 @@
-from .transform import RawDataUpload,Transform
\ No newline at end of file
+from .transform import RawDataUpload,Transform, ViewTransform
+from .admission import MemoryBudget, MemoryEstimator
+from .batch import TransformBatch
+from .graph import GraphNode, GraphReport, GraphScheduler, TransformGraph
+from .jobs import QueueWorker, enqueue
+from .overlap import OverlappingRunner
+from .pipeline import Pipeline
+from .rebuild import RebuildReport, Rebuilder
+from .runner import RunSummary, TransformRunner
+from .streaming import StreamingTransform
+from .sweep import ParameterSweep, SweepReport, SweepResult, param_grid
@@ -0,0 +1,131 @@
+"""
+Memory-aware admission of transforms run concurrently.
+
+Transforms estimate the peak memory of a run from the size of their inputs
+(Transform.estimate_memory). A MemoryEstimator refines those estimates with
+the peaks observed in earlier runs, and a MemoryBudget admits runs only
+while the sum of the estimates of those running fits in the host's memory.
+TransformRunner uses both when given a ``memory_budget``.
+"""
+from typing import Deque, Dict, Optional
+
+from collections import deque
+import os
+import threading
+
+from .transform import Transform
+
+
+def host_memory() -> Optional[int]:
+    """The physical memory of this machine in bytes, if known."""
+    try:
+        return os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+class MemoryBudget:
+    """Admits work while the estimates of what is running fit a limit.
+
+    A run whose estimate alone exceeds the limit is still admitted once
+    nothing else is running, so large runs wait rather than never running.
+    Budgets are thread-safe and may be shared by several runners.
+
+    Args:
+        limit: Bytes of memory the admitted runs may use together.
+    """
+
+    def __init__(self, limit: int):
+        if limit <= 0:
+            raise ValueError(f"Invalid memory limit {limit}.")
+        self.limit = limit
+        self.in_use = 0
+        self.running = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_host(cls, fraction: float = 0.8) -> 'MemoryBudget':
+        """A budget of a fraction of this machine's physical memory."""
+        total = host_memory()
+        if total is None:
+            raise ValueError("Can't tell how much memory this machine has; "
+                             "give a limit.")
+        return cls(int(total * fraction))
+
+    def try_acquire(self, nbytes: int) -> bool:
+        """Admit a run estimated to use ``nbytes``, if it fits."""
+        with self._lock:
+            if self.running and self.in_use + nbytes > self.limit:
+                return False
+            self.in_use += nbytes
+            self.running += 1
+            return True
+
+    def release(self, nbytes: int):
+        """Return the memory of a finished run admitted with ``nbytes``."""
+        with self._lock:
+            self.in_use -= nbytes
+            self.running -= 1
+
+    def __repr__(self) -> str:
+        return (f"MemoryBudget(in_use={self.in_use}, limit={self.limit}, "
+                f"running={self.running})")
+
+
+class MemoryEstimator:
+    """Estimates the peak memory of transform runs, learning from peaks seen.
+
+    Until a transform has been observed, its own estimate is used
+    (Transform.estimate_memory), or ``default`` if it has none. Once runs
+    have been observed, the estimate is the input size times the largest
+    ratio of peak memory to input size among the last ``history`` runs of
+    the transform, plus ``headroom``. Estimates so follow a transform's
+    actual use up as well as down.
+
+    Args:
+        default: Bytes assumed for runs that can't be estimated.
+        headroom: Fraction added to learned estimates.
+        history: Number of recent runs per transform to learn from.
+    """
+
+    def __init__(self, default: int = 1 << 30, headroom: float = 0.2,
+                 history: int = 20):
+        self.default = default
+        self.headroom = headroom
+        self.history = history
+        self._ratios: Dict[str, Deque[float]] = {}
+        self._lock = threading.Lock()
+
+    def estimate(self, transform: Transform,
+                 input_nbytes: Optional[int] = None) -> int:
+        """Estimate the peak memory of a transform's run, in bytes.
+
+        Args:
+            transform: The transform, with its inputs.
+            input_nbytes: The size of its inputs once loaded, if already
+                known (see Transform.input_nbytes).
+        """
+        if input_nbytes is None:
+            input_nbytes = transform.input_nbytes()
+        ratio = self.learned_ratio(type(transform).__name__)
+        if ratio is not None and input_nbytes is not None:
+            return int(input_nbytes * ratio * (1 + self.headroom))
+        estimate = transform.estimate_memory(input_nbytes)
+        return self.default if estimate is None else estimate
+
+    def observe(self, transform_name: str, input_nbytes: Optional[int],
+                peak: Optional[int]):
+        """Record the peak memory used by a run of a transform."""
+        if not input_nbytes or peak is None:
+            return
+        with self._lock:
+            ratios = self._ratios.setdefault(
+                transform_name, deque(maxlen=self.history))
+            # A run holds at least its inputs.
+            ratios.append(max(peak / input_nbytes, 1.0))
+
+    def learned_ratio(self, transform_name: str) -> Optional[float]:
+        """The largest recent ratio of peak memory to input size, if any."""
+        with self._lock:
+            ratios = self._ratios.get(transform_name)
+            return max(ratios) if ratios else None
@@ -0,0 +1,135 @@
+from typing import (TYPE_CHECKING, Dict, Iterable, List, Optional, Set, Type)
+
+import sqlalchemy.orm
+
+from contextvars import ContextVar
+
+from ..db import Session
+from ..models import Timecourse
+from ..storage import StorageManager
+from ..utils import git_utils
+
+if TYPE_CHECKING:
+    from .transform import Transform
+
+
+_CURRENT_BATCH: ContextVar[Optional['TransformBatch']] = ContextVar(
+    'transform_batch', default=None)
+
+
+def current_batch() -> Optional['TransformBatch']:
+    """The TransformBatch that is currently open, if any."""
+    return _CURRENT_BATCH.get()
+
+
+class TransformBatch:
+    """A context that amortizes the fixed cost of many small transforms.
+
+    While a batch is open, every Transform:
+
+    - uses the git commit and working tree state snapshotted when the batch
+      was opened, instead of running git for every timecourse,
+    - uses the batch's storage manager and, when constructed without a
+      timecourse, its session, and
+    - adds its new timecourse to the session on commit() without committing
+      it. The batch commits every ``batch_size`` timecourses, so ids are
+      assigned by one multi-row INSERT ... RETURNING per batch, and commits
+      whatever is left when it closes.
+
+    If the block raises, the uncommitted timecourses are rolled back (their
+    payloads, which were already stored, are left behind).
+
+    Example:
+        with TransformBatch(session, storage_manager) as batch:
+            for tc in timecourses:
+                transform = FilterTransform(tc, None, cutoff_freq=30)
+                transform.apply_transform()
+                transform.commit()
+
+    Args:
+        session: The session to commit. Defaults to a new session.
+        storage_manager: Shared by every transform that isn't given one.
+            Defaults to the Transform default.
+        batch_size: Number of new timecourses committed at once.
+    """
+
+    def __init__(self, session: Optional[sqlalchemy.orm.Session] = None,
+                 storage_manager: Optional[StorageManager] = None,
+                 batch_size: int = 500):
+        if batch_size < 1:
+            raise ValueError(f"Invalid batch size {batch_size}.")
+        self.session = session if session is not None else Session()
+        self.storage_manager = storage_manager
+        self.batch_size = batch_size
+        self.git_commit: Optional[str] = None
+        self.git_clean: Optional[bool] = None
+        self.n_committed = 0
+        self._pending: List[Timecourse] = []
+        self._pending_keys: Dict[str, Timecourse] = {}
+        self._sessions: Set[sqlalchemy.orm.Session] = set()
+        self._token = None
+
+    def __enter__(self) -> 'TransformBatch':
+        if self._token is not None:
+            raise RuntimeError("This TransformBatch is already open.")
+        self.git_commit = git_utils.get_most_recent_commit()
+        self.git_clean = git_utils.no_uncommitted_changes()
+        self._token = _CURRENT_BATCH.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _CURRENT_BATCH.reset(self._token)
+        self._token = None
+        if exc_type is None:
+            self.flush()
+        else:
+            for session in self._sessions:
+                session.rollback()
+            self._pending.clear()
+            self._pending_keys.clear()
+            self._sessions.clear()
+
+    def add(self, timecourse: Timecourse,
+            session: sqlalchemy.orm.Session):
+        """Add a new timecourse, committing the batch once it is full."""
+        session.add(timecourse)
+        self._sessions.add(session)
+        self._pending.append(timecourse)
+        if timecourse.derivation_key is not None:
+            self._pending_keys[timecourse.derivation_key] = timecourse
+        if len(self._pending) >= self.batch_size:
+            self.flush()
+
+    def find_pending(self, derivation_key: str) -> Optional[Timecourse]:
+        """A timecourse with the derivation key that isn't committed yet."""
+        return self._pending_keys.get(derivation_key)
+
+    def flush(self):
+        """Commit the pending timecourses."""
+        for session in self._sessions:
+            session.commit()
+        self.n_committed += len(self._pending)
+        self._pending.clear()
+        self._pending_keys.clear()
+        self._sessions.clear()
+
+    def run(self, transform_cls: Type['Transform'],
+            timecourses: Iterable[Timecourse], force: bool = False,
+            **params) -> List[Timecourse]:
+        """Apply a transform to each timecourse within the batch.
+
+        Returns:
+            The new (or reused) timecourses, in order. They are committed
+            when the batch fills up or closes.
+        """
+        if self._token is None:
+            raise RuntimeError("TransformBatch.run must be called inside the "
+                               "batch's with block.")
+        new_timecourses = []
+        for timecourse in timecourses:
+            transform = transform_cls(timecourse, self.session,
+                                      storage_manager=self.storage_manager,
+                                      **params)
+            new_timecourses.append(transform.apply_transform(force=force))
+            transform.commit()
+        return new_timecourses
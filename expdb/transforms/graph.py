@@ -0,0 +1,411 @@
+"""
+Declarative graphs of transforms, run per subject with independent branches
+in parallel.
+
+A TransformGraph names the source data types a preprocessing graph starts
+from and the transform nodes computed from them:
+
+    graph = TransformGraph(
+        sources={"eeg": DataType.EEG, "behavior": DataType.INPUT_RESPONSE},
+        nodes={
+            "filtered": GraphNode(FilterTransform, ["eeg"],
+                                  {"cutoff_freq": 30}),
+            "ica": GraphNode(ICATransform, ["filtered"]),
+            "epochs": GraphNode(EpochTransform, ["ica", "behavior"]),
+        })
+
+or, from a JSON or YAML config, with transforms given by "module:Class" (or
+by class name, if the module defining them is imported):
+
+    graph = TransformGraph.from_spec({
+        "sources": {"eeg": "EEG", "behavior": "INPUT_RESPONSE"},
+        "nodes": {
+            "filtered": {"transform": "mylab.transforms:FilterTransform",
+                         "inputs": ["eeg"], "params": {"cutoff_freq": 30}},
+            ...
+        }})
+
+A GraphScheduler then runs the graph for every subject.
+"""
+from typing import (Any, Callable, Dict, Iterable, List, Mapping, Optional,
+                    Sequence, Set, Tuple, Type, Union)
+
+import sqlalchemy.orm
+
+from concurrent.futures import (FIRST_COMPLETED, Future, ProcessPoolExecutor,
+                                wait)
+import dataclasses
+import functools
+import multiprocessing
+import time
+import traceback
+
+from ..config import get_config
+from ..models import DataType, Study, Subject, Timecourse
+from ..storage import GCSStorageManager, StorageManager
+from . import runner
+from .jobs import resolve_transform
+from .transform import TRANSFORMS, Transform
+
+CONFIG = get_config()
+
+# A task of a scheduler run: a node of the graph for one subject.
+TaskKey = Tuple[int, str]
+
+
+@dataclasses.dataclass
+class GraphNode:
+    """A transform of a TransformGraph.
+
+    Attributes:
+        transform: The Transform subclass, or its "module:Class" path or
+            registered class name.
+        inputs: Names of the sources or nodes whose outputs are the
+            transform's inputs, in order.
+        params: Parameters passed to the transform.
+    """
+    transform: Union[Type[Transform], str]
+    inputs: Sequence[str]
+    params: Dict[str, Any] = dataclasses.field(default_factory=dict)
+
+    @property
+    def transform_cls(self) -> Type[Transform]:
+        if isinstance(self.transform, str):
+            if ":" not in self.transform and self.transform in TRANSFORMS:
+                return TRANSFORMS[self.transform]
+            return resolve_transform(self.transform)
+        return self.transform
+
+
+class TransformGraph:
+    """A DAG of transforms over the source data of each subject.
+
+    Each source stands for a subject's most recent upload (a timecourse
+    derived from nothing) of a data type. Each node applies a transform to
+    the outputs of other sources and nodes.
+
+    Args:
+        sources: Data types of the source uploads, by name.
+        nodes: The transforms, by name.
+
+    Raises:
+        ValueError: If a node has no inputs or an unknown one, names clash,
+            the graph has a cycle, or a node's first input is not of the data
+            type its transform takes.
+    """
+
+    def __init__(self, sources: Mapping[str, DataType],
+                 nodes: Mapping[str, GraphNode]):
+        clash = set(sources) & set(nodes)
+        if clash:
+            raise ValueError(f"Names {sorted(clash)} are both sources and "
+                             f"nodes.")
+        self.sources = dict(sources)
+        self.nodes = dict(nodes)
+        for name, node in self.nodes.items():
+            if not node.inputs:
+                raise ValueError(f"Node {name} has no inputs.")
+            unknown = [i for i in node.inputs
+                       if i not in self.sources and i not in self.nodes]
+            if unknown:
+                raise ValueError(f"Node {name} has unknown inputs {unknown}.")
+        self.order = self._sort()
+        for name in self.order:
+            self._check_types(name)
+
+    @classmethod
+    def from_spec(cls, spec: Mapping[str, Any]) -> 'TransformGraph':
+        """Build a graph from plain data, as loaded from JSON or YAML.
+
+        Args:
+            spec: A mapping with "sources", mapping names to DataType names,
+                and "nodes", mapping names to mappings of "transform",
+                "inputs" and optionally "params".
+        """
+        sources = {name: DataType[data_type] if isinstance(data_type, str)
+                   else data_type
+                   for name, data_type in spec.get("sources", {}).items()}
+        nodes = {name: GraphNode(node["transform"], list(node["inputs"]),
+                                 dict(node.get("params", {})))
+                 for name, node in spec.get("nodes", {}).items()}
+        return cls(sources, nodes)
+
+    def _sort(self) -> List[str]:
+        """The nodes in dependency order (Kahn's algorithm)."""
+        waiting = {name: {i for i in node.inputs if i in self.nodes}
+                   for name, node in self.nodes.items()}
+        order = []
+        ready = sorted(name for name, deps in waiting.items() if not deps)
+        while ready:
+            name = ready.pop(0)
+            order.append(name)
+            for other, deps in waiting.items():
+                if name in deps:
+                    deps.discard(name)
+                    if not deps:
+                        ready.append(other)
+        cyclic = sorted(set(self.nodes) - set(order))
+        if cyclic:
+            raise ValueError(f"Nodes {cyclic} form a cycle.")
+        return order
+
+    def _check_types(self, name: str):
+        node = self.nodes[name]
+        expected = node.transform_cls.input_datatype
+        first = node.inputs[0]
+        if first in self.sources:
+            if self.sources[first] != expected.type:
+                raise ValueError(
+                    f"Node {name} takes {expected.type}, but source {first} "
+                    f"is {self.sources[first]}.")
+        else:
+            produced = getattr(self.nodes[first].transform_cls,
+                               "output_datatype", None)
+            if produced is not None and produced != expected:
+                raise ValueError(f"Node {name} takes {expected}, but node "
+                                 f"{first} produces {produced}.")
+
+    def required(self, targets: Optional[Iterable[str]] = None) -> List[str]:
+        """The nodes needed to compute ``targets``, in dependency order.
+
+        Defaults to every node.
+        """
+        if targets is None:
+            return list(self.order)
+        needed: Set[str] = set()
+        frontier = list(targets)
+        while frontier:
+            name = frontier.pop()
+            if name not in self.nodes:
+                raise ValueError(f"Unknown node {name}.")
+            if name not in needed:
+                needed.add(name)
+                frontier.extend(i for i in self.nodes[name].inputs
+                                if i in self.nodes)
+        return [name for name in self.order if name in needed]
+
+
+@dataclasses.dataclass
+class GraphReport:
+    """What a GraphScheduler run did, by (subject id, node name).
+
+    Attributes:
+        created: The ids of newly computed timecourses.
+        reused: The ids of existing identical derivations that were reused.
+        failed: The error of each task that raised.
+        skipped: Why each task that didn't run was skipped: a missing source
+            or an input that failed.
+        elapsed: Wall time of the run, in seconds.
+    """
+    created: Dict[TaskKey, int] = dataclasses.field(default_factory=dict)
+    reused: Dict[TaskKey, int] = dataclasses.field(default_factory=dict)
+    failed: Dict[TaskKey, str] = dataclasses.field(default_factory=dict)
+    skipped: Dict[TaskKey, str] = dataclasses.field(default_factory=dict)
+    elapsed: float = 0.0
+
+    def outputs(self, node: str) -> Dict[int, int]:
+        """Maps each subject id to the timecourse id of a node's output."""
+        return {subject_id: tc_id
+                for (subject_id, name), tc_id in {**self.reused,
+                                                  **self.created}.items()
+                if name == node}
+
+    def __repr__(self) -> str:
+        return (f"GraphReport(created={len(self.created)}, "
+                f"reused={len(self.reused)}, failed={len(self.failed)}, "
+                f"skipped={len(self.skipped)})")
+
+
+class GraphScheduler:
+    """Runs a TransformGraph for every subject, in parallel.
+
+    For each subject, the graph's sources are looked up and each node
+    becomes a task that runs once all of its inputs have. Tasks of any
+    subject whose inputs are ready run concurrently in a process pool, so
+    independent branches of the graph, and the graphs of different subjects,
+    fill the workers instead of one subject's chain running at a time.
+
+    Before a task is submitted, its transform looks for an identical
+    derivation (see Transform.find_existing); if there is one, it is reused
+    without running. A task whose input failed or whose subject lacks a
+    source is skipped, along with everything downstream of it, while the
+    rest of the graph carries on.
+
+    Example:
+        report = GraphScheduler(
+            graph, session.query(Subject), study=study,
+            storage_manager_factory=functools.partial(
+                GCSStorageManager, "gs://bucket", local_cache_dir="cache")
+        ).run(targets=["epochs"])
+
+    Args:
+        graph: The graph to run.
+        subjects: The subjects to run it for.
+        session: Used to find the sources and existing derivations.
+            Defaults to the session of the subjects' query.
+        study: If given, only this study's uploads are sources.
+        storage_manager_factory: A picklable callable that builds the storage
+            managers, as for TransformRunner.
+        n_workers: Number of worker processes. Defaults to the CPU count. 0
+            runs every task in this process, with ``session``.
+        progress: Called with a message as each task finishes.
+        database_url: As for TransformRunner.
+    """
+
+    def __init__(self, graph: TransformGraph,
+                 subjects: Union[sqlalchemy.orm.Query, Iterable[Subject]],
+                 session: Optional[sqlalchemy.orm.Session] = None,
+                 study: Optional[Study] = None,
+                 storage_manager_factory: Optional[
+                     Callable[[], StorageManager]] = None,
+                 n_workers: Optional[int] = None,
+                 progress: Optional[Callable[[str], None]] = print,
+                 database_url: Optional[str] = None):
+        self.graph = graph
+        if session is None:
+            session = getattr(subjects, "session", None)
+        if session is None:
+            raise ValueError("Give a session, or subjects as a query.")
+        self.session = session
+        self.subjects = list(subjects)
+        self.study = study
+        if storage_manager_factory is None:
+            storage_manager_factory = functools.partial(
+                GCSStorageManager, f"gs://{CONFIG.GS_BUCKET_NAME}",
+                local_cache_dir=CONFIG.CACHE_DIR)
+        self.storage_manager_factory = storage_manager_factory
+        self.n_workers = n_workers
+        self.progress = progress
+        self.database_url = database_url
+
+    def _source(self, subject: Subject,
+                data_type: DataType) -> Optional[Timecourse]:
+        """A subject's most recent upload of a data type."""
+        query = (self.session.query(Timecourse)
+                 .filter(Timecourse.subject_id == subject.id,
+                         Timecourse.__table__.c.type == data_type,
+                         ~Timecourse.derived_from.any()))
+        if self.study is not None:
+            query = query.filter(Timecourse.study_id == self.study.id)
+        return query.order_by(Timecourse.date_collected.desc(),
+                              Timecourse.id.desc()).first()
+
+    def run(self, targets: Optional[Iterable[str]] = None) -> GraphReport:
+        """Compute ``targets`` (by default, every node) for every subject."""
+        started = time.monotonic()
+        names = self.graph.required(targets)
+        report = GraphReport()
+        # Output timecourse id of every finished source and task.
+        outputs: Dict[TaskKey, int] = {}
+        waiting: List[TaskKey] = []
+        for subject in self.subjects:
+            for name in self.graph.sources:
+                source = self._source(subject, self.graph.sources[name])
+                if source is not None:
+                    outputs[(subject.id, name)] = source.id
+            waiting.extend((subject.id, name) for name in names)
+
+        storage_manager = self.storage_manager_factory()
+        executor = None
+        if self.n_workers != 0:
+            database_url = (self.database_url or
+                            runner.session_database_url(self.session))
+            executor = ProcessPoolExecutor(
+                max_workers=self.n_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=runner.init_worker,
+                initargs=(database_url, self.storage_manager_factory))
+        pending: Dict[Future, TaskKey] = {}
+
+        def finish(key: TaskKey, new_id: Optional[int],
+                   error: Optional[str]):
+            if error is not None:
+                report.failed[key] = error
+                message = (f"{key[1]} of subject {key[0]} failed: "
+                           f"{error.strip().splitlines()[-1]}")
+            else:
+                outputs[key] = new_id
+                report.created[key] = new_id
+                message = f"{key[1]} of subject {key[0]} -> {new_id}"
+            if self.progress is not None:
+                self.progress(message)
+
+        try:
+            while waiting or pending:
+                started_any = True
+                while started_any:
+                    started_any = False
+                    for key in list(waiting):
+                        state = self._state(key, outputs, report)
+                        if state == "waiting":
+                            continue
+                        waiting.remove(key)
+                        started_any = True
+                        if state != "ready":
+                            report.skipped[key] = state
+                            continue
+                        self._start(key, outputs, report, storage_manager,
+                                    executor, pending, finish)
+                if not pending:
+                    # Nothing can make progress.
+                    for key in waiting:
+                        report.skipped[key] = "inputs were never computed"
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    finish(pending.pop(future), *runner.result_or_error(future))
+        finally:
+            if executor is not None:
+                for future in pending:
+                    future.cancel()
+                executor.shutdown()
+
+        self.session.expire_all()
+        report.elapsed = time.monotonic() - started
+        return report
+
+    def _state(self, key: TaskKey, outputs: Dict[TaskKey, int],
+               report: GraphReport) -> str:
+        """"ready", "waiting", or why the task must be skipped."""
+        subject_id, name = key
+        state = "ready"
+        for input_name in self.graph.nodes[name].inputs:
+            input_key = (subject_id, input_name)
+            if input_key in outputs:
+                continue
+            if input_name in self.graph.sources:
+                return f"no {input_name} source"
+            if input_key in report.failed or input_key in report.skipped:
+                return f"input {input_name} was not computed"
+            state = "waiting"
+        return state
+
+    def _start(self, key: TaskKey, outputs: Dict[TaskKey, int],
+               report: GraphReport, storage_manager: StorageManager,
+               executor: Optional[ProcessPoolExecutor],
+               pending: Dict[Future, TaskKey],
+               finish: Callable[[TaskKey, Optional[int], Optional[str]],
+                                None]):
+        subject_id, name = key
+        node = self.graph.nodes[name]
+        classes, params = [node.transform_cls], [node.params]
+        input_ids = [outputs[(subject_id, i)] for i in node.inputs]
+        inputs = [self.session.get(Timecourse, tc_id) for tc_id in input_ids]
+        transform = runner.build_transform(classes, params, inputs,
+                                           self.session, storage_manager)
+        existing = transform.find_existing()
+        if existing is not None:
+            outputs[key] = existing.id
+            report.reused[key] = existing.id
+            return
+        if executor is not None:
+            future = executor.submit(runner.derive_in_worker, classes,
+                                     params, input_ids)
+            pending[future] = key
+            return
+        try:
+            finish(key, runner.derive(classes, params, input_ids,
+                                      self.session, storage_manager), None)
+        except Exception:
+            self.session.rollback()
+            finish(key, None, traceback.format_exc())
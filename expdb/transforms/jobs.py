@@ -0,0 +1,362 @@
+"""
+A job queue for running transforms on several machines.
+
+Jobs are rows of the ``transform_jobs`` table, so any number of workers
+pointed at the same database (Postgres, or SQLite for a single machine) can
+share the work:
+
+    enqueue(session, FilterTransform, timecourses, cutoff_freq=30)
+
+and on each machine:
+
+    python -m expdb.transforms.jobs --database-url postgresql://... \\
+        --import mylab.transforms
+
+Workers claim the oldest queued job with ``SELECT ... FOR UPDATE SKIP
+LOCKED`` where the database supports it, and with a compare-and-set UPDATE
+otherwise. While a job runs, a thread updates its heartbeat; jobs whose
+worker stopped heartbeating are queued again (or failed, once they have used
+up their attempts) by the next worker to look for work.
+"""
+from typing import Any, Dict, Iterable, List, Optional, Type, Union
+
+import sqlalchemy
+import sqlalchemy.orm
+from sqlalchemy import select, update
+from sqlalchemy.orm import sessionmaker
+
+from datetime import datetime, timedelta, timezone
+import argparse
+import importlib
+import json
+import os
+import socket
+import threading
+import time
+import traceback
+import uuid
+
+from ..config import get_config
+from ..models import JobStatus, Timecourse, TransformJob
+from ..storage import GCSStorageManager, LocalStorageManager, StorageManager
+from .transform import TRANSFORMS, CustomParamsEncoder, Transform
+
+CONFIG = get_config()
+
+# Dialects that support SELECT ... FOR UPDATE SKIP LOCKED.
+_SKIP_LOCKED_DIALECTS = ("postgresql", "mysql", "oracle")
+
+
+def _utcnow() -> datetime:
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def transform_path(transform_cls: Type[Transform]) -> str:
+    """The "module:ClassName" a job records its transform as."""
+    return f"{transform_cls.__module__}:{transform_cls.__qualname__}"
+
+
+def resolve_transform(path: str) -> Type[Transform]:
+    """Import the Transform subclass recorded by transform_path()."""
+    module_name, _, name = path.partition(":")
+    try:
+        obj = importlib.import_module(module_name)
+        for attr in name.split("."):
+            obj = getattr(obj, attr)
+        return obj
+    except (ImportError, AttributeError):
+        # e.g. defined in a script run as __main__ on the enqueuing machine.
+        if name in TRANSFORMS:
+            return TRANSFORMS[name]
+        raise
+
+
+def enqueue(session: sqlalchemy.orm.Session,
+            transform_cls: Type[Transform],
+            inputs: Iterable[Union[Timecourse, int]],
+            max_attempts: int = 3, per_input: bool = True,
+            **params) -> List[TransformJob]:
+    """Queue a transform to be run by workers.
+
+    Args:
+        session: Session used to add (and commit) the jobs.
+        transform_cls: The Transform subclass. It must be importable by the
+            workers, by module and class name.
+        inputs: Input timecourses, or their ids.
+        max_attempts: How many times a failing job is tried.
+        per_input: If True, queue one job per input. Otherwise queue a single
+            job with all the inputs.
+        **params: JSON-serializable parameters passed to the transform.
+
+    Returns:
+        The new jobs.
+    """
+    input_ids = [tc if isinstance(tc, int) else tc.id for tc in inputs]
+    groups = [[tc_id] for tc_id in input_ids] if per_input else [input_ids]
+    params_json = json.dumps(params, cls=CustomParamsEncoder)
+    jobs = [TransformJob(transform=transform_path(transform_cls),
+                         params_json=params_json,
+                         input_ids_json=json.dumps(group),
+                         status=JobStatus.QUEUED, attempts=0,
+                         max_attempts=max_attempts)
+            for group in groups]
+    session.add_all(jobs)
+    session.commit()
+    return jobs
+
+
+def claim_job(session: sqlalchemy.orm.Session,
+              worker_id: str) -> Optional[TransformJob]:
+    """Claim the oldest queued job for a worker.
+
+    Returns:
+        The claimed job, now RUNNING, or None if the queue is empty.
+    """
+    dialect = session.get_bind().dialect.name
+    while True:
+        candidates = (select(TransformJob.id)
+                      .where(TransformJob.status == JobStatus.QUEUED)
+                      .order_by(TransformJob.id)
+                      .limit(1))
+        if dialect in _SKIP_LOCKED_DIALECTS:
+            candidates = candidates.with_for_update(skip_locked=True)
+        job_id = session.execute(candidates).scalar()
+        if job_id is None:
+            session.commit()
+            return None
+        now = _utcnow()
+        # Without row locks, another worker may have claimed the job since
+        # it was selected; the status condition makes the claim atomic.
+        claimed = session.execute(
+            update(TransformJob)
+            .where(TransformJob.id == job_id,
+                   TransformJob.status == JobStatus.QUEUED)
+            .values(status=JobStatus.RUNNING, worker_id=worker_id,
+                    attempts=TransformJob.attempts + 1, claimed_at=now,
+                    heartbeat_at=now)
+            .execution_options(synchronize_session=False)
+        ).rowcount
+        session.commit()
+        if claimed:
+            return session.get(TransformJob, job_id, populate_existing=True)
+
+
+def requeue_dead_jobs(session: sqlalchemy.orm.Session,
+                      timeout: float) -> int:
+    """Requeue (or fail) running jobs that haven't heartbeat for a while.
+
+    Args:
+        timeout: Seconds since the last heartbeat after which a worker is
+            considered dead.
+
+    Returns:
+        The number of jobs that were requeued or failed.
+    """
+    cutoff = _utcnow() - timedelta(seconds=timeout)
+    dead = ((TransformJob.status == JobStatus.RUNNING)
+            & (TransformJob.heartbeat_at < cutoff))
+    failed = session.execute(
+        update(TransformJob)
+        .where(dead, TransformJob.attempts >= TransformJob.max_attempts)
+        .values(status=JobStatus.FAILED, finished_at=_utcnow(),
+                error="The worker running the job stopped responding.")
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    requeued = session.execute(
+        update(TransformJob)
+        .where(dead)
+        .values(status=JobStatus.QUEUED, worker_id=None)
+        .execution_options(synchronize_session=False)
+    ).rowcount
+    session.commit()
+    return failed + requeued
+
+
+class _Heartbeat:
+    """Updates a running job's heartbeat from a background thread."""
+
+    def __init__(self, session_factory: sessionmaker, job_id: int,
+                 worker_id: str, interval: float):
+        self.session_factory = session_factory
+        self.job_id = job_id
+        self.worker_id = worker_id
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                with self.session_factory() as session:
+                    session.execute(
+                        update(TransformJob)
+                        .where(TransformJob.id == self.job_id,
+                               TransformJob.worker_id == self.worker_id)
+                        .values(heartbeat_at=_utcnow())
+                        .execution_options(synchronize_session=False))
+                    session.commit()
+            except sqlalchemy.exc.OperationalError as e:
+                # e.g. a locked SQLite database; try again next beat.
+                print(f"Heartbeat of job {self.job_id} failed: {e}")
+
+    def __enter__(self) -> '_Heartbeat':
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+class QueueWorker:
+    """Runs queued transform jobs until told to stop.
+
+    Args:
+        session_factory: Makes sessions on the queue's database.
+        storage_manager: Used by every transform the worker runs.
+        worker_id: Identifies the worker in claimed jobs. Defaults to the
+            host name, process id and a random suffix.
+        heartbeat_interval: Seconds between heartbeats of a running job.
+        dead_after: Seconds without a heartbeat after which a job's worker
+            is considered dead. Must be well above heartbeat_interval.
+        poll_interval: Seconds to wait before checking an empty queue again.
+    """
+
+    def __init__(self, session_factory: sessionmaker,
+                 storage_manager: StorageManager,
+                 worker_id: Optional[str] = None,
+                 heartbeat_interval: float = 30.0,
+                 dead_after: float = 120.0,
+                 poll_interval: float = 5.0):
+        if dead_after <= heartbeat_interval:
+            raise ValueError("dead_after must be longer than the heartbeat "
+                             "interval.")
+        self.session_factory = session_factory
+        self.storage_manager = storage_manager
+        self.worker_id = worker_id or default_worker_id()
+        self.heartbeat_interval = heartbeat_interval
+        self.dead_after = dead_after
+        self.poll_interval = poll_interval
+
+    def run(self, max_jobs: Optional[int] = None,
+            stop_when_empty: bool = False) -> int:
+        """Claim and run jobs.
+
+        Args:
+            max_jobs: Stop after this many jobs.
+            stop_when_empty: Stop when no job is queued, instead of polling.
+
+        Returns:
+            The number of jobs run (successfully or not).
+        """
+        n_run = 0
+        while max_jobs is None or n_run < max_jobs:
+            with self.session_factory() as session:
+                requeue_dead_jobs(session, self.dead_after)
+                job = claim_job(session, self.worker_id)
+                if job is None:
+                    if stop_when_empty:
+                        break
+                    time.sleep(self.poll_interval)
+                    continue
+                self.run_job(session, job)
+                n_run += 1
+        return n_run
+
+    def run_job(self, session: sqlalchemy.orm.Session, job: TransformJob):
+        """Run a claimed job and record its outcome."""
+        name = repr(job)
+        print(f"[{self.worker_id}] running {name}")
+        output_id, error = None, None
+        with _Heartbeat(self.session_factory, job.id, self.worker_id,
+                        self.heartbeat_interval):
+            try:
+                output_id = self._apply(session, job)
+            except Exception:
+                session.rollback()
+                error = traceback.format_exc()
+
+        if error is not None:
+            print(f"[{self.worker_id}] {name} failed: "
+                  f"{error.strip().splitlines()[-1]}")
+        if error is None:
+            values = dict(status=JobStatus.DONE,
+                          output_timecourse_id=output_id, error=None,
+                          finished_at=_utcnow())
+        elif job.attempts < job.max_attempts:
+            values = dict(status=JobStatus.QUEUED, worker_id=None,
+                          error=error)
+        else:
+            values = dict(status=JobStatus.FAILED, error=error,
+                          finished_at=_utcnow())
+        # Only record the outcome if the job wasn't given to another worker
+        # in the meantime.
+        session.execute(
+            update(TransformJob)
+            .where(TransformJob.id == job.id,
+                   TransformJob.worker_id == self.worker_id,
+                   TransformJob.status == JobStatus.RUNNING)
+            .values(**values)
+            .execution_options(synchronize_session=False))
+        session.commit()
+
+    def _apply(self, session: sqlalchemy.orm.Session,
+               job: TransformJob) -> int:
+        transform_cls = resolve_transform(job.transform)
+        params: Dict[str, Any] = json.loads(job.params_json)
+        inputs = [session.get(Timecourse, tc_id)
+                  for tc_id in json.loads(job.input_ids_json)]
+        if any(tc is None for tc in inputs):
+            raise ValueError(f"Input timecourses of {job} do not exist.")
+        transform = transform_cls(inputs[0], session,
+                                  storage_manager=self.storage_manager,
+                                  **params)
+        transform.input_timecourses.extend(inputs[1:])
+        transform.apply_transform()
+        transform.commit()
+        return transform.new_timecourse.id
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        description="Run queued expdb transform jobs.")
+    parser.add_argument("--database-url",
+                        default=CONFIG.SQLALCHEMY_DATABASE_URI)
+    parser.add_argument("--import", dest="modules", action="append",
+                        default=[], help="Module defining transforms; may be "
+                        "repeated.")
+    parser.add_argument("--storage-root", default=None,
+                        help="Store files locally under this directory "
+                        "instead of in the configured GCS bucket.")
+    parser.add_argument("--worker-id", default=None)
+    parser.add_argument("--heartbeat-interval", type=float, default=30.0)
+    parser.add_argument("--dead-after", type=float, default=120.0)
+    parser.add_argument("--poll-interval", type=float, default=5.0)
+    parser.add_argument("--max-jobs", type=int, default=None)
+    parser.add_argument("--stop-when-empty", action="store_true")
+    args = parser.parse_args(argv)
+
+    for module in args.modules:
+        importlib.import_module(module)
+    if args.storage_root is not None:
+        storage_manager = LocalStorageManager(file_root=args.storage_root)
+    else:
+        storage_manager = GCSStorageManager(f"gs://{CONFIG.GS_BUCKET_NAME}",
+                                            local_cache_dir=CONFIG.CACHE_DIR)
+    engine = sqlalchemy.create_engine(args.database_url)
+    worker = QueueWorker(sessionmaker(bind=engine), storage_manager,
+                         worker_id=args.worker_id,
+                         heartbeat_interval=args.heartbeat_interval,
+                         dead_after=args.dead_after,
+                         poll_interval=args.poll_interval)
+    n_run = worker.run(max_jobs=args.max_jobs,
+                       stop_when_empty=args.stop_when_empty)
+    print(f"[{worker.worker_id}] ran {n_run} jobs")
+
+
+if __name__ == "__main__":
+    main()
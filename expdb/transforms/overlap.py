@@ -0,0 +1,221 @@
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Type
+
+import mne
+import numpy as np
+import pandas as pd
+import sqlalchemy.orm
+
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+import dataclasses
+
+from ..models import Timecourse
+from ..storage import StorageManager
+from .transform import Transform
+
+
+def _payload_nbytes(payload: Any) -> int:
+    """Bytes of memory held by loaded data (file-backed data counts as 0)."""
+    if isinstance(payload, (list, tuple)):
+        return sum(_payload_nbytes(p) for p in payload)
+    if isinstance(payload, dict):
+        return sum(_payload_nbytes(p) for p in payload.values())
+    if isinstance(payload, np.memmap):
+        return 0
+    if isinstance(payload, np.ndarray):
+        return payload.nbytes
+    if isinstance(payload, mne.io.BaseRaw):
+        return payload._data.nbytes if payload.preload else 0
+    if isinstance(payload, pd.DataFrame):
+        return int(payload.memory_usage(deep=True).sum())
+    return 0
+
+
+@dataclasses.dataclass
+class _InFlight:
+    """A transform whose input is being loaded or output stored."""
+    index: int
+    transform: Transform
+    future: Future
+    nbytes: int = 0
+
+
+class OverlappingRunner:
+    """Applies a transform to many timecourses, overlapping I/O and compute.
+
+    Run one after another, each transform downloads and decodes its inputs,
+    transforms them, then serializes and uploads its output, so the CPU idles
+    during I/O and the network idles during compute. This runner loads the
+    inputs of the next ``prefetch`` timecourses on one thread and stores the
+    outputs of up to ``max_pending_stores`` previous ones on another, while
+    the calling thread transforms the current one. Over many inputs, the
+    total time approaches that of the slowest of loading, transforming and
+    storing rather than their sum.
+
+    Everything that uses the session (looking up inputs and existing
+    derivations, constructing and committing timecourses) stays on the
+    calling thread, so transforms only need to be thread-safe in their
+    ``prepare_load`` and ``prepare_store`` functions, as the built-in ones
+    are. Run inside a TransformBatch to also share commits.
+
+    Memory is bounded by the number of inputs loaded ahead and outputs
+    waiting to be stored, and optionally by ``max_buffered_bytes``: no more
+    inputs are loaded ahead while the loaded inputs and pending outputs hold
+    more than that (file-backed payloads, such as memory maps and streaming
+    readers, count as 0). At least one input is always loaded, so a single
+    payload larger than the cap is still transformed.
+
+    Example:
+        runner = OverlappingRunner(FilterTransform, params={"cutoff_freq": 30},
+                                   prefetch=2)
+        new_timecourses = runner.run(session.query(Timecourse).filter(...))
+
+    Args:
+        transform_cls: The Transform subclass to apply.
+        params: Keyword parameters of the transform.
+        session: Used to construct transforms. Defaults to each input's
+            session, as for Transform.
+        storage_manager: Shared by every transform. Defaults to the
+            Transform default.
+        prefetch: Number of inputs loaded ahead of the one being
+            transformed.
+        max_pending_stores: Number of outputs that may be waiting to be
+            stored before transforming waits for them.
+        max_buffered_bytes: Optional cap on the memory held by loaded inputs
+            and pending outputs.
+        force: Recompute even where an identical derivation exists.
+    """
+
+    def __init__(self, transform_cls: Type[Transform],
+                 params: Optional[Dict[str, Any]] = None,
+                 session: Optional[sqlalchemy.orm.Session] = None,
+                 storage_manager: Optional[StorageManager] = None,
+                 prefetch: int = 1,
+                 max_pending_stores: int = 1,
+                 max_buffered_bytes: Optional[int] = None,
+                 force: bool = False):
+        if prefetch < 0 or max_pending_stores < 1:
+            raise ValueError(f"Invalid prefetch {prefetch} or "
+                             f"max_pending_stores {max_pending_stores}.")
+        self.transform_cls = transform_cls
+        self.params = params or {}
+        self.session = session
+        self.storage_manager = storage_manager
+        self.prefetch = prefetch
+        self.max_pending_stores = max_pending_stores
+        self.max_buffered_bytes = max_buffered_bytes
+        self.force = force
+
+    def run(self, timecourses: Iterable[Timecourse]) -> List[Timecourse]:
+        """Transform every timecourse.
+
+        Returns:
+            The new (or reused) timecourses, in input order.
+
+        Raises:
+            Whatever a transform raised. The outputs of the inputs before the
+            one that failed are still committed.
+        """
+        inputs = iter(enumerate(timecourses))
+        results: Dict[int, Timecourse] = {}
+        loads: Deque[_InFlight] = deque()
+        stores: Deque[_InFlight] = deque()
+        exhausted = False
+
+        with ThreadPoolExecutor(1, thread_name_prefix="load") as loader, \
+                ThreadPoolExecutor(1, thread_name_prefix="store") as storer:
+
+            def buffered() -> int:
+                return (sum(load.nbytes for load in loads
+                            if load.future.done())
+                        + sum(store.nbytes for store in stores))
+
+            def fill():
+                nonlocal exhausted
+                # The input about to be transformed and the next prefetch.
+                while not exhausted and len(loads) <= self.prefetch:
+                    if (loads and self.max_buffered_bytes is not None
+                            and buffered() > self.max_buffered_bytes):
+                        return
+                    try:
+                        i, timecourse = next(inputs)
+                    except StopIteration:
+                        exhausted = True
+                        return
+                    transform = self.transform_cls(
+                        timecourse, self.session,
+                        storage_manager=self.storage_manager, **self.params)
+                    if transform._lookup(self.force):
+                        results[i] = transform.new_timecourse
+                        continue
+                    load = self._timed(transform, "load",
+                                       transform.prepare_load())
+                    in_flight = _InFlight(i, transform, loader.submit(load))
+                    in_flight.future.add_done_callback(
+                        lambda f, in_flight=in_flight: self._measure(
+                            in_flight, f))
+                    loads.append(in_flight)
+
+            def finish_store():
+                in_flight = stores.popleft()
+                try:
+                    in_flight.future.result()
+                    in_flight.transform._commit_to_session()
+                finally:
+                    in_flight.transform.close()
+                results[in_flight.index] = in_flight.transform.new_timecourse
+
+            try:
+                fill()
+                while loads:
+                    in_flight = loads.popleft()
+                    transform = in_flight.transform
+                    try:
+                        transform.data = in_flight.future.result()
+                        transform._finish_transform()
+                        transform.data = None
+                        store = self._timed(transform, "store",
+                                            transform.prepare_store())
+                    except BaseException:
+                        transform.close()
+                        raise
+                    while len(stores) >= self.max_pending_stores:
+                        finish_store()
+                    stores.append(_InFlight(
+                        in_flight.index, transform, storer.submit(store),
+                        _payload_nbytes(transform.out_data)))
+                    fill()
+                while stores:
+                    finish_store()
+            except BaseException:
+                for in_flight in loads:
+                    in_flight.future.cancel()
+                for in_flight in loads:
+                    if not in_flight.future.cancelled():
+                        # Wait for it, so that what it opened can be closed.
+                        in_flight.future.exception()
+                    in_flight.transform.close()
+                # The outputs of earlier inputs are still committed, unless
+                # they fail too (e.g. because the error was the session's),
+                # in which case the original error is the one raised.
+                while stores:
+                    try:
+                        finish_store()
+                    except Exception:
+                        pass
+                raise
+
+        return [results[i] for i in sorted(results)]
+
+    @staticmethod
+    def _timed(transform: Transform, stage: str,
+               fn: Callable[[], Any]) -> Callable[[], Any]:
+        def timed():
+            with transform.telemetry.stage(stage):
+                return fn()
+        return timed
+
+    @staticmethod
+    def _measure(in_flight: _InFlight, future: Future):
+        if not future.cancelled() and future.exception() is None:
+            in_flight.nbytes = _payload_nbytes(future.result())
@@ -0,0 +1,179 @@
+from typing import (Any, Callable, Dict, Iterable, List, Optional, Sequence,
+                    Tuple, Type, Union)
+
+import sqlalchemy.orm
+
+from ..models import Timecourse
+from ..storage import StorageManager
+from ..utils import data_utils as du
+from ..utils import telemetry
+from .transform import Transform
+
+
+Step = Union[Type[Transform], Tuple[Type[Transform], Dict[str, Any]]]
+
+
+class Pipeline(Transform):
+    """
+    Several transforms applied in memory as one.
+
+    Each step's output is passed directly to the next step's ``transform``,
+    so only the pipeline's input is loaded from storage and only its output
+    is stored. The derived timecourse's TransformData records every step's
+    name and parameters, in order.
+
+    Intermediate results can be kept by naming steps in ``checkpoints``.
+    Each checkpoint is committed as its own timecourse, derived from the
+    pipeline's inputs, whose TransformData records the steps up to and
+    including the checkpoint. Since a checkpoint is exactly what running
+    those steps alone would produce, it is also reused as a memoized
+    derivation: a later run of the pipeline (e.g. after changing the
+    parameters of a step after the checkpoint) resumes from the latest
+    checkpoint that already exists.
+
+    Examples
+    --------
+    >>> pipeline = Pipeline(timecourse, steps=[
+    ...     (FilterTransform, {"cutoff_freq": 30}),
+    ...     (ResampleTransform, {"sampling_rate": 128}),
+    ...     ZScoreTransform,
+    ... ], checkpoints=["FilterTransform"])
+    >>> pipeline.apply_transform()
+    >>> pipeline.commit()
+
+    Parameters
+    ----------
+    timecourse : Timecourse
+        The input timecourse.
+    session : sqlalchemy.orm.Session, optional
+        Used when ``timecourse`` is None, as for Transform.
+    storage_manager : StorageManager, optional
+        Shared by every step.
+    steps : sequence
+        Transform subclasses, or (subclass, params) tuples, in the order they
+        are applied. Each step's output data type must match the next step's
+        input data type.
+    checkpoints : iterable of int or str
+        Steps whose output is committed, given by index or by class name.
+    """
+
+    def __init__(self, timecourse: Optional[Timecourse],
+                 session: Optional[sqlalchemy.orm.Session] = None,
+                 storage_manager: Optional[StorageManager] = None,
+                 steps: Sequence[Step] = (),
+                 checkpoints: Iterable[Union[int, str]] = ()):
+        if not steps:
+            raise ValueError("A Pipeline needs at least one step.")
+        steps = [(step, {}) if isinstance(step, type) else step
+                 for step in steps]
+        self.input_datatype = steps[0][0].input_datatype
+        super().__init__(timecourse, session, storage_manager=storage_manager)
+
+        self.steps: List[Transform] = [
+            cls(None, self.session, storage_manager=self.storage_manager,
+                **params)
+            for cls, params in steps
+        ]
+        for prev, step in zip(self.steps, self.steps[1:]):
+            if prev.output_datatype != step.input_datatype:
+                raise ValueError(
+                    f"{type(prev).__name__} outputs {prev.output_datatype} "
+                    f"but {type(step).__name__} expects "
+                    f"{step.input_datatype}.")
+        self.output_datatype = self.steps[-1].output_datatype
+
+        # The last step's output is the pipeline's, so it is never a
+        # separate checkpoint.
+        self.checkpoints = sorted({self._step_index(c) for c in checkpoints}
+                                  - {len(self.steps) - 1})
+        # Checkpoint timecourses by step index, filled in by apply_transform.
+        self.checkpoint_timecourses: Dict[int, Timecourse] = {}
+        self._checkpoint_data: Dict[int, du.TimecoursePayload] = {}
+        self._force = False
+        self._start = 0
+
+    def _step_index(self, checkpoint: Union[int, str]) -> int:
+        if isinstance(checkpoint, int):
+            if not -len(self.steps) <= checkpoint < len(self.steps):
+                raise ValueError(f"No step {checkpoint} in the pipeline.")
+            return checkpoint % len(self.steps)
+        matches = [i for i, step in enumerate(self.steps)
+                   if type(step).__name__ == checkpoint]
+        if len(matches) != 1:
+            raise ValueError(f"Checkpoint {checkpoint!r} must name exactly "
+                             f"one step, but names {len(matches)}.")
+        return matches[0]
+
+    def _prefix(self, stop: int) -> Tuple[List[str], List[Dict[str, Any]]]:
+        """The transform names and params of the first ``stop`` steps."""
+        names, params = [], []
+        for step in self.steps[:stop]:
+            names.extend(step._transform_names())
+            params.extend(step._transform_params())
+        return names, params
+
+    def _transform_names(self) -> List[str]:
+        return self._prefix(len(self.steps))[0]
+
+    def _transform_params(self) -> List[Dict[str, Any]]:
+        return self._prefix(len(self.steps))[1]
+
+    def _lookup(self, force: bool) -> bool:
+        self._force = force
+        self._start = 0
+        self._checkpoint_data = {}
+        self.checkpoint_timecourses = {}
+        return super()._lookup(force)
+
+    def _finish_transform(self) -> Timecourse:
+        new_timecourse = super()._finish_transform()
+        for i, payload in self._checkpoint_data.items():
+            names, params = self._prefix(i + 1)
+            checkpoint = self._construct_timecourse(
+                self.steps[i].output_datatype,
+                self._get_transform_data(names, params), payload)
+            checkpoint.derivation_key = self._derivation_key(names, params)
+            self.checkpoint_timecourses[i] = checkpoint
+        return new_timecourse
+
+    def prepare_load(self) -> Callable[[], List[du.TimecoursePayload]]:
+        if not self._force:
+            for i in reversed(self.checkpoints):
+                existing = self._find_derivation(
+                    self._derivation_key(*self._prefix(i + 1)))
+                if existing is not None:
+                    self.checkpoint_timecourses[i] = existing
+                    self._start = i + 1
+                    load = self.storage_manager.prepare_retrieve(existing)
+                    return lambda: [load()]
+        return super().prepare_load()
+
+    def transform(self, data: List[du.TimecoursePayload]
+                  ) -> du.TimecoursePayload:
+        # Intermediate payloads are only referenced by the loop (and by
+        # checkpoints), so each can be freed as soon as the next step is done.
+        for i in range(self._start, len(self.steps)):
+            out = self.steps[i].transform(data)
+            if i in self.checkpoints:
+                self._checkpoint_data[i] = out
+            data = [out]
+        return out
+
+    def prepare_store(self) -> Callable[[], None]:
+        stores = [self.storage_manager.prepare_store(
+                      self.checkpoint_timecourses[i], payload)
+                  for i, payload in self._checkpoint_data.items()]
+        store_output = super().prepare_store()
+
+        def store():
+            with telemetry.stage("checkpoints"):
+                for store_checkpoint in stores:
+                    store_checkpoint()
+            store_output()
+        return store
+
+    def _commit_to_session(self):
+        for i in self._checkpoint_data:
+            self._link_timecourse(self.checkpoint_timecourses[i])
+            self.session.add(self.checkpoint_timecourses[i])
+        super()._commit_to_session()
@@ -0,0 +1,307 @@
+from typing import (Any, Callable, Dict, Iterable, List, Optional, Tuple,
+                    Type)
+
+import sqlalchemy.orm
+
+from concurrent.futures import ProcessPoolExecutor
+import dataclasses
+import functools
+import inspect
+import json
+import multiprocessing
+import os
+import traceback
+
+from ..config import get_config
+from ..models import Timecourse
+from ..storage import GCSStorageManager, StorageManager
+from ..utils import git_utils
+from . import runner
+from .transform import TRANSFORMS, CustomParamsEncoder, Transform
+
+CONFIG = get_config()
+
+
+@dataclasses.dataclass
+class RebuildReport:
+    """What a Rebuilder found and did.
+
+    Attributes:
+        stale: Maps each stale timecourse id to why it is stale.
+        rebuilt: Maps each rebuilt timecourse id to the id of its
+            replacement. The stale timecourse itself is kept.
+        skipped: Maps each derived timecourse id that was not rebuilt, and
+            didn't fail, to why: it is up to date, or it can't be rebuilt.
+        failed: Maps each timecourse id whose rebuild raised to the error.
+    """
+    stale: Dict[int, str] = dataclasses.field(default_factory=dict)
+    rebuilt: Dict[int, int] = dataclasses.field(default_factory=dict)
+    skipped: Dict[int, str] = dataclasses.field(default_factory=dict)
+    failed: Dict[int, str] = dataclasses.field(default_factory=dict)
+
+    def __repr__(self) -> str:
+        return (f"RebuildReport(stale={len(self.stale)}, "
+                f"rebuilt={len(self.rebuilt)}, skipped={len(self.skipped)}, "
+                f"failed={len(self.failed)})")
+
+
+@dataclasses.dataclass
+class _Recipe:
+    """How to recompute one timecourse."""
+    classes: List[Type[Transform]]
+    params: List[Dict[str, Any]]
+    parent_ids: List[int]
+    level: int
+
+
+def _canonical(params: Any) -> str:
+    return json.dumps(params, sort_keys=True, cls=CustomParamsEncoder)
+
+
+class Rebuilder:
+    """Recomputes the derived timecourses made stale by code or param changes.
+
+    Starting from the timecourses matched by a query, every descendant (and
+    every matched timecourse that is itself derived) is checked, parents
+    before children. A timecourse is stale if:
+
+    - the source file of one of its transforms, or one of ``watch_paths``,
+      was changed in a commit after the one it was produced at,
+    - it was produced with parameters that differ from the current ones
+      given in ``params``, or
+    - one of its parents is stale.
+
+    Stale timecourses are recomputed by re-running the transforms recorded
+    in their TransformData (with the current parameters) on their parents,
+    or on their parents' replacements. Timecourses whose parents are all up
+    to date are independent, so each generation is rebuilt in parallel.
+    Stale timecourses are kept, since others may refer to them; rebuilding
+    again reuses the replacements rather than recomputing them.
+
+    Transforms are found by the class name recorded in TransformData, so the
+    modules defining them must be imported. Only committed changes are seen.
+
+    Example:
+        report = Rebuilder(
+            session.query(Timecourse).filter(Timecourse.study_id == study.id),
+            params={"FilterTransform": {"cutoff_freq": 40}}).run()
+
+    Args:
+        query: A query of the timecourses to start from.
+        params: Current parameters by transform name. Timecourses produced
+            with different parameters are stale.
+        watch_paths: Other paths (e.g. shared helper modules) whose changes
+            make every derived timecourse stale.
+        storage_manager_factory: A picklable callable that builds the storage
+            managers used for recomputing. Defaults to the configured GCS
+            bucket and cache directory.
+        n_workers: Number of worker processes, as for TransformRunner. 0
+            recomputes in this process, with the query's session.
+        progress: Called with a message as each timecourse is rebuilt.
+        database_url: As for TransformRunner.
+    """
+
+    def __init__(self, query: sqlalchemy.orm.Query,
+                 params: Optional[Dict[str, Dict[str, Any]]] = None,
+                 watch_paths: Iterable[str] = (),
+                 storage_manager_factory: Optional[
+                     Callable[[], StorageManager]] = None,
+                 n_workers: Optional[int] = None,
+                 progress: Optional[Callable[[str], None]] = print,
+                 database_url: Optional[str] = None):
+        self.query = query
+        self.session = query.session
+        self.params = params or {}
+        self.watch_paths = [os.path.abspath(p) for p in watch_paths]
+        if storage_manager_factory is None:
+            storage_manager_factory = functools.partial(
+                GCSStorageManager, f"gs://{CONFIG.GS_BUCKET_NAME}",
+                local_cache_dir=CONFIG.CACHE_DIR)
+        self.storage_manager_factory = storage_manager_factory
+        self.n_workers = n_workers
+        self.progress = progress
+        self.database_url = database_url
+        self._changed_cache: Dict[Tuple[str, Tuple[str, ...]],
+                                  Optional[List[str]]] = {}
+
+    def _collect(self) -> List[Timecourse]:
+        """The matched timecourses and their descendants, parents first."""
+        nodes: Dict[int, Timecourse] = {}
+        for tc in self.query:
+            nodes[tc.id] = tc
+            # One query for the descendants at every depth.
+            for descendant in tc.descendants:
+                nodes[descendant.id] = descendant
+
+        order: List[Timecourse] = []
+        visited = set()
+
+        def visit(tc: Timecourse):
+            if tc.id in visited:
+                return
+            visited.add(tc.id)
+            for parent in tc.derived_from:
+                if parent.id in nodes:
+                    visit(parent)
+            order.append(tc)
+
+        for tc_id in sorted(nodes):
+            visit(nodes[tc_id])
+        return order
+
+    def _changed_files(self, commit: str,
+                       classes: List[Type[Transform]]) -> Optional[List[str]]:
+        paths = set(self.watch_paths)
+        for cls in classes:
+            source = inspect.getsourcefile(cls)
+            if source is not None:
+                paths.add(os.path.abspath(source))
+        key = (commit, tuple(sorted(paths)))
+        if key not in self._changed_cache:
+            self._changed_cache[key] = git_utils.files_changed_since(
+                commit, list(key[1]))
+        return self._changed_cache[key]
+
+    def plan(self) -> Tuple[RebuildReport, Dict[int, _Recipe]]:
+        """Find the stale timecourses without recomputing anything.
+
+        Returns:
+            The report, with ``stale`` and ``skipped`` filled in, and how
+            to recompute each stale timecourse.
+        """
+        report = RebuildReport()
+        recipes: Dict[int, _Recipe] = {}
+        # Stale timecourses that can't be rebuilt, nor can their descendants.
+        blocked = set()
+
+        for tc in self._collect():
+            parents = tc.derived_from.order_by(Timecourse.id).all()
+            if not parents:
+                # Uploads and other sources have nothing to be rebuilt from.
+                continue
+            blocked_parents = [p.id for p in parents if p.id in blocked]
+            if blocked_parents:
+                blocked.add(tc.id)
+                report.skipped[tc.id] = (f"stale ancestor {blocked_parents} "
+                                         f"could not be rebuilt")
+                continue
+
+            names = json.loads(tc.transform.transform_names_json)
+            params = json.loads(tc.transform.transform_params_json)
+            classes = [TRANSFORMS.get(name) for name in names]
+            unknown = [n for n, cls in zip(names, classes) if cls is None]
+
+            reason = None
+            stale_parents = [p.id for p in parents if p.id in recipes]
+            if stale_parents:
+                reason = f"parents {stale_parents} are stale"
+            if reason is None and not unknown:
+                changed = self._changed_files(tc.transform.git_commit,
+                                              classes)
+                if changed is None:
+                    report.skipped[tc.id] = (
+                        f"can't compare commit {tc.transform.git_commit} "
+                        f"with HEAD")
+                    continue
+                if changed:
+                    reason = (f"{', '.join(changed)} changed since "
+                              f"{tc.transform.git_commit[:7]}")
+            if reason is None:
+                for name, recorded in zip(names, params):
+                    if (name in self.params and
+                            _canonical(recorded) !=
+                            _canonical(self.params[name])):
+                        reason = f"{name} parameters changed"
+                        break
+
+            if reason is None:
+                report.skipped[tc.id] = ("up to date" if not unknown else
+                                         f"unknown transforms {unknown}")
+                continue
+            report.stale[tc.id] = reason
+            if unknown:
+                blocked.add(tc.id)
+                report.skipped[tc.id] = f"unknown transforms {unknown}"
+                continue
+            params = [self.params.get(name, recorded)
+                      for name, recorded in zip(names, params)]
+            level = max([recipes[p].level + 1 for p in stale_parents],
+                        default=0)
+            recipes[tc.id] = _Recipe(classes, params,
+                                     [p.id for p in parents], level)
+        return report, recipes
+
+    def run(self) -> RebuildReport:
+        """Rebuild every stale timecourse and report what was done."""
+        report, recipes = self.plan()
+        if not recipes:
+            return report
+
+        executor = None
+        storage_manager = None
+        if self.n_workers == 0:
+            storage_manager = self.storage_manager_factory()
+        else:
+            database_url = (self.database_url or
+                            runner.session_database_url(self.session))
+            executor = ProcessPoolExecutor(
+                max_workers=self.n_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=runner.init_worker,
+                initargs=(database_url, self.storage_manager_factory))
+
+        try:
+            for level in range(max(r.level for r in recipes.values()) + 1):
+                batch = {tc_id: recipe for tc_id, recipe in recipes.items()
+                         if recipe.level == level}
+                runnable = {}
+                for tc_id, recipe in batch.items():
+                    failed = [p for p in recipe.parent_ids
+                              if p in recipes and p not in report.rebuilt]
+                    if failed:
+                        report.skipped[tc_id] = (f"rebuilding parents "
+                                                 f"{failed} failed")
+                        continue
+                    recipe.parent_ids = [report.rebuilt.get(p, p)
+                                         for p in recipe.parent_ids]
+                    runnable[tc_id] = recipe
+                if executor is None:
+                    results = {tc_id: self._run_inline(recipe,
+                                                       storage_manager)
+                               for tc_id, recipe in runnable.items()}
+                else:
+                    futures = {
+                        tc_id: executor.submit(runner.derive_in_worker,
+                                               recipe.classes, recipe.params,
+                                               recipe.parent_ids)
+                        for tc_id, recipe in runnable.items()}
+                    results = {tc_id: runner.result_or_error(future)
+                               for tc_id, future in futures.items()}
+                for tc_id, (new_id, error) in results.items():
+                    if error is not None:
+                        report.failed[tc_id] = error
+                    else:
+                        report.rebuilt[tc_id] = new_id
+                    if self.progress is not None:
+                        self.progress(
+                            f"timecourse {tc_id} rebuilt as {new_id}"
+                            if error is None else
+                            f"timecourse {tc_id} failed to rebuild: "
+                            f"{error.strip().splitlines()[-1]}")
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        self.session.expire_all()
+        return report
+
+    def _run_inline(self, recipe: _Recipe, storage_manager: StorageManager
+                    ) -> Tuple[Optional[int], Optional[str]]:
+        try:
+            return runner.derive(recipe.classes, recipe.params,
+                                 recipe.parent_ids, self.session,
+                                 storage_manager), None
+        except Exception:
+            self.session.rollback()
+            return None, traceback.format_exc()
+
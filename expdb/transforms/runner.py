@@ -0,0 +1,384 @@
+from typing import (Any, Callable, Dict, List, Optional, Sequence, Tuple,
+                    Type, Union)
+
+import sqlalchemy
+import sqlalchemy.orm
+from sqlalchemy.orm import sessionmaker
+
+from collections import deque
+from concurrent.futures import (FIRST_COMPLETED, Future, ProcessPoolExecutor,
+                                wait)
+import dataclasses
+import functools
+import multiprocessing
+import traceback
+
+from ..config import get_config
+from ..models import Timecourse
+from ..storage import GCSStorageManager, SharedPayload, StorageManager
+from ..utils import telemetry
+from .admission import MemoryBudget, MemoryEstimator
+from .pipeline import Pipeline
+from .transform import Transform
+
+CONFIG = get_config()
+
+
+@dataclasses.dataclass
+class RunSummary:
+    """The outcome of a TransformRunner run.
+
+    Attributes:
+        created: Maps each input timecourse id to the id of the timecourse
+            derived from it.
+        failed: Maps each input timecourse id that could not be transformed,
+            after all retries, to the last error.
+        attempts: Number of attempts made per input timecourse id.
+        estimated_memory: With a memory budget, the estimated peak memory
+            of each input timecourse id's run, in bytes.
+        peak_memory: With a memory budget, the peak memory each successful
+            run used above its worker's baseline, in bytes.
+    """
+    created: Dict[int, int] = dataclasses.field(default_factory=dict)
+    failed: Dict[int, str] = dataclasses.field(default_factory=dict)
+    attempts: Dict[int, int] = dataclasses.field(default_factory=dict)
+    estimated_memory: Dict[int, int] = dataclasses.field(default_factory=dict)
+    peak_memory: Dict[int, int] = dataclasses.field(default_factory=dict)
+
+    @property
+    def created_ids(self) -> List[int]:
+        """Ids of the created timecourses, in input order."""
+        return list(self.created.values())
+
+    def __repr__(self) -> str:
+        return (f"RunSummary(created={len(self.created)}, "
+                f"failed={len(self.failed)})")
+
+
+def print_progress(done: int, total: int, input_id: int,
+                   output_id: Optional[int], error: Optional[str]):
+    """The default progress report of a TransformRunner."""
+    if error is None:
+        print(f"[{done}/{total}] timecourse {input_id} -> {output_id}")
+    else:
+        print(f"[{done}/{total}] timecourse {input_id} failed: "
+              f"{error.strip().splitlines()[-1]}")
+
+
+def session_database_url(session: sqlalchemy.orm.Session) -> str:
+    """The URL worker processes use to connect to a session's database."""
+    url = session.get_bind().url
+    if url.get_backend_name() == "sqlite" and url.database in (
+            None, "", ":memory:"):
+        raise ValueError("In-memory SQLite databases cannot be shared with "
+                         "worker processes.")
+    return url.render_as_string(hide_password=False)
+
+
+# Per-process state of the worker processes, set up by init_worker.
+_worker_session_factory: Optional[sessionmaker] = None
+_worker_storage_manager: Optional[StorageManager] = None
+
+
+def init_worker(database_url: str,
+                storage_manager_factory: Callable[[], StorageManager]):
+    """Set up a worker process to run transforms.
+
+    Pass it as the ``initializer`` of a ProcessPoolExecutor; the functions
+    run in its workers then get their session and storage manager from
+    worker_session() and worker_storage_manager().
+
+    Args:
+        database_url: The database to connect to (see session_database_url).
+        storage_manager_factory: Builds the worker's storage manager.
+    """
+    global _worker_session_factory, _worker_storage_manager
+    engine = sqlalchemy.create_engine(database_url)
+    _worker_session_factory = sessionmaker(bind=engine)
+    _worker_storage_manager = storage_manager_factory()
+
+
+def worker_session() -> sqlalchemy.orm.Session:
+    """A new session in a worker process set up by init_worker."""
+    if _worker_session_factory is None:
+        raise RuntimeError("This process was not set up by init_worker.")
+    return _worker_session_factory()
+
+
+def worker_storage_manager() -> StorageManager:
+    """The storage manager of a worker process set up by init_worker."""
+    if _worker_storage_manager is None:
+        raise RuntimeError("This process was not set up by init_worker.")
+    return _worker_storage_manager
+
+
+def result_or_error(future: Future) -> Tuple[Any, Optional[str]]:
+    """The result of a finished future, or the error it raised.
+
+    Returns:
+        The result and None, or None and the formatted traceback.
+    """
+    try:
+        return future.result(), None
+    except Exception:
+        return None, traceback.format_exc()
+
+
+def build_transform(classes: Sequence[Type[Transform]],
+                    params: Sequence[Dict[str, Any]],
+                    inputs: Sequence[Timecourse],
+                    session: Optional[sqlalchemy.orm.Session],
+                    storage_manager: Optional[StorageManager]) -> Transform:
+    """Instantiate the transform that a TransformData chain describes.
+
+    A single transform is instantiated directly; a chain of several (as
+    recorded by a Pipeline) becomes a Pipeline of them.
+    """
+    if len(classes) == 1:
+        transform = classes[0](inputs[0], session,
+                               storage_manager=storage_manager, **params[0])
+    else:
+        transform = Pipeline(inputs[0], session,
+                             storage_manager=storage_manager,
+                             steps=list(zip(classes, params)))
+    transform.input_timecourses.extend(inputs[1:])
+    return transform
+
+
+def derive(classes: Sequence[Type[Transform]],
+           params: Sequence[Dict[str, Any]], input_ids: Sequence[int],
+           session: sqlalchemy.orm.Session,
+           storage_manager: StorageManager) -> int:
+    """Apply and commit a transform chain (see build_transform).
+
+    Returns:
+        The id of the new timecourse.
+    """
+    inputs = [session.get(Timecourse, tc_id) for tc_id in input_ids]
+    transform = build_transform(classes, params, inputs, session,
+                                storage_manager)
+    transform.apply_transform()
+    transform.commit()
+    return transform.new_timecourse.id
+
+
+def derive_in_worker(classes: Sequence[Type[Transform]],
+                     params: Sequence[Dict[str, Any]],
+                     input_ids: Sequence[int]) -> int:
+    """derive(), in a worker process set up by init_worker."""
+    session = worker_session()
+    try:
+        return derive(classes, params, input_ids, session,
+                      worker_storage_manager())
+    except BaseException:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def _transform_one(transform_cls: Type[Transform], params: Dict[str, Any],
+                   timecourse_id: int, force: bool,
+                   shared_inputs: Optional[Dict[int, SharedPayload]] = None
+                   ) -> int:
+    """Apply and commit a transform in a worker, returning the new id.
+
+    Inputs with a handle in ``shared_inputs`` are mapped from shared memory
+    rather than retrieved from storage.
+    """
+    session = worker_session()
+    try:
+        timecourse = session.get(Timecourse, timecourse_id)
+        if timecourse is None:
+            raise ValueError(f"Timecourse {timecourse_id} does not exist.")
+        transform = transform_cls(timecourse, session,
+                                  storage_manager=worker_storage_manager(),
+                                  **params)
+        transform.shared_inputs = dict(shared_inputs or {})
+        transform.apply_transform(force=force)
+        transform.commit()
+        return transform.new_timecourse.id
+    except BaseException:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def _transform_one_measured(transform_cls: Type[Transform],
+                            params: Dict[str, Any], timecourse_id: int,
+                            force: bool) -> Tuple[int, Optional[int]]:
+    """_transform_one, also returning the peak memory the run used."""
+    baseline = telemetry.current_rss()
+    telemetry.reset_peak_rss()
+    new_id = _transform_one(transform_cls, params, timecourse_id, force)
+    peak = telemetry.peak_rss()
+    if peak is None or baseline is None:
+        return new_id, None
+    return new_id, max(peak - baseline, 0)
+
+
+class TransformRunner:
+    """Applies a Transform to every timecourse matched by a query.
+
+    Each timecourse is transformed and committed in a process pool. Worker
+    processes open their own database session (against the database the
+    query is bound to) and build their own storage manager, so no ORM objects
+    are shared between processes.
+
+    Example:
+        runner = TransformRunner(
+            FilterTransform,
+            session.query(Timecourse).filter(Timecourse.study_id == study.id,
+                                             Timecourse.type == DataType.EEG),
+            params={"cutoff_freq": 30},
+            storage_manager_factory=functools.partial(
+                GCSStorageManager, "gs://bucket", local_cache_dir="cache"))
+        summary = runner.run()
+
+    Args:
+        transform_cls: The Transform subclass to apply. It must be importable
+            by the worker processes (i.e. defined at module level).
+        query: A query of Timecourse objects to transform.
+        params: Parameters passed to every transform.
+        storage_manager_factory: A picklable callable that builds the storage
+            manager each worker uses, e.g. a functools.partial. Defaults to
+            the configured GCS bucket and cache directory.
+        n_workers: Number of worker processes. Defaults to the CPU count.
+        max_retries: How many times a failed timecourse is retried.
+        progress: Called after each timecourse finishes (successfully or
+            not, after retries) with (done, total, input_id, output_id,
+            error). Defaults to printing a line per timecourse.
+        database_url: URL of the database the workers connect to. Defaults
+            to the URL of the engine the query's session is bound to.
+        force: Recompute timecourses whose identical derivation already
+            exists, instead of reusing it (see Transform.apply_transform).
+        memory_budget: If set, bytes of memory (or a MemoryBudget, which
+            may be shared with other runners) that the runs in progress may
+            use together, by their estimates. Inputs are admitted in order;
+            one that doesn't fit waits, holding back those after it, until
+            enough running work has finished, so several large runs don't
+            land on the host at once. A run larger than the whole budget
+            runs alone.
+        memory_estimator: Estimates each run's peak memory, and learns from
+            the peaks the workers observe. Pass the same estimator to later
+            runners to keep what it learned. Defaults to a new one.
+    """
+
+    def __init__(self, transform_cls: Type[Transform],
+                 query: sqlalchemy.orm.Query,
+                 params: Optional[Dict[str, Any]] = None,
+                 storage_manager_factory: Optional[
+                     Callable[[], StorageManager]] = None,
+                 n_workers: Optional[int] = None,
+                 max_retries: int = 2,
+                 progress: Optional[Callable[..., None]] = print_progress,
+                 database_url: Optional[str] = None,
+                 force: bool = False,
+                 memory_budget: Union[None, int, MemoryBudget] = None,
+                 memory_estimator: Optional[MemoryEstimator] = None):
+        self.transform_cls = transform_cls
+        self.query = query
+        self.params = params or {}
+        if storage_manager_factory is None:
+            storage_manager_factory = functools.partial(
+                GCSStorageManager, f"gs://{CONFIG.GS_BUCKET_NAME}",
+                local_cache_dir=CONFIG.CACHE_DIR)
+        self.storage_manager_factory = storage_manager_factory
+        self.n_workers = n_workers
+        self.max_retries = max_retries
+        self.progress = progress
+        self.force = force
+        self.database_url = database_url or session_database_url(
+            query.session)
+        if isinstance(memory_budget, int):
+            memory_budget = MemoryBudget(memory_budget)
+        self.memory_budget = memory_budget
+        self.memory_estimator = memory_estimator or MemoryEstimator()
+
+    def _input_ids(self) -> List[int]:
+        return [tc_id for (tc_id,) in self.query.with_entities(Timecourse.id)]
+
+    def _estimate(self, input_ids: List[int],
+                  summary: RunSummary) -> Dict[int, Optional[int]]:
+        """Estimate each run's memory, returning the inputs' sizes."""
+        storage_manager = self.storage_manager_factory()
+        session = self.query.session
+        input_nbytes = {}
+        for tc_id in input_ids:
+            transform = self.transform_cls(
+                session.get(Timecourse, tc_id), session,
+                storage_manager=storage_manager, **self.params)
+            input_nbytes[tc_id] = transform.input_nbytes()
+            summary.estimated_memory[tc_id] = self.memory_estimator.estimate(
+                transform, input_nbytes[tc_id])
+        return input_nbytes
+
+    def run(self) -> RunSummary:
+        """Transform every matching timecourse and return a summary."""
+        input_ids = self._input_ids()
+        summary = RunSummary()
+        total = len(input_ids)
+        budget = self.memory_budget
+        input_nbytes = {}
+        if budget is not None:
+            input_nbytes = self._estimate(input_ids, summary)
+
+        executor = ProcessPoolExecutor(
+            max_workers=self.n_workers,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=init_worker,
+            initargs=(self.database_url, self.storage_manager_factory))
+        with executor:
+            queue = deque(input_ids)
+            pending = {}
+
+            def admit():
+                while queue:
+                    tc_id = queue[0]
+                    if budget is None:
+                        work = _transform_one
+                    elif budget.try_acquire(summary.estimated_memory[tc_id]):
+                        work = _transform_one_measured
+                    else:
+                        return
+                    queue.popleft()
+                    summary.attempts[tc_id] = summary.attempts.get(tc_id,
+                                                                   0) + 1
+                    future = executor.submit(work, self.transform_cls,
+                                             self.params, tc_id, self.force)
+                    pending[future] = tc_id
+
+            admit()
+            while pending:
+                finished, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    tc_id = pending.pop(future)
+                    try:
+                        result = future.result()
+                        if budget is not None:
+                            result, peak = result
+                            self.memory_estimator.observe(
+                                self.transform_cls.__name__,
+                                input_nbytes[tc_id], peak)
+                            if peak is not None:
+                                summary.peak_memory[tc_id] = peak
+                        summary.created[tc_id] = result
+                        summary.failed.pop(tc_id, None)
+                    except Exception:
+                        summary.failed[tc_id] = traceback.format_exc()
+                        if summary.attempts[tc_id] <= self.max_retries:
+                            queue.appendleft(tc_id)
+                            continue
+                    finally:
+                        if budget is not None:
+                            budget.release(summary.estimated_memory[tc_id])
+                    if self.progress is not None:
+                        self.progress(len(summary.created) + len(summary.failed),
+                                      total, tc_id, summary.created.get(tc_id),
+                                      summary.failed.get(tc_id))
+                admit()
+
+        # Make the new timecourses visible to the caller's session.
+        self.query.session.expire_all()
+        return summary
@@ -0,0 +1,143 @@
+from typing import Callable, List, Optional, Union
+
+import numpy as np
+import sqlalchemy.orm
+
+from abc import abstractmethod
+import contextlib
+
+from ..models import Timecourse
+from ..storage import StorageManager, WindowReader
+from ..storage.readers import reader_for_payload
+from ..storage.storage_utils import release_pages
+from ..utils import data_utils as du
+from .transform import Transform
+
+
+class StreamingTransform(Transform):
+    """
+    A transform applied one window of time at a time.
+
+    Instead of the whole payload, ``transform_window`` receives windows of
+    ``window`` samples along the time axis (the last axis of an fMRI volume,
+    the samples of an EEG recording), extended by up to ``padding`` samples
+    of context on each side. Its output must have the same number of samples
+    as its input; the padding is trimmed off and each window written to a
+    memory-mapped scratch file, which is then stored block by block. The
+    input is read lazily from storage (see StorageManager.open_reader), so
+    peak memory depends on the window size rather than the length of the
+    recording.
+
+    The output keeps the input's payload type: an MNE Raw input produces a
+    Raw with the same measurement info, so the channels must be kept.
+
+    Subclasses set ``window`` and ``padding`` (e.g. from the length of a
+    filter's impulse response, so that results don't depend on where the
+    windows fall) and implement ``transform_window``. Both can be overridden
+    per instance; they are not recorded in the TransformData, since they only
+    affect how the result is computed.
+
+    Parameters
+    ----------
+    timecourse : Timecourse
+        The input timecourse.
+    session : sqlalchemy.orm.Session, optional
+        Used when ``timecourse`` is None, as for Transform.
+    storage_manager : StorageManager, optional
+        Used to read the input and store the output.
+    window : int, optional
+        Samples per window, excluding padding.
+    padding : int, optional
+        Samples of context on each side of a window.
+    **params
+        The transform's parameters.
+    """
+    window: int = 4096
+    padding: int = 0
+
+    def __init__(self, timecourse: Optional[Timecourse],
+                 session: Optional[sqlalchemy.orm.Session] = None,
+                 storage_manager: Optional[StorageManager] = None,
+                 window: Optional[int] = None,
+                 padding: Optional[int] = None,
+                 **params):
+        super().__init__(timecourse, session, storage_manager=storage_manager,
+                         **params)
+        if window is not None:
+            self.window = window
+        if padding is not None:
+            self.padding = padding
+        if self.window < 1 or self.padding < 0:
+            raise ValueError(f"Invalid window {self.window} or padding "
+                             f"{self.padding}.")
+        self._stack = contextlib.ExitStack()
+
+    @abstractmethod
+    def transform_window(self, window: np.ndarray) -> np.ndarray:
+        """
+        Transform one window of samples.
+
+        Parameters
+        ----------
+        window : np.ndarray
+            Samples along the last axis, including the padding (which is
+            shorter at the start and end of the recording).
+
+        Returns
+        -------
+        np.ndarray
+            An array with the same number of samples as ``window``.
+        """
+        raise NotImplementedError
+
+    def prepare_load(self) -> Callable[[], List[WindowReader]]:
+        openers = [self.storage_manager.prepare_open_reader(tc)
+                   for tc in self.input_timecourses]
+        return lambda: [self._stack.enter_context(open_reader())
+                        for open_reader in openers]
+
+    def transform(self, data: List[Union[WindowReader, du.TimecoursePayload]]
+                  ) -> du.TimecoursePayload:
+        # Payloads that are already in memory (e.g. passed on by a Pipeline)
+        # are read through the same windows.
+        reader = data[0]
+        in_memory = not isinstance(reader, WindowReader)
+        if in_memory:
+            reader = reader_for_payload(reader)
+        out = None
+        for start in range(0, reader.n_times, self.window):
+            stop = min(start + self.window, reader.n_times)
+            lo = max(start - self.padding, 0)
+            hi = min(stop + self.padding, reader.n_times)
+            result = np.asarray(self.transform_window(reader.read(lo, hi)))
+            if result.shape[-1] != hi - lo:
+                raise ValueError(
+                    f"{type(self).__name__}.transform_window returned "
+                    f"{result.shape[-1]} samples for a window of {hi - lo}.")
+            if out is None:
+                shape = result.shape[:-1] + (reader.n_times,)
+                out = (np.empty(shape, dtype=result.dtype, order="F")
+                       if in_memory else self._open_output(shape, result.dtype))
+            out[..., start:stop] = result[..., start - lo:stop - lo]
+            release_pages(out)
+        if out is None:
+            raise ValueError("Cannot stream a payload with no samples.")
+        if not in_memory:
+            out = self._reopen_readonly(out)
+        return reader.wrap(out)
+
+    def _open_output(self, shape, dtype) -> np.memmap:
+        path = self._stack.enter_context(du.scratch_file(suffix=".dat"))
+        # Fortran order keeps each window contiguous on disk, and is stored
+        # blocked along time.
+        return np.memmap(path, dtype=dtype, mode="w+", shape=shape,
+                         order="F")
+
+    def _reopen_readonly(self, out: np.memmap) -> np.memmap:
+        out.flush()
+        return np.memmap(out.filename, dtype=out.dtype, mode="r",
+                         shape=out.shape, order="F")
+
+    def close(self):
+        """Close the input readers and remove the scratch output."""
+        self._stack.close()
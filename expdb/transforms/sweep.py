@@ -0,0 +1,387 @@
+from typing import (Any, Callable, Dict, Iterable, List, Mapping, Optional,
+                    Sequence, Tuple, Type, Union)
+
+import mne
+import numpy as np
+import pandas as pd
+import sqlalchemy.orm
+from sqlalchemy.orm import object_session
+
+from concurrent.futures import (FIRST_COMPLETED, Future, ProcessPoolExecutor,
+                                wait)
+import dataclasses
+import functools
+import itertools
+import json
+import multiprocessing
+import traceback
+
+from ..config import get_config
+from ..models import SweepMetric, Timecourse
+from ..storage import (GCSStorageManager, SharedPayload, SharedPayloadStore,
+                       StorageManager)
+from ..storage import format as fmt
+from . import runner
+from .transform import CustomParamsEncoder, Transform
+
+CONFIG = get_config()
+
+# A metric reduces a transform's output to what is recorded of it, e.g. a
+# float or a dict of floats. It must be picklable (defined at module level).
+Metric = Callable[[Any], Any]
+
+
+class _MetricEncoder(CustomParamsEncoder):
+    def default(self, obj):
+        if isinstance(obj, (np.generic, np.ndarray)):
+            return obj.tolist()
+        return super().default(obj)
+
+
+def param_grid(axes: Mapping[str, Sequence[Any]]) -> List[Dict[str, Any]]:
+    """Every combination of the values given for each parameter.
+
+    Example:
+        param_grid({"cutoff_freq": [20, 30, 40], "order": [2, 4]})
+        # [{"cutoff_freq": 20, "order": 2}, {"cutoff_freq": 20, "order": 4},
+        #  ...]
+    """
+    names = list(axes)
+    return [dict(zip(names, values))
+            for values in itertools.product(*(axes[n] for n in names))]
+
+
+@dataclasses.dataclass
+class SweepResult:
+    """One run of a parameter sweep.
+
+    Attributes:
+        input_id: The input timecourse.
+        params: The parameters of the run.
+        output_id: The output timecourse, if outputs are stored.
+        metric: The run's metric, if the sweep has one.
+        reused: Whether an earlier identical run's output or metric was
+            reused instead of running.
+        error: The error, if the run raised.
+    """
+    input_id: int
+    params: Dict[str, Any]
+    output_id: Optional[int] = None
+    metric: Any = None
+    reused: bool = False
+    error: Optional[str] = None
+
+
+@dataclasses.dataclass
+class SweepReport:
+    """The runs of a ParameterSweep, in input then parameter order.
+
+    Attributes:
+        results: One per input and parameter set.
+        loads: How many inputs were decoded into shared memory (once each,
+            for all of their parameter sets).
+    """
+    results: List[SweepResult] = dataclasses.field(default_factory=list)
+    loads: int = 0
+
+    @property
+    def failed(self) -> List[SweepResult]:
+        return [r for r in self.results if r.error is not None]
+
+    def to_frame(self) -> pd.DataFrame:
+        """The results as a table, with a column per parameter."""
+        return pd.DataFrame([{"input_id": r.input_id, **r.params,
+                              "output_id": r.output_id, "metric": r.metric,
+                              "reused": r.reused, "error": r.error}
+                             for r in self.results])
+
+    def __repr__(self) -> str:
+        reused = sum(r.reused for r in self.results)
+        return (f"SweepReport(runs={len(self.results)}, reused={reused}, "
+                f"failed={len(self.failed)}, loads={self.loads})")
+
+
+def _shareable(timecourse: Timecourse) -> bool:
+    """Whether a timecourse's payload type can be put in shared memory."""
+    _, payload_type = fmt.get_serializer_for_extension(
+        timecourse.data.type, timecourse.path.split('.')[-1])
+    return issubclass(payload_type, (np.ndarray, mne.io.BaseRaw))
+
+
+def _sweep_one(transform_cls: Type[Transform], params: Dict[str, Any],
+               input_id: int, handle: Optional[SharedPayload],
+               metric: Optional[Metric], store_outputs: bool, force: bool
+               ) -> Tuple[Optional[int], Any]:
+    """Run one parameter set in a worker process."""
+    session = runner.worker_session()
+    try:
+        return _sweep(transform_cls, params, input_id, handle, metric,
+                      store_outputs, force, session,
+                      runner.worker_storage_manager())
+    except BaseException:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+
+def _sweep(transform_cls: Type[Transform], params: Dict[str, Any],
+           input_id: int, handle: Optional[SharedPayload],
+           metric: Optional[Metric], store_outputs: bool, force: bool,
+           session: sqlalchemy.orm.Session,
+           storage_manager: StorageManager) -> Tuple[Optional[int], Any]:
+    transform = transform_cls(session.get(Timecourse, input_id), session,
+                              storage_manager=storage_manager, **params)
+    if handle is not None:
+        transform.shared_inputs = {input_id: handle}
+    output_id = None
+    if store_outputs:
+        transform.apply_transform(force=force)
+        transform.commit()
+        output_id = transform.new_timecourse.id
+        output = transform.out_data
+        if transform.reused and metric is not None:
+            output = storage_manager.retrieve(transform.new_timecourse)
+    else:
+        # Only the metric is kept, so no timecourse is constructed.
+        transform._lookup(force=True)
+        try:
+            with transform.telemetry.stage("load"):
+                transform._load_data()
+            with transform.telemetry.stage("transform"):
+                output = transform.transform(transform.data)
+        finally:
+            transform.close()
+    if metric is None:
+        return output_id, None
+
+    value = metric(output)
+    session.add(SweepMetric(
+        input_id=input_id, output_id=output_id,
+        transform=transform_cls.__name__,
+        params_json=json.dumps(params, sort_keys=True,
+                               cls=CustomParamsEncoder),
+        git_commit=transform._get_git_commit(),
+        derivation_key=transform.derivation_key(),
+        value_json=json.dumps(value, cls=_MetricEncoder)))
+    session.commit()
+    return output_id, json.loads(json.dumps(value, cls=_MetricEncoder))
+
+
+class ParameterSweep:
+    """Runs one transform over a grid of parameters, loading inputs once.
+
+    Each input is retrieved and decoded once, into shared memory (see
+    SharedPayloadStore), and every parameter set is then run on it in a
+    process pool, with the workers mapping the decoded payload instead of
+    retrieving it again. Each run is committed as its own timecourse, with
+    its own TransformData, as if the transform had been applied with those
+    parameters. While the workers run one input's parameter sets, the next
+    input is decoded, up to ``max_shared_inputs`` inputs at a time.
+
+    With a ``metric``, each run's output is also reduced to a metric that is
+    saved as a SweepMetric and returned in the report. With
+    ``store_outputs=False`` only the metric is saved, and no timecourses are
+    created. Runs whose output (or metric) already exists are reused
+    without running, so an interrupted sweep resumes where it stopped.
+
+    Payloads that can't be shared (anything but arrays and MNE Raw objects)
+    are retrieved by each run instead.
+
+    Example:
+        sweep = ParameterSweep(
+            FilterTransform, session.query(Timecourse).filter(...),
+            param_grid({"cutoff_freq": [20, 30, 40], "order": [2, 4]}),
+            metric=signal_to_noise, store_outputs=False)
+        report = sweep.run()
+        report.to_frame().groupby(["cutoff_freq", "order"]).metric.mean()
+
+    Args:
+        transform_cls: The Transform subclass. It must be importable by the
+            worker processes.
+        timecourses: The inputs, each run with every parameter set.
+        params: The parameter sets, or a mapping of each parameter to its
+            values to run every combination of (see param_grid).
+        metric: Optionally, a picklable function of a run's output.
+        store_outputs: Whether to store each run's output as a timecourse.
+            Requires a metric if False.
+        storage_manager_factory: A picklable callable that builds the storage
+            managers, as for TransformRunner.
+        n_workers: Number of worker processes. Defaults to the CPU count. 0
+            runs every parameter set in this process.
+        max_shared_inputs: How many decoded inputs may be held in shared
+            memory at once.
+        progress: Called with a message as each run finishes.
+        database_url: As for TransformRunner.
+        force: Rerun parameter sets whose output or metric exists.
+    """
+
+    def __init__(self, transform_cls: Type[Transform],
+                 timecourses: Iterable[Timecourse],
+                 params: Union[Sequence[Dict[str, Any]],
+                               Mapping[str, Sequence[Any]]],
+                 metric: Optional[Metric] = None,
+                 store_outputs: bool = True,
+                 storage_manager_factory: Optional[
+                     Callable[[], StorageManager]] = None,
+                 n_workers: Optional[int] = None,
+                 max_shared_inputs: int = 2,
+                 progress: Optional[Callable[[str], None]] = print,
+                 database_url: Optional[str] = None,
+                 force: bool = False):
+        if not store_outputs and metric is None:
+            raise ValueError("A sweep that doesn't store outputs needs a "
+                             "metric.")
+        if max_shared_inputs < 1:
+            raise ValueError(f"Invalid max_shared_inputs "
+                             f"{max_shared_inputs}.")
+        self.transform_cls = transform_cls
+        self.timecourses = list(timecourses)
+        if isinstance(params, Mapping):
+            params = param_grid(params)
+        self.param_sets = [dict(p) for p in params]
+        self.metric = metric
+        self.store_outputs = store_outputs
+        if storage_manager_factory is None:
+            storage_manager_factory = functools.partial(
+                GCSStorageManager, f"gs://{CONFIG.GS_BUCKET_NAME}",
+                local_cache_dir=CONFIG.CACHE_DIR)
+        self.storage_manager_factory = storage_manager_factory
+        self.n_workers = n_workers
+        self.max_shared_inputs = max_shared_inputs
+        self.progress = progress
+        self.database_url = database_url
+        self.force = force
+        self.session = (object_session(self.timecourses[0])
+                        if self.timecourses else None)
+
+    def _plan(self, timecourse: Timecourse, storage_manager: StorageManager,
+              report: SweepReport) -> List[SweepResult]:
+        """Add an input's results to the report, returning those to run."""
+        to_run = []
+        for params in self.param_sets:
+            result = SweepResult(timecourse.id, params)
+            report.results.append(result)
+            key = None
+            if not self.force:
+                transform = self.transform_cls(
+                    timecourse, self.session,
+                    storage_manager=storage_manager, **params)
+                # None if the code isn't committed, so nothing is reused.
+                key = transform.derivation_key()
+            if key is not None and self.metric is not None:
+                recorded = (self.session.query(SweepMetric)
+                            .filter(SweepMetric.derivation_key == key)
+                            .order_by(SweepMetric.id.desc()).first())
+                if recorded is not None:
+                    result.reused = True
+                    result.output_id = recorded.output_id
+                    result.metric = json.loads(recorded.value_json)
+                    continue
+            elif key is not None:
+                existing = transform._find_derivation(key)
+                if existing is not None:
+                    result.reused = True
+                    result.output_id = existing.id
+                    continue
+            to_run.append(result)
+        return to_run
+
+    def _finish(self, result: SweepResult,
+                outcome: Optional[Tuple[Optional[int], Any]],
+                error: Optional[str]):
+        if error is not None:
+            result.error = error
+            message = (f"{self.transform_cls.__name__}{result.params} on "
+                       f"timecourse {result.input_id} failed: "
+                       f"{error.strip().splitlines()[-1]}")
+        else:
+            result.output_id, result.metric = outcome
+            message = (f"{self.transform_cls.__name__}{result.params} on "
+                       f"timecourse {result.input_id} -> "
+                       + (f"{result.output_id}" if self.metric is None else
+                          f"{result.metric}"))
+        if self.progress is not None:
+            self.progress(message)
+
+    def run(self) -> SweepReport:
+        """Run every parameter set on every input."""
+        report = SweepReport()
+        if not self.timecourses:
+            return report
+        storage_manager = self.storage_manager_factory()
+        executor = None
+        if self.n_workers != 0:
+            database_url = (self.database_url or
+                            runner.session_database_url(self.session))
+            executor = ProcessPoolExecutor(
+                max_workers=self.n_workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=runner.init_worker,
+                initargs=(database_url, self.storage_manager_factory))
+        inputs = iter(self.timecourses)
+        pending: Dict[Future, SweepResult] = {}
+        # The shared payload and number of unfinished runs of each input.
+        live: Dict[int, List[Any]] = {}
+
+        with SharedPayloadStore() as store:
+            def done_with(input_id: int):
+                live[input_id][1] -= 1
+                if live[input_id][1] == 0:
+                    handle = live.pop(input_id)[0]
+                    if handle is not None:
+                        store.release(handle)
+
+            def fill():
+                while len(live) < self.max_shared_inputs:
+                    timecourse = next(inputs, None)
+                    if timecourse is None:
+                        return
+                    to_run = self._plan(timecourse, storage_manager, report)
+                    if not to_run:
+                        continue
+                    handle = None
+                    if _shareable(timecourse):
+                        try:
+                            handle = storage_manager.retrieve_shared(
+                                timecourse, store)
+                        except TypeError:
+                            # e.g. a masked fMRI volume.
+                            pass
+                        report.loads += 1
+                    live[timecourse.id] = [handle, len(to_run)]
+                    for result in to_run:
+                        args = (self.transform_cls, result.params,
+                                result.input_id, handle, self.metric,
+                                self.store_outputs, self.force)
+                        if executor is not None:
+                            pending[executor.submit(_sweep_one, *args)] = \
+                                result
+                            continue
+                        try:
+                            outcome = _sweep(*args, self.session,
+                                             storage_manager)
+                            self._finish(result, outcome, None)
+                        except Exception:
+                            self.session.rollback()
+                            self._finish(result, None,
+                                         traceback.format_exc())
+                        done_with(result.input_id)
+
+            try:
+                fill()
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        result = pending.pop(future)
+                        self._finish(result, *runner.result_or_error(future))
+                        done_with(result.input_id)
+                    fill()
+            finally:
+                if executor is not None:
+                    for future in pending:
+                        future.cancel()
+                    executor.shutdown()
+
+        self.session.expire_all()
+        return report
@@ -1,19 +1,29 @@
-from typing import Any, Dict, Generic, List, Optional, Tuple, TypeVar
+from typing import (Any, Callable, Dict, Generic, List, Optional, Tuple, Type,
+                    TypeVar)
 
 import sqlalchemy.orm
-from sqlalchemy import text
 from sqlalchemy.orm import object_session
+from sqlalchemy.orm.attributes import set_committed_value
 
 from abc import ABC, abstractmethod
-from datetime import datetime
+from datetime import datetime, timezone
+import dataclasses
+import functools
+import hashlib
 import json
+import socket
 
 from ..config import get_config
 from ..db import Session
 from ..models import Data, Study, Subject, Timecourse,TransformData
-from ..storage import StorageManager, GCSStorageManager
+from ..models import TransformRun, TransformRunStage
+from ..storage import SharedPayload, StorageManager, GCSStorageManager
+from ..storage.views import Operation, View
 from ..utils import data_utils as du
 from ..utils import git_utils
+from ..utils import ingest
+from ..utils import telemetry
+from .batch import current_batch
 
 CONFIG = get_config()
 
@@ -29,9 +39,22 @@ class CustomParamsEncoder(json.JSONEncoder):
         return super().default(obj)
 
 
+# Transform subclasses by class name, the name recorded in TransformData.
+TRANSFORMS: Dict[str, Type['Transform']] = {}
+
+
 class Transform(ABC, Generic[T, U]):
     input_datatype: Data
     output_datatype: Data
+    # Whether commit() saves a TransformRun with the cost of each stage.
+    record_runs: bool = True
+    # Peak memory of a run, as a multiple of the size of its loaded inputs
+    # (see estimate_memory).
+    memory_multiplier: float = 3.0
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        TRANSFORMS[cls.__name__] = cls
 
     def __init__(self, timecourse: Optional[Timecourse],
                  session: Optional[sqlalchemy.orm.Session],
@@ -39,12 +62,25 @@ class Transform(ABC, Generic[T, U]):
                  **params):
         self.params = params
         self.data = None
+        self.reused = False
+        self.telemetry = telemetry.Recorder()
+        self.run: Optional[TransformRun] = None
+        # Inputs already decoded into shared memory, by timecourse id.
+        self.shared_inputs: Dict[int, SharedPayload] = {}
+        self._git_commit: Optional[str] = None
+        self._git_clean: Optional[bool] = None
         sess = None
         self.input_timecourses = []
+        batch = current_batch()
+        if batch is not None:
+            if storage_manager is None:
+                storage_manager = batch.storage_manager
+            if session is None:
+                session = batch.session
         if storage_manager is None:
             self.storage_manager = GCSStorageManager(
-                CONFIG.GCS_BUCKET,
-                local_cache_dir=CONFIG.LOCAL_CACHE_DIR
+                f"gs://{CONFIG.GS_BUCKET_NAME}",
+                local_cache_dir=CONFIG.CACHE_DIR
             )
         else:
             self.storage_manager = storage_manager
@@ -71,66 +107,386 @@ class Transform(ABC, Generic[T, U]):
     def _transform_params(self) -> List[Dict[str, Any]]:
         return [self.params]
     
-    def _get_transform_data(self) -> TransformData:
-        if not (CONFIG.DEBUG or git_utils.no_uncommitted_changes()):
-            raise Exception("Git repo has uncommitted changes.")
+    def _get_git_commit(self) -> str:
+        # Running git costs a fork per call, so the commit is looked up once
+        # per transform, or once per TransformBatch.
+        batch = current_batch()
+        if batch is not None:
+            return batch.git_commit
+        if self._git_commit is None:
+            self._git_commit = git_utils.get_most_recent_commit()
+        return self._git_commit
+
+    def _is_git_clean(self) -> bool:
+        batch = current_batch()
+        if batch is not None:
+            return bool(batch.git_clean)
+        if self._git_clean is None:
+            self._git_clean = bool(git_utils.no_uncommitted_changes())
+        return self._git_clean
+
+    def _get_transform_data(self, names: Optional[List[str]] = None,
+                            params: Optional[List[Dict[str, Any]]] = None
+                            ) -> TransformData:
+        if not CONFIG.DEBUG:
+            if not self._is_git_clean():
+                raise Exception("Git repo has uncommitted changes.")
+        if names is None:
+            names, params = self._transform_names(), self._transform_params()
         transform_data = TransformData(
-            transform_names_json=json.dumps(self._transform_names(),
-                                            cls=CustomParamsEncoder),
-            transform_params_json=json.dumps(self._transform_params(),
+            transform_names_json=json.dumps(names, cls=CustomParamsEncoder),
+            transform_params_json=json.dumps(params,
                                              cls=CustomParamsEncoder),
-            git_commit=git_utils.get_most_recent_commit()
+            git_commit=self._get_git_commit()
         )
         return transform_data
     
-    def apply_transform(self):
-        self._load_data()
-        self.out_data = self.transform(self.data)
-        new_timecourse = self._construct_new_timecourse()
+    def derivation_key(self) -> Optional[str]:
+        """
+        A hash identifying this derivation.
+
+        The key covers the ids of the input timecourses (in order), the
+        transform names, the parameters serialized as canonical JSON and the
+        git commit. Two transforms with the same key produce the same data,
+        since a key is only given when the code is committed.
+
+        Returns
+        -------
+        str or None
+            The hex digest, or None if the transform has no saved inputs
+            (e.g. raw uploads), or if the code isn't a clean git checkout
+            (uncommitted changes, or no commit at all), in which case it is
+            never reused.
+        """
+        return self._derivation_key(self._transform_names(),
+                                    self._transform_params())
+
+    def _derivation_key(self, names: List[str],
+                        params: List[Dict[str, Any]]) -> Optional[str]:
+        if not self.input_timecourses:
+            return None
+        # The commit only identifies the code if nothing was changed since.
+        git_commit = self._get_git_commit()
+        if git_commit is None or not self._is_git_clean():
+            return None
+        if any(tc.id is None for tc in self.input_timecourses):
+            # Inputs created earlier in a TransformBatch get their ids when
+            # the session is flushed.
+            if self.session is None:
+                return None
+            self.session.flush()
+        input_ids = [tc.id for tc in self.input_timecourses]
+        canonical = json.dumps({
+            "inputs": input_ids,
+            "names": names,
+            "params": params,
+            "git_commit": git_commit,
+        }, sort_keys=True, separators=(',', ':'), cls=CustomParamsEncoder)
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    def find_existing(self) -> Optional[Timecourse]:
+        """Return a saved timecourse with this transform's derivation key."""
+        return self._find_derivation(self.derivation_key())
+
+    def _find_derivation(self, key: Optional[str]) -> Optional[Timecourse]:
+        if key is None:
+            return None
+        batch = current_batch()
+        if batch is not None and batch.find_pending(key) is not None:
+            return batch.find_pending(key)
+        # Pending timecourses are found above, so don't flush a batch early.
+        with self.session.no_autoflush:
+            return (self.session.query(Timecourse)
+                    .filter(Timecourse.derivation_key == key)
+                    .order_by(Timecourse.id)
+                    .first())
+
+    def apply_transform(self, force: bool = False) -> Timecourse:
+        """
+        Run the transform, or reuse the output of an identical run.
+
+        If a timecourse was already derived from the same inputs by the same
+        transforms, parameters and git commit, it is returned without loading
+        any data, ``out_data`` is None and ``commit()`` does nothing.
+
+        The wall time, CPU time, bytes read and peak memory of each stage are
+        recorded in ``telemetry``, and saved as a TransformRun by
+        ``commit()``.
+
+        Parameters
+        ----------
+        force : bool
+            Recompute even if an identical derivation exists.
+
+        Returns
+        -------
+        Timecourse
+            The new (uncommitted) or existing timecourse.
+        """
+        if self._lookup(force):
+            return self.new_timecourse
+        with self.telemetry.stage("load"):
+            self._load_data()
+        return self._finish_transform()
+
+    def _lookup(self, force: bool) -> bool:
+        """Start a run, returning whether an identical derivation exists."""
+        self.reused = False
+        self.telemetry = telemetry.Recorder()
+        self.run = None
+        self._started_at = datetime.now(timezone.utc).replace(tzinfo=None)
+        if not force:
+            with self.telemetry.stage("lookup"):
+                existing = self.find_existing()
+            if existing is not None:
+                self.reused = True
+                self.out_data = None
+                self.new_timecourse = existing
+        return self.reused
+
+    def _finish_transform(self) -> Timecourse:
+        """Transform the loaded data and construct the new timecourse."""
+        with self.telemetry.stage("transform"):
+            self.out_data = self.transform(self.data)
+        with self.telemetry.stage("construct"):
+            new_timecourse = self._construct_new_timecourse()
+            new_timecourse.derivation_key = self.derivation_key()
         self.new_timecourse = new_timecourse
+        return new_timecourse
 
     def _construct_new_timecourse(self):
-        # Get an ID for the timecourse.
-        result = self.session.execute(
-            text("SELECT nextval('timecourse_id_seq')"))
-        next_id = result.scalar()
+        return self._construct_timecourse(self.output_datatype,
+                                          self._get_transform_data(),
+                                          self.out_data)
 
-        transform_data = self._get_transform_data()
+    def _construct_timecourse(self, data: Data, transform_data: TransformData,
+                              payload: du.TimecoursePayload) -> Timecourse:
+        # The ID is assigned by the database when the timecourse is flushed.
         new_timecourse = Timecourse(
-            id=next_id,
-            study=self.input_timecourses[0].study,
-            subject=self.input_timecourses[0].subject,
-            data=self.output_datatype,
+            data=data,
             transform=transform_data,
             is_pilot=self.input_timecourses[0].is_pilot,
             date_collected = datetime.now().astimezone()
 
         )
-        for parent in self.input_timecourses:
-            new_timecourse.derived_from.append(parent)
-        
+        # Until it is added to the session (see _link_timecourse), the new
+        # timecourse isn't put in the collections of its study, subject and
+        # parents, which are in the session: every flush in between (e.g.
+        # while OverlappingRunner transforms the next input) would warn that
+        # it can't be saved along with them.
+        set_committed_value(new_timecourse, "study",
+                            self.input_timecourses[0].study)
+        set_committed_value(new_timecourse, "subject",
+                            self.input_timecourses[0].subject)
+
         # Get the upload path for the new timecourse
-        uri = self.storage_manager.get_uri_from_data(new_timecourse, T)
+        uri = self.storage_manager.get_uri_from_data(new_timecourse, payload)
         # gs_url = du.construct_gs_url(new_timecourse)
         new_timecourse.path = uri
         return new_timecourse
-        
+
+    def _link_timecourse(self, new_timecourse: Timecourse):
+        """Relate a constructed timecourse to its study, subject and parents.
+
+        Called just before it is added to the session.
+        """
+        study, subject = new_timecourse.study, new_timecourse.subject
+        set_committed_value(new_timecourse, "study", None)
+        set_committed_value(new_timecourse, "subject", None)
+        new_timecourse.study = study
+        new_timecourse.subject = subject
+        for parent in self.input_timecourses:
+            new_timecourse.derived_from.append(parent)
+
+    def input_nbytes(self) -> Optional[int]:
+        """
+        Estimate the memory the inputs take once loaded, without loading them.
+
+        Returns
+        -------
+        int or None
+            Bytes (see StorageManager.estimate_nbytes), or None if the size
+            of an input can't be estimated.
+        """
+        sizes = [self.storage_manager.estimate_nbytes(tc)
+                 for tc in self.input_timecourses]
+        if not sizes or any(size is None for size in sizes):
+            return None
+        return sum(sizes)
+
+    def estimate_memory(self, input_nbytes: Optional[int] = None
+                        ) -> Optional[int]:
+        """
+        Estimate the peak memory of a run, used to admit concurrent runs.
+
+        By default ``memory_multiplier`` times the size of the inputs.
+        Transforms whose memory use doesn't scale with their inputs override
+        this, or set ``memory_multiplier``.
+
+        Parameters
+        ----------
+        input_nbytes : int, optional
+            The size of the inputs, if already known (see ``input_nbytes``).
+
+        Returns
+        -------
+        int or None
+            Bytes, or None if there is no estimate.
+        """
+        if input_nbytes is None:
+            input_nbytes = self.input_nbytes()
+        if input_nbytes is None:
+            return None
+        return int(input_nbytes * self.memory_multiplier)
 
     def _load_data(self):
-        self.data = []
-        for tc in self.input_timecourses:
-            self.data.append(self.storage_manager.retrieve(tc))
-        
+        self.data = self.prepare_load()()
+
+    def prepare_load(self) -> Callable[[], Any]:
+        """
+        Look up the inputs, returning a function that loads them.
+
+        The function doesn't use the session, so it can run on another thread
+        (see OverlappingRunner) while this one does other work. Inputs with a
+        handle in ``shared_inputs`` are attached from shared memory instead
+        of being retrieved, copy-on-write, so that a transform may modify its
+        input in place without the other runs sharing it seeing the change.
+
+        Returns
+        -------
+        callable
+            Returns the data passed to ``transform``.
+        """
+        loaders = [functools.partial(self.shared_inputs[tc.id].attach,
+                                     private=True)
+                   if tc.id in self.shared_inputs
+                   else self.storage_manager.prepare_retrieve(tc)
+                   for tc in self.input_timecourses]
+        return lambda: [load() for load in loaders]
+
+    def prepare_store(self) -> Callable[[], None]:
+        """
+        Work out where the output goes, returning a function that stores it.
+
+        Like ``prepare_load``, the function can run on another thread.
+        """
+        return self.storage_manager.prepare_store(self.new_timecourse,
+                                                  self.out_data)
+
     def commit(self):
-        # du.reupload_data_to_gcs(self.out_data,
-        #                         self.new_timecourse.path)
-        self.storage_manager.store(self.new_timecourse, self.out_data)
+        if self.reused:
+            return
+        try:
+            # du.reupload_data_to_gcs(self.out_data,
+            #                         self.new_timecourse.path)
+            store = self.prepare_store()
+            with self.telemetry.stage("store"):
+                store()
+            self._commit_to_session()
+        finally:
+            self.close()
+
+    def close(self):
+        """Release whatever the loaded data holds open (called by commit)."""
+
+    def _commit_to_session(self):
+        """Add the stored output to the session and commit it."""
+        self._link_timecourse(self.new_timecourse)
+        if self.record_runs:
+            self._build_run()
+        batch = current_batch()
+        if batch is not None:
+            # Commits are shared by the whole batch, so there is no db_commit
+            # stage.
+            batch.add(self.new_timecourse, self.session)
+            if self.run is not None:
+                self.session.add(self.run)
+            return
         self.session.add(self.new_timecourse)
-        self.session.commit()
-        
+        if self.run is not None:
+            self.session.add(self.run)
+        with self.telemetry.stage("db_commit") as measurement:
+            self.session.commit()
+        if self.run is not None:
+            # The commit can only be saved once it has been timed.
+            position = len(self.telemetry.stages) - 1
+            self.session.add(self._build_stage(position, measurement))
+            self._total_run()
+            self.session.commit()
+
+    def _build_run(self) -> TransformRun:
+        self.run = TransformRun(
+            timecourse=self.new_timecourse,
+            transform=self.__class__.__name__,
+            git_commit=self.new_timecourse.transform.git_commit,
+            hostname=socket.gethostname(),
+            started_at=self._started_at)
+        for i, measurement in enumerate(self.telemetry.stages):
+            self._build_stage(i, measurement)
+        self._total_run()
+        return self.run
+
+    def _build_stage(self, position: int,
+                     measurement: telemetry.StageMeasurement
+                     ) -> TransformRunStage:
+        return TransformRunStage(run=self.run, position=position,
+                                 stage=measurement.name,
+                                 wall_time=measurement.wall_time,
+                                 cpu_time=measurement.cpu_time,
+                                 bytes=measurement.bytes,
+                                 max_rss=measurement.max_rss)
+
+    def _total_run(self):
+        top_level = self.telemetry.top_level()
+        self.run.wall_time = sum(s.wall_time for s in top_level)
+        self.run.cpu_time = sum(s.cpu_time for s in top_level)
+        self.run.max_rss = telemetry.max_rss()
+
+
+class ViewTransform(Transform[T, View]):
+    """
+    A transform whose output is a view of its input's payload.
+
+    Subclasses implement ``view_ops``, returning the operations (see
+    storage.views, e.g. ``crop`` or ``pick``) that derive the output from
+    the input. The output is stored as a small descriptor referencing the
+    input instead of a copy of it, and the input isn't loaded to create it:
+    the operations are applied whenever the output is retrieved. Lineage and
+    TransformData are recorded as for any other transform.
+    """
+    # Nothing is loaded.
+    memory_multiplier: float = 0.0
+
+    @abstractmethod
+    def view_ops(self) -> List[Operation]:
+        """The operations applied to the input's payload, in order."""
+        raise NotImplementedError
+
+    def prepare_load(self) -> Callable[[], Any]:
+        return lambda: None
+
+    def transform(self, data: None) -> View:
+        if len(self.input_timecourses) != 1:
+            raise ValueError(f"{type(self).__name__} is a view of one "
+                             f"timecourse, but was given "
+                             f"{len(self.input_timecourses)}.")
+        parent = self.input_timecourses[0]
+        if parent.id is None and self.session is not None:
+            # An input created earlier in a TransformBatch.
+            self.session.flush()
+        return View.of(parent, *self.view_ops())
+
 
 W = TypeVar('W', bound=du.TimecoursePayload)
 class RawDataUpload(Transform[W, W], Generic[W]):
+    """Uploads a local raw data file as a new root timecourse.
+
+    Files in a format with a registered ingestion plugin (e.g. NIfTI, EDF,
+    BrainVision) are read lazily and converted to the storage format in
+    bounded-memory blocks when committed, and the sampling rate recorded in
+    their header replaces the one given in ``data_type``. Other files are
+    loaded with ``data_utils.load_data_from_local``.
+    """
     
     def __init__(self, data_type: Data, subject: Subject, study: Study,
                  is_pilot: bool, file_path: str,
@@ -144,19 +500,15 @@ class RawDataUpload(Transform[W, W], Generic[W]):
         self.study = study
         self.subject = subject
         self.is_pilot = is_pilot
+        self._source: Optional[ingest.IngestPlugin] = None
 
     def _construct_new_timecourse(self):
-        # Get an ID for the timecourse.
-        result = self.session.execute(
-            text("SELECT nextval('timecourses_id_seq')"))
-        next_id = result.scalar()
-
+        # The ID is assigned by the database when the timecourse is flushed.
         if self.date_collected is None:
             print("DEBUG: No date collected")
             self.date_collected = datetime.now().astimezone()
 
         new_timecourse = Timecourse(
-            id=next_id,
             study=self.study,
             subject=self.subject,
             data=self.output_datatype,
@@ -170,7 +522,25 @@ class RawDataUpload(Transform[W, W], Generic[W]):
         return new_timecourse
 
     def _load_data(self):
-        self.data = du.load_data_from_local(self.file_path)
+        plugin = ingest.get_plugin(self.file_path)
+        if plugin is None:
+            self.data = du.load_data_from_local(self.file_path)
+            return
+
+        self._source = plugin(self.file_path)
+        self.data = self._source.load()
+        sampling_rate = self._source.sampling_rate
+        if sampling_rate is not None:
+            if sampling_rate != self.output_datatype.sampling_rate:
+                print(f"Using sampling rate {sampling_rate} from the header "
+                      f"of {self.file_path} instead of "
+                      f"{self.output_datatype.sampling_rate}")
+            self.output_datatype = dataclasses.replace(
+                self.output_datatype, sampling_rate=sampling_rate)
+
+    def close(self):
+        if self._source is not None:
+            self._source.close()
 
     def transform(self, data: W) -> W:
         return data
\ No newline at end of file
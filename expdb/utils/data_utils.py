@@ -1,15 +1,17 @@
-from typing import Dict, Union
+from typing import Callable, Dict, Iterator, Optional, Union
 
 from ..config import get_config
 from ..models import DataType, Timecourse
 
-import io
+import contextlib
+import gzip
 import numpy as np
 import pandas as pd
 from google.cloud import storage
 import mne
 import cv2  # OpenCV for video
 from pydub import AudioSegment
+import soundfile as sf
 import os
 import subprocess
 import tempfile
@@ -54,7 +56,7 @@ def construct_gs_url(timecourse: Timecourse) -> str:
 
 def load_bdf(path: str) -> mne.io.Raw:
     """
-    Loads EEG data from a BDF file stored in memory as bytes.
+    Loads EEG data from a BDF file.
     
     Args:
         path: BDF file.
@@ -64,13 +66,23 @@ def load_bdf(path: str) -> mne.io.Raw:
     """
     raw = mne.io.read_raw_bdf(path, preload=True)
     return raw
-    # with io.BytesIO(data_bytes) as bdf_file:
-    #     raw = mne.io.read_raw_bdf(bdf_file, preload=True)
-    #     return raw
+
+def load_edf(path: str) -> mne.io.Raw:
+    """
+    Loads EEG data from an EDF file.
+    
+    Args:
+        path: EDF file.
+    
+    Returns:
+        mne.io.BaseRaw: The loaded EEG data.
+    """
+    raw = mne.io.read_raw_edf(path, preload=True)
+    return raw
 
 def load_mne_raw(path: str) -> mne.io.Raw:
     """
-    Loads EEG data from a fif file stored in memory as bytes.
+    Loads EEG data from a fif file.
     
     Args:
         path: fif file.
@@ -82,68 +94,97 @@ def load_mne_raw(path: str) -> mne.io.Raw:
     return raw
 
 
-def load_npz(data_bytes: bytes) -> Dict[str, np.ndarray]:
+def load_npz(path: str) -> Dict[str, np.ndarray]:
     """
-    Loads a .npz file from memory as bytes and returns a dictionary of numpy arrays.
+    Loads a .npz file and returns a dictionary of numpy arrays.
     
     Args:
-        data_bytes (bytes): NPZ file content in bytes.
+        path: NPZ file.
     
     Returns:
         Dict[str, np.ndarray]: Dictionary of numpy arrays.
     """
-    with io.BytesIO(data_bytes) as npz_file:
-        npz_data = np.load(npz_file, allow_pickle=True)
+    with np.load(path, allow_pickle=False) as npz_data:
         return dict(npz_data)
 
-def load_parquet(data_bytes: bytes) -> pd.DataFrame:
+def load_npy(path: str) -> np.ndarray:
+    """
+    Loads a .npy file as a numpy array.
+    
+    Args:
+        path: NPY file.
+    
+    Returns:
+        np.ndarray: The stored array.
+    """
+    return np.load(path, allow_pickle=False)
+
+def load_parquet(path: str) -> pd.DataFrame:
     """
-    Loads a Parquet file from memory as bytes and returns a pandas DataFrame.
+    Loads a Parquet file and returns a pandas DataFrame.
     
     Args:
-        data_bytes (bytes): Parquet file content in bytes.
+        path: Parquet file.
     
     Returns:
         pd.DataFrame: Loaded pandas DataFrame.
     """
-    with io.BytesIO(data_bytes) as parquet_file:
-        df = pd.read_parquet(parquet_file)
-        return df
+    return pd.read_parquet(path)
 
-def load_video(data_bytes: bytes) -> np.ndarray:
+def load_video(path: str) -> np.ndarray:
     """
-    Loads a video file from memory as bytes and returns the frames as 
-    numpy arrays.
+    Loads a video file and returns its frames as a numpy array.
     
     Args:
-        data_bytes (bytes): Video file content in bytes.
+        path: Video file.
     
     Returns:
-        np.ndarray: Array of video frames.
-    """    
-    with io.BytesIO(data_bytes) as video_file:
-        # Open the video file using OpenCV
-        video_file.seek(0)  # Make sure we're at the start of the file
-        video_array = []
-        # Write the video_file to a temporary file to process with OpenCV
-        temp_video_file = '/tmp/temp_video.mp4'
-        with open(temp_video_file, 'wb') as f:
-            f.write(video_file.read())
-        cap = cv2.VideoCapture(temp_video_file)
+        np.ndarray: Array of RGB video frames of shape
+        (frames, height, width, 3), as expected by the video serializer.
+    """
+    cap = cv2.VideoCapture(path)
+    try:
+        # The reported frame count is a hint, not a guarantee, so grow or
+        # trim the preallocated array as needed.
+        n_frames = max(int(cap.get(cv2.CAP_PROP_FRAME_COUNT)), 0)
+        height = int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT))
+        width = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH))
+        frames = np.empty((n_frames, height, width, 3), dtype=np.uint8)
+        i = 0
         while cap.isOpened():
             ret, frame = cap.read()
             if not ret:
                 break
-            video_array.append(frame)
+            if i == len(frames):
+                frames = np.concatenate(
+                    [frames, np.empty((max(i, 1), height, width, 3),
+                                      dtype=np.uint8)])
+            frames[i] = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+            i += 1
+        return frames[:i]
+    finally:
         cap.release()
-        return np.array(video_array)
 
-# Helper function to load audio data
-def load_audio(data_bytes):
-    with io.BytesIO(data_bytes) as audio_file:
-        audio_segment = AudioSegment.from_file(audio_file)
-        samples = np.array(audio_segment.get_array_of_samples())
+def load_audio(path: str) -> np.ndarray:
+    """
+    Loads an audio file and returns its samples.
+    
+    Args:
+        path: Audio file.
+    
+    Returns:
+        np.ndarray: float32 samples in [-1, 1] of shape (samples, channels).
+    """
+    try:
+        samples, _ = sf.read(path, dtype="float32", always_2d=True)
         return samples
+    except sf.LibsndfileError:
+        # Formats libsndfile can't decode go through ffmpeg.
+        audio_segment = AudioSegment.from_file(path)
+        samples = np.array(audio_segment.get_array_of_samples(),
+                           dtype=np.float32)
+        samples = samples.reshape(-1, audio_segment.channels)
+        return samples / float(1 << (8 * audio_segment.sample_width - 1))
     
 def save_bdf(data: mne.io.Raw) -> str:
     """
@@ -280,47 +321,138 @@ def save_mne_raw(data: mne.io.Raw) -> str:
 #     return bytes_io
     
 
+# Loaders for each file format, taking a path to the file.
+FORMAT_LOADERS: Dict[str, Callable[[str], TimecoursePayload]] = {
+    "bdf": load_bdf,
+    "edf": load_edf,
+    "fif": load_mne_raw,
+    "npz": load_npz,
+    "npy": load_npy,
+    "parquet": load_parquet,
+    "mp4": load_video,
+    "mov": load_video,
+    "avi": load_video,
+    "mp3": load_audio,
+    "wav": load_audio,
+}
+
+# Bytes needed to recognize any of the formats above.
+_SNIFF_BYTES = 512
+
+
+def sniff_format(path: str) -> Optional[str]:
+    """
+    Determines a file's format from its leading magic bytes.
+    
+    Args:
+        path: Local path to the file.
+    
+    Returns:
+        Optional[str]: The format name (a key of FORMAT_LOADERS, or a format
+        only handled by an ingestion plugin, such as "nifti"), or None if
+        the format isn't recognized.
+    """
+    with open(path, 'rb') as f:
+        head = f.read(_SNIFF_BYTES)
+
+    if head.startswith(b'\xffBIOSEMI'):
+        return "bdf"
+    if head.startswith(b'0       '):
+        return "edf"
+    # FIF files open with a FIFF_FILE_ID (100) tag of type ID struct (31).
+    if head.startswith(b'\x00\x00\x00\x64\x00\x00\x00\x1f'):
+        return "fif"
+    if head.startswith((b'PK\x03\x04', b'PK\x05\x06')):
+        return "npz"
+    if head.startswith(b'\x93NUMPY'):
+        return "npy"
+    if head.startswith(b'PAR1'):
+        return "parquet"
+    if head.startswith((b'Brain Vision Data Exchange Header File',
+                        b'BrainVision Data Exchange Header File')):
+        return "brainvision"
+    if head.startswith(b'\x1f\x8b'):
+        # Gzipped NIfTI (.nii.gz); look at the decompressed header.
+        with gzip.open(path, 'rb') as f:
+            head = f.read(_SNIFF_BYTES)
+    if head[344:348] == b'n+1\x00':
+        return "nifti"
+    if head[4:8] == b'ftyp':
+        return "mov" if head[8:12] == b'qt  ' else "mp4"
+    if head.startswith(b'RIFF'):
+        if head[8:12] == b'AVI ':
+            return "avi"
+        if head[8:12] == b'WAVE':
+            return "wav"
+    # MP3 files start with an ID3 tag or directly with an MPEG frame sync.
+    if head.startswith(b'ID3') or (len(head) > 1 and head[0] == 0xFF
+                                   and head[1] & 0xE0 == 0xE0):
+        return "mp3"
+    return None
+
+
+@contextlib.contextmanager
+def scratch_file(suffix: str = "") -> Iterator[str]:
+    """
+    Creates a uniquely named scratch file that is removed on exit.
+    
+    Use this, never a fixed path, when a decoder needs its input on disk, so
+    that concurrent uploads in any number of workers can't clobber each
+    other's data.
+    
+    Args:
+        suffix: Suffix of the file name, e.g. ".bdf".
+    
+    Yields:
+        str: Path to the (empty) scratch file.
+    """
+    fd, path = tempfile.mkstemp(suffix=suffix)
+    os.close(fd)
+    try:
+        yield path
+    finally:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def _resolve_format(path: str, ext: Optional[str]) -> str:
+    data_format = sniff_format(path)
+    if data_format is None and ext is not None:
+        # Fall back to the extension for formats without reliable magic bytes.
+        data_format = ext.lstrip(".").lower()
+    if data_format not in FORMAT_LOADERS:
+        raise ValueError(f"Unsupported file format: {ext}")
+    return data_format
+
+
 def bytes_to_data(data_bytes: bytes, ext: str) -> TimecoursePayload:
+    """
+    Loads data held in memory as bytes.
+    
+    Prefer load_data_from_local, which reads straight from the original file
+    instead of requiring a copy of it in memory.
+    
+    Args:
+        data_bytes: File content.
+        ext: The file's extension, with or without the leading dot. Only used
+            if the format can't be determined from the content.
     
-    # Determine the file type based on file extension
-    if ext == "bdf":
-        # Load EEG data from .bdf file
-        path = '/tmp/temp_bdf.bdf'
-        with open('/tmp/temp_bdf.bdf', 'wb') as f:
+    Returns:
+        TimecoursePayload: The loaded data.
+    """
+    with scratch_file(suffix=f".{ext.lstrip('.')}") as path:
+        with open(path, 'wb') as f:
             f.write(data_bytes)
-        eeg_data = load_bdf(path)
-        os.remove(path)
-        return eeg_data
-    elif ext == ".npz":
-        # Load .npz file into a dictionary of numpy arrays
-        npz_data = load_npz(data_bytes)
-        return npz_data
-    elif ext == ".parquet":
-        # Load parquet file into pandas dataframe
-        df = load_parquet(data_bytes)
-        return df
-    elif (ext == '.mp4' or
-          ext == '.avi' or
-          ext == '.mov'):
-        # Load video file as numpy arrays (frames)
-        video_data = load_video(data_bytes)
-        return video_data
-    elif (ext == '.mp3' or 
-          ext == '.wav'):
-        # Load audio file as numpy arrays (waveform)
-        audio_data = load_audio(data_bytes)
-        return audio_data
-    elif ext == ".fif":
-        # Load EEG data from .fif file
-        return load_mne_raw(data_bytes)
-    else:
-        raise ValueError("Unsupported file format")
+        return load_data_from_local(path, ext=ext)
 
 def load_data_from_gcs(gs_path: str) -> TimecoursePayload:
     """
     Loads data from a Google Cloud Storage bucket, determines the file type, 
     and returns the data loaded into an appropriate data structure.
 
+    The object is streamed to a unique scratch file rather than held in
+    memory.
+
     Args:
         gs_path (str): Google Cloud Storage path (gs://bucket_name/blob_name).
     
@@ -340,26 +472,33 @@ def load_data_from_gcs(gs_path: str) -> TimecoursePayload:
     bucket = storage_client.bucket(bucket_name)
     blob = bucket.blob(blob_path)
     
-    # Download file as bytes stream
-    data_bytes = blob.download_as_bytes()
-    
-    return bytes_to_data(data_bytes, blob_path.split(".")[-1])
+    ext = blob_path.split(".")[-1]
+    with scratch_file(suffix=f".{ext}") as path:
+        blob.download_to_filename(path)
+        return load_data_from_local(path, ext=ext)
 
-def load_data_from_local(path: str) -> TimecoursePayload:
+def load_data_from_local(path: str, ext: Optional[str] = None
+                         ) -> TimecoursePayload:
     """
     Loads data from a local path, determines the file type, and returns the data
     loaded into an appropriate data structure.
 
+    The format is determined from the file's magic bytes, falling back to its
+    extension, and the file is decoded in place without first being read
+    into memory.
+
     Args:
         path (str): Local path to the file.
+        ext (str, optional): Extension to fall back on if the format can't be
+            sniffed. Defaults to the extension of ``path``.
     
     Returns:
         Union[mne.io.BaseRaw, Dict[str, np.ndarray], pd.DataFrame, np.ndarray]: 
         Loaded data, either EEG data, npz data, a DataFrame, or numpy array (for video/audio).
     """
-    with open(path, 'rb') as f:
-        data_bytes = f.read()
-    return bytes_to_data(data_bytes, path.split(".")[-1])
+    if ext is None:
+        ext = os.path.splitext(path)[1] or None
+    return FORMAT_LOADERS[_resolve_format(path, ext)](path)
     
 # Re-upload data to GCS based on file extension
 def reupload_data_to_gcs(data: TimecoursePayload,
@@ -27,3 +27,18 @@ def no_uncommitted_changes():
     except subprocess.CalledProcessError as e:
         print("Error: Could not check for uncommitted changes.")
         return None
+
+def files_changed_since(commit, paths):
+    """Returns which of the paths differ between a commit and HEAD.
+
+    Only committed changes are compared. Returns None if the commit isn't
+    known to the repository or a path is outside of it.
+    """
+    try:
+        output = subprocess.check_output(
+            ['git', 'diff', '--name-only', commit, 'HEAD', '--', *paths],
+            stderr=subprocess.DEVNULL
+        ).strip().decode('utf-8')
+    except subprocess.CalledProcessError:
+        return None
+    return output.splitlines() if output else []
@@ -0,0 +1,224 @@
+"""
+Ingestion plugins for vendor file formats.
+
+Plugins read a raw file's header eagerly but its data lazily, as a
+memory-mapped array or an MNE Raw that is not preloaded, so that storing the
+payload converts it to the registered storage format in bounded-memory blocks
+rather than loading it whole. RawDataUpload uses a plugin whenever one is
+registered for the sniffed format of the uploaded file.
+"""
+from typing import Dict, List, Optional, Type
+
+from ..models import DataType
+from ..storage.storage_utils import release_pages
+from . import data_utils as du
+
+from abc import ABC, abstractmethod
+import contextlib
+import gzip
+import numpy as np
+import mne
+import shutil
+import struct
+
+
+FORMAT_TO_PLUGIN: Dict[str, Type['IngestPlugin']] = {}
+
+
+class IngestPlugin(ABC):
+    """Lazily reads one file of a vendor format.
+
+    To implement a plugin:
+    1. Subclass IngestPlugin and set the data_types it produces
+    2. Implement load(), returning a lazily-read payload
+    3. Use the register method to register the sniffed formats it reads
+
+    Plugins are context managers; scratch files created while loading are
+    removed on close().
+
+    Args:
+        path: Local path to the file.
+    """
+    data_types: List[DataType]
+
+    def __init__(self, path: str):
+        self.path = path
+        # Filled in from the file's header, if it has one.
+        self.sampling_rate: Optional[float] = None
+        self._stack = contextlib.ExitStack()
+
+    @abstractmethod
+    def load(self) -> du.TimecoursePayload:
+        """Return the file's data without reading it into memory."""
+        raise NotImplementedError
+
+    def _scratch_file(self, suffix: str) -> str:
+        """A scratch file that lives until the plugin is closed."""
+        return self._stack.enter_context(du.scratch_file(suffix=suffix))
+
+    def close(self):
+        self._stack.close()
+
+    def __enter__(self) -> 'IngestPlugin':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @classmethod
+    def register(cls, formats: List[str]):
+        for data_format in formats:
+            FORMAT_TO_PLUGIN[data_format] = cls
+
+
+def get_plugin(path: str) -> Optional[Type[IngestPlugin]]:
+    """Return the plugin registered for a file's sniffed format, if any."""
+    return FORMAT_TO_PLUGIN.get(du.sniff_format(path))
+
+
+class MNERawPlugin(IngestPlugin):
+    """Reads EEG recordings (EDF, BDF, BrainVision) without preloading them.
+
+    MNE reads the samples on demand, and saving the Raw to fif copies them
+    in one-second buffers.
+    """
+    data_types = [DataType.EEG]
+
+    _READERS = {
+        "edf": mne.io.read_raw_edf,
+        "bdf": mne.io.read_raw_bdf,
+        "brainvision": mne.io.read_raw_brainvision,
+    }
+
+    def load(self) -> mne.io.BaseRaw:
+        reader = self._READERS[du.sniff_format(self.path)]
+        raw = reader(self.path, preload=False)
+        self.sampling_rate = float(raw.info['sfreq'])
+        return raw
+
+
+MNERawPlugin.register(["edf", "bdf", "brainvision"])
+
+
+# NIfTI-1 datatype codes and the numpy types they correspond to.
+NIFTI_DTYPES = {
+    2: np.uint8,
+    4: np.int16,
+    8: np.int32,
+    16: np.float32,
+    64: np.float64,
+    256: np.int8,
+    512: np.uint16,
+    768: np.uint32,
+    1024: np.int64,
+    1280: np.uint64,
+}
+
+# Seconds per unit, for the time units of the NIfTI xyzt_units field.
+NIFTI_TIME_UNITS = {0x08: 1.0, 0x10: 1e-3, 0x18: 1e-6}
+
+NIFTI1_HEADER_SIZE = 348
+
+# Time points converted per block when scaling NIfTI data.
+_NIFTI_BLOCK_BYTES = 64 * 1024 * 1024
+
+
+class NiftiPlugin(IngestPlugin):
+    """Reads single-file NIfTI-1 volumes (.nii, .nii.gz) as memory maps.
+
+    Only the 348 byte header is parsed. The voxel data of an uncompressed
+    file is memory-mapped in place; gzipped files are first streamed to a
+    scratch file. Data with a scaling slope or intercept is scaled block by
+    block into a float32 scratch file. The sampling rate is 1 / TR, taken from
+    the fourth pixdim.
+    """
+    data_types = [DataType.FMRI]
+
+    def load(self) -> np.ndarray:
+        path = self.path
+        if _is_gzipped(path):
+            path = self._scratch_file(suffix=".nii")
+            with gzip.open(self.path, 'rb') as src, open(path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+
+        header = read_nifti1_header(path)
+        self.sampling_rate = header["sampling_rate"]
+        data = np.memmap(path, dtype=header["dtype"], mode="r",
+                         offset=header["vox_offset"], shape=header["shape"],
+                         order="F")
+        slope, inter = header["scl_slope"], header["scl_inter"]
+        if slope in (0.0, 1.0) and inter == 0.0:
+            return data
+        return self._scale(data, slope or 1.0, inter)
+
+    def _scale(self, data: np.memmap, slope: float,
+               inter: float) -> np.ndarray:
+        path = self._scratch_file(suffix=".f32")
+        # NIfTI data is Fortran ordered, so time is the slowest axis and
+        # consecutive time blocks are contiguous on disk.
+        volume_bytes = max(int(np.prod(data.shape[:-1])) * 4, 1)
+        step = max(1, _NIFTI_BLOCK_BYTES // volume_bytes)
+        with open(path, 'wb') as f:
+            for start in range(0, data.shape[-1], step):
+                block = data[..., start:start + step] * np.float32(slope)
+                block += np.float32(inter)
+                f.write(block.astype(np.float32).tobytes(order="F"))
+                release_pages(data)
+        return np.memmap(path, dtype=np.float32, mode="r", shape=data.shape,
+                         order="F")
+
+
+NiftiPlugin.register(["nifti"])
+
+
+def _is_gzipped(path: str) -> bool:
+    with open(path, 'rb') as f:
+        return f.read(2) == b'\x1f\x8b'
+
+
+def read_nifti1_header(path: str) -> dict:
+    """Parse the fields of an uncompressed NIfTI-1 header needed to read it.
+
+    Returns:
+        dict: The data's shape, numpy dtype (with the file's byte order),
+        vox_offset, scl_slope, scl_inter and sampling_rate (None if the file
+        doesn't record a repetition time).
+    """
+    with open(path, 'rb') as f:
+        raw = f.read(NIFTI1_HEADER_SIZE)
+    if len(raw) < NIFTI1_HEADER_SIZE:
+        raise ValueError(f"{path} is too short to be a NIfTI-1 file")
+    for endian in "<>":
+        if struct.unpack(endian + "i", raw[:4])[0] == NIFTI1_HEADER_SIZE:
+            break
+    else:
+        raise ValueError(f"{path} is not a NIfTI-1 file (NIfTI-2 and "
+                         "ANALYZE files are not supported)")
+    if raw[344:348] != b'n+1\x00':
+        raise ValueError(f"{path} is not a single-file NIfTI-1 volume")
+
+    dim = struct.unpack(endian + "8h", raw[40:56])
+    datatype = struct.unpack(endian + "h", raw[70:72])[0]
+    pixdim = struct.unpack(endian + "8f", raw[76:108])
+    vox_offset, scl_slope, scl_inter = struct.unpack(endian + "3f",
+                                                     raw[108:120])
+    xyzt_units = raw[123]
+
+    if datatype not in NIFTI_DTYPES:
+        raise ValueError(f"Unsupported NIfTI datatype {datatype} in {path}")
+    ndim = dim[0]
+    shape = tuple(int(n) for n in dim[1:ndim + 1])
+
+    sampling_rate = None
+    time_unit = NIFTI_TIME_UNITS.get(xyzt_units & 0x38, 1.0)
+    if ndim >= 4 and pixdim[4] > 0:
+        sampling_rate = 1.0 / (pixdim[4] * time_unit)
+
+    return {
+        "shape": shape,
+        "dtype": np.dtype(NIFTI_DTYPES[datatype]).newbyteorder(endian),
+        "vox_offset": max(int(vox_offset), NIFTI1_HEADER_SIZE),
+        "scl_slope": float(np.nan_to_num(scl_slope)),
+        "scl_inter": float(np.nan_to_num(scl_inter)),
+        "sampling_rate": sampling_rate,
+    }
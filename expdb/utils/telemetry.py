@@ -0,0 +1,152 @@
+from typing import Iterator, List, Optional, Tuple
+
+from contextvars import ContextVar
+import contextlib
+import dataclasses
+import os
+import sys
+import time
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+@dataclasses.dataclass
+class StageMeasurement:
+    """What one stage of a transform run cost.
+
+    Attributes:
+        name: The stage, prefixed by its enclosing stages, e.g.
+            "load/download".
+        wall_time: Elapsed seconds.
+        cpu_time: CPU seconds used by the process (all threads).
+        bytes: Size of the payload files read or written by the stage and
+            the stages within it, or None if it read or wrote none.
+        max_rss: The peak resident set size of the process when the stage
+            ended, in bytes. It is a high-water mark, so a stage raised it only
+            if it is larger than the previous stage's.
+    """
+    name: str
+    wall_time: float = 0.0
+    cpu_time: float = 0.0
+    bytes: Optional[int] = None
+    max_rss: Optional[int] = None
+
+
+_CURRENT_STAGE: ContextVar[Optional[Tuple['Recorder', StageMeasurement]]] = (
+    ContextVar('telemetry_stage', default=None))
+
+
+def max_rss() -> Optional[int]:
+    """The peak resident set size of this process so far, in bytes."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS.
+    return rss if sys.platform == "darwin" else rss * 1024
+
+
+def current_rss() -> Optional[int]:
+    """The resident set size of this process now, in bytes (Linux only)."""
+    try:
+        with open("/proc/self/statm") as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * os.sysconf("SC_PAGE_SIZE")
+
+
+def reset_peak_rss() -> bool:
+    """Reset the peak resident set size reported by peak_rss() to now.
+
+    Only Linux supports this; elsewhere the peak stays the process's.
+
+    Returns:
+        Whether the peak was reset.
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+    except OSError:
+        return False
+    return True
+
+
+def peak_rss() -> Optional[int]:
+    """The peak resident set size since reset_peak_rss(), in bytes.
+
+    Falls back to max_rss(), the peak of the whole process, where the peak
+    can't be reset.
+    """
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return max_rss()
+
+
+class Recorder:
+    """Records the stages of one transform run.
+
+    Stages may be nested. A stage opened with the module-level ``stage`` (as
+    the storage managers do) is recorded by the recorder whose stage encloses
+    it, and is a no-op outside of one.
+
+    Example:
+        recorder = Recorder()
+        with recorder.stage("load"):
+            data = storage_manager.retrieve(tc)  # records load/download...
+    """
+
+    def __init__(self):
+        self.stages: List[StageMeasurement] = []
+
+    @contextlib.contextmanager
+    def stage(self, name: str) -> Iterator[StageMeasurement]:
+        current = _CURRENT_STAGE.get()
+        parent = (current[1] if current is not None and current[0] is self
+                  else None)
+        measurement = StageMeasurement(
+            name if parent is None else f"{parent.name}/{name}")
+        # Stages are listed in the order they start, so each is listed before
+        # the stages within it.
+        self.stages.append(measurement)
+        token = _CURRENT_STAGE.set((self, measurement))
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield measurement
+        finally:
+            measurement.wall_time = time.perf_counter() - wall
+            measurement.cpu_time = time.process_time() - cpu
+            measurement.max_rss = max_rss()
+            _CURRENT_STAGE.reset(token)
+            if parent is not None and measurement.bytes is not None:
+                parent.bytes = (parent.bytes or 0) + measurement.bytes
+
+    def top_level(self) -> List[StageMeasurement]:
+        """The stages that aren't within another stage."""
+        return [s for s in self.stages if "/" not in s.name]
+
+
+@contextlib.contextmanager
+def stage(name: str) -> Iterator[Optional[StageMeasurement]]:
+    """Record a stage within the current stage of a Recorder, if any."""
+    current = _CURRENT_STAGE.get()
+    if current is None:
+        yield None
+        return
+    with current[0].stage(name) as measurement:
+        yield measurement
+
+
+def add_bytes(n: int):
+    """Count file bytes read or written against the current stage, if any."""
+    current = _CURRENT_STAGE.get()
+    if current is not None:
+        measurement = current[1]
+        measurement.bytes = (measurement.bytes or 0) + n
@@ -0,0 +1,52 @@
+"""Add transform jobs
+
+Revision ID: 9aaa8253cf0b
+Revises: d5a58c2c5833
+Create Date: 2026-10-19 13:40:02.518370
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = '9aaa8253cf0b'
+down_revision: Union[str, None] = 'd5a58c2c5833'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'transform_jobs',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('transform', sa.String(length=255), nullable=False),
+        sa.Column('params_json', sa.Text(), nullable=False),
+        sa.Column('input_ids_json', sa.Text(), nullable=False),
+        sa.Column('status',
+                  sa.Enum('QUEUED', 'RUNNING', 'DONE', 'FAILED',
+                          name='jobstatus'),
+                  nullable=False),
+        sa.Column('attempts', sa.Integer(), nullable=False),
+        sa.Column('max_attempts', sa.Integer(), nullable=False),
+        sa.Column('worker_id', sa.String(length=255), nullable=True),
+        sa.Column('error', sa.Text(), nullable=True),
+        sa.Column('created_at', sa.DateTime(),
+                  server_default=sa.text('now()'), nullable=True),
+        sa.Column('claimed_at', sa.DateTime(), nullable=True),
+        sa.Column('heartbeat_at', sa.DateTime(), nullable=True),
+        sa.Column('finished_at', sa.DateTime(), nullable=True),
+        sa.Column('output_timecourse_id', sa.Integer(), nullable=True),
+        sa.ForeignKeyConstraint(['output_timecourse_id'], ['timecourses.id']),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index('ix_transform_jobs_status_id', 'transform_jobs',
+                    ['status', 'id'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_transform_jobs_status_id', table_name='transform_jobs')
+    op.drop_table('transform_jobs')
+    sa.Enum(name='jobstatus').drop(op.get_bind(), checkfirst=True)
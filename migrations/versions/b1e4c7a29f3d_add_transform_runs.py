@@ -0,0 +1,75 @@
+"""Add transform runs
+
+Revision ID: b1e4c7a29f3d
+Revises: 9aaa8253cf0b
+Create Date: 2026-10-19 15:02:47.118204
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'b1e4c7a29f3d'
+down_revision: Union[str, None] = '9aaa8253cf0b'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'transform_runs',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('timecourse_id', sa.Integer(), nullable=False),
+        sa.Column('transform', sa.String(length=255), nullable=False),
+        sa.Column('git_commit', sa.String(), nullable=True),
+        sa.Column('hostname', sa.String(length=255), nullable=True),
+        sa.Column('started_at', sa.DateTime(),
+                  server_default=sa.text('now()'), nullable=True),
+        sa.Column('wall_time', sa.Float(), nullable=False),
+        sa.Column('cpu_time', sa.Float(), nullable=False),
+        sa.Column('max_rss', sa.BigInteger(), nullable=True),
+        sa.ForeignKeyConstraint(['timecourse_id'], ['timecourses.id']),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_transform_runs_timecourse_id'),
+                    'transform_runs', ['timecourse_id'], unique=False)
+    op.create_index(op.f('ix_transform_runs_transform'), 'transform_runs',
+                    ['transform'], unique=False)
+    op.create_index(op.f('ix_transform_runs_git_commit'), 'transform_runs',
+                    ['git_commit'], unique=False)
+    op.create_table(
+        'transform_run_stages',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('run_id', sa.Integer(), nullable=False),
+        sa.Column('position', sa.Integer(), nullable=False),
+        sa.Column('stage', sa.String(length=255), nullable=False),
+        sa.Column('wall_time', sa.Float(), nullable=False),
+        sa.Column('cpu_time', sa.Float(), nullable=False),
+        sa.Column('bytes', sa.BigInteger(), nullable=True),
+        sa.Column('max_rss', sa.BigInteger(), nullable=True),
+        sa.ForeignKeyConstraint(['run_id'], ['transform_runs.id']),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_transform_run_stages_run_id'),
+                    'transform_run_stages', ['run_id'], unique=False)
+    op.create_index('ix_transform_run_stages_stage_wall_time',
+                    'transform_run_stages', ['stage', 'wall_time'],
+                    unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_transform_run_stages_stage_wall_time',
+                  table_name='transform_run_stages')
+    op.drop_index(op.f('ix_transform_run_stages_run_id'),
+                  table_name='transform_run_stages')
+    op.drop_table('transform_run_stages')
+    op.drop_index(op.f('ix_transform_runs_git_commit'),
+                  table_name='transform_runs')
+    op.drop_index(op.f('ix_transform_runs_transform'),
+                  table_name='transform_runs')
+    op.drop_index(op.f('ix_transform_runs_timecourse_id'),
+                  table_name='transform_runs')
+    op.drop_table('transform_runs')
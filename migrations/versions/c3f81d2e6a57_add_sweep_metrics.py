@@ -0,0 +1,49 @@
+"""Add sweep metrics
+
+Revision ID: c3f81d2e6a57
+Revises: b1e4c7a29f3d
+Create Date: 2026-10-19 17:41:09.532871
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'c3f81d2e6a57'
+down_revision: Union[str, None] = 'b1e4c7a29f3d'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'sweep_metrics',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('input_id', sa.Integer(), nullable=False),
+        sa.Column('output_id', sa.Integer(), nullable=True),
+        sa.Column('transform', sa.String(length=255), nullable=False),
+        sa.Column('params_json', sa.Text(), nullable=False),
+        sa.Column('git_commit', sa.String(), nullable=True),
+        sa.Column('derivation_key', sa.String(length=64), nullable=True),
+        sa.Column('value_json', sa.Text(), nullable=False),
+        sa.Column('created_at', sa.DateTime(),
+                  server_default=sa.text('now()'), nullable=True),
+        sa.ForeignKeyConstraint(['input_id'], ['timecourses.id']),
+        sa.ForeignKeyConstraint(['output_id'], ['timecourses.id']),
+        sa.PrimaryKeyConstraint('id')
+    )
+    op.create_index(op.f('ix_sweep_metrics_input_id'), 'sweep_metrics',
+                    ['input_id'], unique=False)
+    op.create_index(op.f('ix_sweep_metrics_derivation_key'), 'sweep_metrics',
+                    ['derivation_key'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_sweep_metrics_derivation_key'),
+                  table_name='sweep_metrics')
+    op.drop_index(op.f('ix_sweep_metrics_input_id'),
+                  table_name='sweep_metrics')
+    op.drop_table('sweep_metrics')
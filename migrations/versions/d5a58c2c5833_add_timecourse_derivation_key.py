@@ -0,0 +1,32 @@
+"""Add timecourse derivation key
+
+Revision ID: d5a58c2c5833
+Revises: 7373b7673ef0
+Create Date: 2026-10-19 10:12:31.402615
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'd5a58c2c5833'
+down_revision: Union[str, None] = '7373b7673ef0'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.add_column('timecourses',
+                  sa.Column('derivation_key', sa.String(length=64),
+                            nullable=True))
+    op.create_index(op.f('ix_timecourses_derivation_key'), 'timecourses',
+                    ['derivation_key'], unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_timecourses_derivation_key'),
+                  table_name='timecourses')
+    op.drop_column('timecourses', 'derivation_key')
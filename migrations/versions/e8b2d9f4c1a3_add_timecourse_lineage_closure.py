@@ -0,0 +1,57 @@
+"""Add timecourse lineage closure
+
+Revision ID: e8b2d9f4c1a3
+Revises: c3f81d2e6a57
+Create Date: 2026-10-19 19:02:44.118305
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'e8b2d9f4c1a3'
+down_revision: Union[str, None] = 'c3f81d2e6a57'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_table(
+        'timecourse_lineage_closure',
+        sa.Column('ancestor_id', sa.Integer(), nullable=False),
+        sa.Column('descendant_id', sa.Integer(), nullable=False),
+        sa.Column('depth', sa.Integer(), nullable=False),
+        sa.ForeignKeyConstraint(['ancestor_id'], ['timecourses.id']),
+        sa.ForeignKeyConstraint(['descendant_id'], ['timecourses.id']),
+        sa.PrimaryKeyConstraint('ancestor_id', 'descendant_id')
+    )
+    op.create_index(op.f('ix_timecourse_lineage_closure_descendant_id'),
+                    'timecourse_lineage_closure', ['descendant_id'],
+                    unique=False)
+    # Backfill from the existing lineage, keeping the shortest paths.
+    op.execute("""
+        INSERT INTO timecourse_lineage_closure
+            (ancestor_id, descendant_id, depth)
+        WITH RECURSIVE paths (ancestor_id, descendant_id, depth) AS (
+            SELECT parent_timecourse_id, derived_timecourse_id, 1
+            FROM timecourse_lineage_association
+            UNION ALL
+            SELECT lineage.parent_timecourse_id, paths.descendant_id,
+                   paths.depth + 1
+            FROM timecourse_lineage_association AS lineage
+            JOIN paths
+              ON lineage.derived_timecourse_id = paths.ancestor_id
+        )
+        SELECT ancestor_id, descendant_id, MIN(depth)
+        FROM paths
+        GROUP BY ancestor_id, descendant_id
+    """)
+
+
+def downgrade() -> None:
+    op.drop_index(op.f('ix_timecourse_lineage_closure_descendant_id'),
+                  table_name='timecourse_lineage_closure')
+    op.drop_table('timecourse_lineage_closure')
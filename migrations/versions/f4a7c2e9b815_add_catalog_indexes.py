@@ -0,0 +1,42 @@
+"""Add catalog indexes
+
+Revision ID: f4a7c2e9b815
+Revises: e8b2d9f4c1a3
+Create Date: 2026-10-19 20:15:37.604112
+
+"""
+from typing import Sequence, Union
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision: str = 'f4a7c2e9b815'
+down_revision: Union[str, None] = 'e8b2d9f4c1a3'
+branch_labels: Union[str, Sequence[str], None] = None
+depends_on: Union[str, Sequence[str], None] = None
+
+
+def upgrade() -> None:
+    op.create_index('ix_timecourses_subject_modality_type_date',
+                    'timecourses',
+                    ['subject_id', 'modality', 'type', 'date_collected'],
+                    unique=False)
+    op.create_index('ix_timecourses_study_modality_type_date',
+                    'timecourses',
+                    ['study_id', 'modality', 'type', 'date_collected'],
+                    unique=False)
+    op.create_index('ix_timecourse_lineage_parent',
+                    'timecourse_lineage_association',
+                    ['parent_timecourse_id', 'derived_timecourse_id'],
+                    unique=False)
+
+
+def downgrade() -> None:
+    op.drop_index('ix_timecourse_lineage_parent',
+                  table_name='timecourse_lineage_association')
+    op.drop_index('ix_timecourses_study_modality_type_date',
+                  table_name='timecourses')
+    op.drop_index('ix_timecourses_subject_modality_type_date',
+                  table_name='timecourses')